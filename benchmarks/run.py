@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+"""Benchmarks for Stenographer's record, replay, load, and save paths.
+
+Each benchmark case records a cassette from a local Twisted Web server,
+then measures loading, replaying, and saving it.  Every measurement
+runs in a fresh worker process, so that peak memory figures are not
+polluted by earlier ones.  Results are written as JSON, for comparison
+between releases."""
+
+
+import argparse
+from collections import namedtuple
+import gzip
+from io import BytesIO
+import json
+from multiprocessing import Pool
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from twisted.internet.defer import inlineCallbacks
+from twisted.web.client import Agent, HTTPConnectionPool, readBody
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+
+from stenographer import CassetteAgent, __version__
+from stenographer.cassette import Cassette
+from stenographer.recorder import Recorder
+from stenographer.storage import load_cassette
+
+
+#: Body encodings to benchmark.  ``text`` bodies are stored as UTF-8
+#: strings, ``base64`` bodies are recorded with exact body bytes
+#: preserved, and ``gzip`` bodies are sent compressed by the upstream.
+ENCODINGS = ('text', 'base64', 'gzip')
+
+#: Benchmarks that run against a recorded cassette, in order.
+BENCHMARKS = ('load', 'replay', 'as_dict', 'save')
+
+WORDS = ('stenographer', 'cassette', 'interaction', 'twisted', 'agent',
+         'response', 'request', 'header', 'body', 'replay', 'record')
+
+
+class Case(namedtuple('Case', 'interactions body_size encoding')):
+    """A cassette shape to benchmark."""
+
+    @property
+    def preserve_exact_body_bytes(self):
+        return self.encoding == 'base64'
+
+    def as_dict(self):
+        return dict(self._asdict())
+
+
+def make_body(size, seed=0):
+    """Return *size* bytes of pseudo-random words."""
+    rng = random.Random(seed)
+    chunks = []
+    length = 0
+    while length < size:
+        word = rng.choice(WORDS)
+        chunks.append(word)
+        length += len(word) + 1
+    return ' '.join(chunks)[:size]
+
+
+class BodyResource(Resource):
+    """Serves a body of the size given in the ``size`` query argument,
+    gzip-compressed if the ``gzip`` argument is present."""
+
+    isLeaf = True
+
+    def __init__(self):
+        Resource.__init__(self)
+        self.bodies = {}
+
+    def render_GET(self, request):
+        size = int(request.args['size'][0])
+        compressed = 'gzip' in request.args
+        if (size, compressed) not in self.bodies:
+            body = make_body(size)
+            if compressed:
+                buf = BytesIO()
+                with gzip.GzipFile(fileobj=buf, mode='wb') as gzip_file:
+                    gzip_file.write(body)
+                body = buf.getvalue()
+            self.bodies[size, compressed] = body
+        request.setHeader('Content-Type', 'text/plain; charset=utf-8')
+        if compressed:
+            request.setHeader('Content-Encoding', 'gzip')
+        return self.bodies[size, compressed]
+
+
+def peak_memory():
+    """Return this process's peak resident set size, in KiB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, but OS X reports bytes.
+    if sys.platform == 'darwin':
+        peak //= 1024
+    return peak
+
+
+def percentile(values, fraction):
+    """Return the value at *fraction* through the sorted *values*."""
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def bench_record(case, cassette_path, concurrency):
+    """Record *case* into *cassette_path* from a local server, and
+    return the time taken to fetch every interaction."""
+    from twisted.internet import reactor
+    port = reactor.listenTCP(0, Site(BodyResource()), interface='127.0.0.1')
+    uris = ['http://127.0.0.1:{}/{}?size={}{}'.format(
+                port.getHost().port, i, case.body_size,
+                '&gzip=1' if case.encoding == 'gzip' else '')
+            for i in xrange(case.interactions)]
+    pool = HTTPConnectionPool(reactor)
+    pool.maxPersistentPerHost = concurrency
+    cassette_agent = CassetteAgent(
+        Agent(reactor, pool=pool), cassette_path,
+        preserve_exact_body_bytes=case.preserve_exact_body_bytes)
+    recorder = Recorder(cassette_agent, concurrency, concurrency)
+    result = {}
+
+    @inlineCallbacks
+    def run():
+        baseline = peak_memory()
+        started = time.time()
+        try:
+            yield recorder.fetch_all(uris)
+            result['seconds'] = time.time() - started
+            result['peak_memory_kib'] = peak_memory() - baseline
+            result['failures'] = len(recorder.failures)
+            cassette_agent.save()
+        finally:
+            yield pool.closeCachedConnections()
+            yield port.stopListening()
+            reactor.stop()
+    reactor.callWhenRunning(run)
+    reactor.run()
+    result['interactions_per_second'] = (
+        case.interactions / result['seconds'])
+    result['bytes_per_second'] = (
+        case.interactions * case.body_size / result['seconds'])
+    return result
+
+
+def bench_load(case, cassette_path, repeat):
+    """Time building a `Cassette` from an already parsed dict, and
+    loading one from disk from scratch."""
+    with open(cassette_path, 'rb') as cassette_file:
+        dct = json.load(cassette_file)
+    baseline = peak_memory()
+    from_dict = []
+    for _ in xrange(repeat):
+        started = time.time()
+        Cassette.from_dict(dct)
+        from_dict.append(time.time() - started)
+    peak = peak_memory() - baseline
+    del dct
+    from_file = []
+    for _ in xrange(repeat):
+        started = time.time()
+        load_cassette(cassette_path)
+        from_file.append(time.time() - started)
+    return {'seconds': min(from_dict), 'peak_memory_kib': peak,
+            'load_cassette_seconds': min(from_file)}
+
+
+def bench_replay(case, cassette_path, repeat):
+    """Time replaying every interaction in the cassette, including
+    reading the response body."""
+    with open(cassette_path, 'rb') as cassette_file:
+        requests = [(interaction['request']['method'],
+                     interaction['request']['uri'].encode('utf-8'))
+                    for interaction in json.load(cassette_file)[
+                        'http_interactions']]
+    latencies = []
+    failures = []
+    baseline = peak_memory()
+    for _ in xrange(repeat):
+        agent = CassetteAgent(None, cassette_path)
+        for method, uri in requests:
+            started = time.time()
+            finished = agent.request(method, uri)
+            finished.addCallback(readBody)
+            finished.addErrback(failures.append)
+            latencies.append(time.time() - started)
+    if failures:
+        failures[0].raiseException()
+    return {'seconds': sum(latencies) / repeat,
+            'peak_memory_kib': peak_memory() - baseline,
+            'mean_latency': sum(latencies) / len(latencies),
+            'median_latency': percentile(latencies, 0.5),
+            'p99_latency': percentile(latencies, 0.99)}
+
+
+def bench_as_dict(case, cassette_path, repeat):
+    """Time serializing a loaded cassette into a dict."""
+    cassette = load_cassette(cassette_path)
+    baseline = peak_memory()
+    times = []
+    for _ in xrange(repeat):
+        started = time.time()
+        cassette.as_dict(case.preserve_exact_body_bytes)
+        times.append(time.time() - started)
+    return {'seconds': min(times), 'peak_memory_kib': peak_memory() - baseline}
+
+
+def bench_save(case, cassette_path, repeat):
+    """Time saving a loaded cassette through `CassetteAgent.save`."""
+    cassette = load_cassette(cassette_path)
+    save_path = cassette_path + '.saved'
+    baseline = peak_memory()
+    times = []
+    for _ in xrange(repeat):
+        agent = CassetteAgent(
+            None, save_path,
+            preserve_exact_body_bytes=case.preserve_exact_body_bytes)
+        agent.cassette = agent.recorded = cassette
+        started = time.time()
+        agent.save()
+        times.append(time.time() - started)
+        os.remove(save_path)
+    return {'seconds': min(times), 'peak_memory_kib': peak_memory() - baseline}
+
+
+def run_benchmark(args):
+    """Run the benchmark named in an ``(name, case, cassette_path,
+    option)`` tuple, and return its result dict."""
+    name, case, cassette_path, option = args
+    return globals()['bench_' + name](case, cassette_path, option)
+
+
+def run_case(case, directory, repeat, concurrency, workers):
+    """Run every benchmark for *case*, and return a list of results."""
+    cassette_path = os.path.join(directory, '{}-{}-{}.json'.format(*case))
+    results = []
+    tasks = [('record', case, cassette_path, concurrency)]
+    tasks.extend((name, case, cassette_path, repeat) for name in BENCHMARKS)
+    for task in tasks:
+        result = workers.apply(run_benchmark, (task,))
+        result.update(case.as_dict(), benchmark=task[0])
+        if task[0] == 'record':
+            result['cassette_bytes'] = os.path.getsize(cassette_path)
+        results.append(result)
+        sys.stderr.write('{benchmark} {interactions}x{body_size} '
+                         '{encoding}: {seconds:.4f}s\n'.format(**result))
+    os.remove(cassette_path)
+    return results
+
+
+def integer_list(string):
+    return [int(value) for value in string.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark recording, replaying, loading, and saving '
+                    'cassettes of various sizes and body encodings.')
+    parser.add_argument(
+        '-o', '--output', default='benchmark-results.json', metavar='PATH',
+        help='path to write JSON results to (default: %(default)s)')
+    parser.add_argument(
+        '--interactions', type=integer_list, default=[10, 100, 1000],
+        metavar='N,...',
+        help='interaction counts to benchmark (default: 10,100,1000)')
+    parser.add_argument(
+        '--body-sizes', type=integer_list, default=[1024, 65536, 1048576],
+        metavar='BYTES,...',
+        help='body sizes to benchmark (default: 1024,65536,1048576)')
+    parser.add_argument(
+        '--encodings', type=lambda s: s.split(','), default=ENCODINGS,
+        metavar='ENCODING,...',
+        help='body encodings to benchmark (default: {})'.format(
+            ','.join(ENCODINGS)))
+    parser.add_argument(
+        '--max-total-bytes', type=int, default=256 * 1024 * 1024,
+        metavar='BYTES',
+        help='skip cases whose bodies add up to more than this many '
+             'bytes (default: %(default)s)')
+    parser.add_argument(
+        '--repeat', type=int, default=3, metavar='N',
+        help='number of times to repeat each measurement; the fastest '
+             'is reported (default: %(default)s)')
+    parser.add_argument(
+        '-c', '--concurrency', type=int, default=10, metavar='N',
+        help='maximum number of requests in flight while recording '
+             '(default: %(default)s)')
+    args = parser.parse_args()
+    cases = [Case(interactions, body_size, encoding)
+             for interactions in args.interactions
+             for body_size in args.body_sizes
+             for encoding in args.encodings
+             if interactions * body_size <= args.max_total_bytes]
+    directory = tempfile.mkdtemp(prefix='stenographer-benchmarks-')
+    # Every measurement gets a fresh process, both so that its peak
+    # memory can be measured and because reactors can't be restarted.
+    workers = Pool(1, maxtasksperchild=1)
+    results = []
+    try:
+        for case in cases:
+            results.extend(run_case(case, directory, args.repeat,
+                                    args.concurrency, workers))
+    finally:
+        workers.close()
+        workers.join()
+        shutil.rmtree(directory)
+    with open(args.output, 'w') as output_file:
+        json.dump({'stenographer_version': __version__,
+                   'python_version': platform.python_version(),
+                   'platform': platform.platform(),
+                   'timestamp': time.time(),
+                   'results': results},
+                  output_file, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
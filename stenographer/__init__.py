@@ -1,5 +1,5 @@
 """Stenographer, an HTTP interaction recorder for Twisted Web."""
 
 
-from .agent import CassetteAgent
+from .agent import CassetteAgent, RoutingAgent
 from .__version__ import __version__
@@ -2,57 +2,524 @@
 
 
 import argparse
-from itertools import imap
+import json
 import sys
 
-from twisted.internet import reactor
-from twisted.internet.defer import DeferredList, inlineCallbacks
-from twisted.web.client import (Agent, ContentDecoderAgent,
-                                RedirectAgent, GzipDecoder, readBody)
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import LoopingCall
+from twisted.web.client import (Agent, ContentDecoderAgent, GzipDecoder,
+                                HTTPConnectionPool, RedirectAgent)
+from twisted.web.server import Site
 
-from .agent import CassetteAgent
+from .agent import RECORD_MODES, CassetteAgent
+from .batch import record_manifest
+from .blobs import BlobStore
+from .cache import DecodedBodyCache
+from .cassette import DEFAULT_MATCH_ON
+from .maintenance import (cassette_stats, compact_cassette, dedupe_cassette,
+                          find_cassettes, maintain, merge_cassettes,
+                          prune_cassette)
+from .recorder import Recorder
+from .refresh import Refresher
+from .server import CassetteResource, ProxyResource
+from .storage import convert_cassette, load_cassette
 
 
 @inlineCallbacks
-def save_and_exit(responses, cassette_agent):
-    """Save the cassette and stop the reactor."""
-    for success, response in responses:
-        if success:
-            while response:
-                yield readBody(response)
-                response = response.previousResponse
-    cassette_agent.save()
+def save_and_exit(_, recorder, cassette_agent, pool):
+    """Report any failures, save the cassette, and stop the reactor."""
+    from twisted.internet import reactor
+    for uri, failure in recorder.failures:
+        sys.stderr.write('{}: {}\n'.format(uri, failure.getErrorMessage()))
+    sys.stderr.write(recorder.progress() + '\n')
+    yield cassette_agent.save_async()
+    yield pool.closeCachedConnections()
     reactor.stop()
 
 
 def fail_and_exit(failure):
     """Print a failure message and stop the reactor."""
+    from twisted.internet import reactor
     failure.printTraceback(file=sys.stderr)
     reactor.stop()
 
 
-def main():
-    """Main command line entry point."""
+def report_progress(recorder):
+    """Print a progress report for *recorder*."""
+    sys.stderr.write(recorder.progress() + '\n')
+
+
+def record(argv):
+    """Recording command line entry point."""
     parser = argparse.ArgumentParser(
         description='Make requests to one or more HTTP or HTTPS URIs, '
                     'and record the interactions in a cassette.',
         epilog='If no URIs are passed on the command line, they are '
-               'read from standard input, one per line.')
+               'read from standard input, one per line.  Other commands: '
+               '{}.'.format(', '.join(sorted(COMMANDS))))
     parser.add_argument(
         'uris', metavar='URI', nargs='*', help='URI to fetch')
     parser.add_argument(
         'cassette_path', metavar='CASSETTE',
         help='path to output cassette')
-    args = parser.parse_args()
-    uris = args.uris or imap(lambda x: x.strip(), sys.stdin)
-    cassette_agent = CassetteAgent(Agent(reactor), args.cassette_path)
+    parser.add_argument(
+        '-c', '--concurrency', type=int, default=10, metavar='N',
+        help='maximum number of requests in flight (default: %(default)s)')
+    parser.add_argument(
+        '--per-host', type=int, default=2, metavar='N',
+        help='maximum number of requests in flight to, and idle '
+             'connections kept open to, any one host (default: '
+             '%(default)s)')
+    parser.add_argument(
+        '--progress-interval', type=float, default=10, metavar='SECONDS',
+        help='how often to report progress, or 0 to only report it at '
+             'the end (default: %(default)s)')
+    parser.add_argument(
+        '--record-mode', choices=RECORD_MODES, default='once',
+        help='how to treat an existing cassette: replay it and fail on '
+             'new requests (once), add new requests to it '
+             '(new_episodes), or re-record everything (all) (default: '
+             '%(default)s)')
+    args = parser.parse_args(argv)
+    from twisted.internet import reactor
+    uris = args.uris or (line.strip() for line in sys.stdin if line.strip())
+    pool = HTTPConnectionPool(reactor)
+    pool.maxPersistentPerHost = args.per_host
+    cassette_agent = CassetteAgent(Agent(reactor, pool=pool),
+                                   args.cassette_path, incremental=True,
+                                   record_mode=args.record_mode,
+                                   body_cache=DecodedBodyCache())
     agent = ContentDecoderAgent(
         RedirectAgent(cassette_agent), [('gzip', GzipDecoder)])
-    finished = DeferredList([agent.request('GET', uri) for uri in uris])
-    finished.addCallback(save_and_exit, cassette_agent)
+    recorder = Recorder(agent, args.concurrency, args.per_host)
+    if args.progress_interval:
+        LoopingCall(report_progress, recorder).start(
+            args.progress_interval, now=False)
+    finished = recorder.fetch_all(uris)
+    finished.addCallback(save_and_exit, recorder, cassette_agent, pool)
     finished.addErrback(fail_and_exit)
     reactor.run()
 
 
+def convert(argv):
+    """Conversion command line entry point."""
+    parser = argparse.ArgumentParser(
+        prog='stenographer convert',
+        description='Convert a cassette between the JSON, binary, and '
+                    'directory formats.',
+        epilog='A path that ends in a separator or names an existing '
+               'directory is treated as a directory cassette.')
+    parser.add_argument(
+        'source_path', metavar='SOURCE', help='path to input cassette')
+    parser.add_argument(
+        'target_path', metavar='TARGET', help='path to output cassette')
+    parser.add_argument(
+        '--binary', action='store_true',
+        help='write a binary cassette instead of a JSON one')
+    parser.add_argument(
+        '--blob-store', metavar='DIRECTORY',
+        help='blob store directory holding the input cassette\'s bodies')
+    args = parser.parse_args(argv)
+    blob_store = args.blob_store and BlobStore(args.blob_store)
+    convert_cassette(args.source_path, args.target_path,
+                     args.binary, blob_store)
+
+
+def report_cassette(cassette_path, summary):
+    """Print a batch recording summary for a single cassette."""
+    sys.stderr.write('{}: {} in {:.1f}s\n'.format(
+        cassette_path, summary['status'], summary['seconds']))
+
+
+def batch(argv):
+    """Batch recording command line entry point."""
+    parser = argparse.ArgumentParser(
+        prog='stenographer batch',
+        description='Record the cassettes listed in a manifest, in '
+                    'parallel worker processes.',
+        epilog='The manifest is a JSON object mapping cassette paths, '
+               'relative to the manifest, to lists of URIs to record. '
+               'Cassettes written after the manifest was last modified '
+               'are skipped.')
+    parser.add_argument(
+        'manifest_path', metavar='MANIFEST', help='path to manifest')
+    parser.add_argument(
+        '-j', '--processes', type=int, metavar='N',
+        help='number of worker processes (default: number of CPUs)')
+    parser.add_argument(
+        '--batch-size', type=int, default=8, metavar='N',
+        help='number of cassettes recorded at once by each worker '
+             '(default: %(default)s)')
+    parser.add_argument(
+        '-c', '--concurrency', type=int, default=10, metavar='N',
+        help='maximum number of requests in flight for each cassette '
+             '(default: %(default)s)')
+    parser.add_argument(
+        '--per-host', type=int, default=2, metavar='N',
+        help='maximum number of requests in flight to any one host for '
+             'each cassette (default: %(default)s)')
+    parser.add_argument(
+        '--force', action='store_true',
+        help='record cassettes even if they are up to date')
+    parser.add_argument(
+        '--summary', metavar='PATH',
+        help='path to write a JSON summary of the run to')
+    args = parser.parse_args(argv)
+    summary = record_manifest(
+        args.manifest_path, args.processes, args.batch_size,
+        args.concurrency, args.per_host, args.force, report_cassette)
+    if args.summary:
+        with open(args.summary, 'w') as summary_file:
+            json.dump(summary, summary_file, indent=2, sort_keys=True)
+    statuses = [s['status'] for s in summary['cassettes'].itervalues()]
+    sys.stderr.write('{} recorded, {} skipped, {} failed in {:.1f}s\n'.format(
+        statuses.count('recorded'), statuses.count('skipped'),
+        statuses.count('failed'), summary['seconds']))
+    if 'failed' in statuses:
+        sys.exit(1)
+
+
+def serve(argv):
+    """Replay server command line entry point."""
+    parser = argparse.ArgumentParser(
+        prog='stenographer serve',
+        description='Serve the interactions in a cassette over HTTP.',
+        epilog='Requests for absolute URIs, as sent to proxies, are '
+               'matched as is.  Relative ones are resolved against the '
+               'origin.  Requests that match no interaction get a 404 '
+               'response.')
+    parser.add_argument(
+        'cassette_path', metavar='CASSETTE', help='path to cassette')
+    parser.add_argument(
+        '-p', '--port', type=int, default=8080,
+        help='port to listen on (default: %(default)s)')
+    parser.add_argument(
+        '--interface', default='127.0.0.1',
+        help='interface to listen on (default: %(default)s)')
+    parser.add_argument(
+        '--origin', metavar='URI',
+        help='scheme and host to resolve request paths against (default: '
+             'the one shared by every interaction in the cassette, or '
+             'else the Host request header)')
+    parser.add_argument(
+        '--match-on', type=match_criteria, default=DEFAULT_MATCH_ON,
+        metavar='CRITERION,...',
+        help='request criteria to match interactions on: method, uri, '
+             'body, or header names (default: {})'.format(
+                 ','.join(DEFAULT_MATCH_ON)))
+    parser.add_argument(
+        '--once', action='store_true',
+        help='answer each interaction only once, instead of starting '
+             'over when identical requests run out')
+    parser.add_argument(
+        '--time-scale', type=float, default=0, metavar='FACTOR',
+        help='delay responses by their recorded durations times FACTOR '
+             '(default: %(default)s)')
+    parser.add_argument(
+        '--blob-store', metavar='DIRECTORY',
+        help='blob store directory holding the cassette\'s bodies')
+    args = parser.parse_args(argv)
+    from twisted.internet import reactor
+    blob_store = args.blob_store and BlobStore(args.blob_store)
+    cassette = load_cassette(args.cassette_path, args.match_on, lazy=True,
+                             blob_store=blob_store)
+    resource = CassetteResource(cassette, args.origin, args.once,
+                                args.time_scale)
+    port = reactor.listenTCP(args.port, Site(resource),
+                             interface=args.interface)
+    sys.stderr.write('Serving {} interactions on http://{}:{}/\n'.format(
+        len(cassette), args.interface, port.getHost().port))
+    reactor.run()
+
+
+def proxy(argv):
+    """Recording proxy command line entry point."""
+    parser = argparse.ArgumentParser(
+        prog='stenographer proxy',
+        description='Run an HTTP forward proxy that records the '
+                    'interactions passing through it in a cassette.',
+        epilog='Point HTTP clients at the proxy, for example with the '
+               'http_proxy environment variable.  HTTPS requests, which '
+               'need CONNECT tunnels, are not supported.  The cassette is '
+               'saved when the proxy is interrupted.')
+    parser.add_argument(
+        'cassette_path', metavar='CASSETTE',
+        help='path to output cassette')
+    parser.add_argument(
+        '-p', '--port', type=int, default=8080,
+        help='port to listen on (default: %(default)s)')
+    parser.add_argument(
+        '--interface', default='127.0.0.1',
+        help='interface to listen on (default: %(default)s)')
+    parser.add_argument(
+        '--per-host', type=int, default=10, metavar='N',
+        help='maximum number of idle connections kept open to any one '
+             'host (default: %(default)s)')
+    parser.add_argument(
+        '--record-mode', choices=RECORD_MODES, default='new_episodes',
+        help='how to treat an existing cassette: replay it and fail on '
+             'new requests (once), add new requests to it '
+             '(new_episodes), or re-record everything (all) (default: '
+             '%(default)s)')
+    args = parser.parse_args(argv)
+    from twisted.internet import reactor
+    pool = HTTPConnectionPool(reactor)
+    pool.maxPersistentPerHost = args.per_host
+    cassette_agent = CassetteAgent(Agent(reactor, pool=pool),
+                                   args.cassette_path, incremental=True,
+                                   record_mode=args.record_mode)
+    port = reactor.listenTCP(args.port, Site(ProxyResource(cassette_agent)),
+                             interface=args.interface)
+    reactor.addSystemEventTrigger('before', 'shutdown', port.stopListening)
+    reactor.addSystemEventTrigger('before', 'shutdown',
+                                  cassette_agent.save_async)
+    reactor.addSystemEventTrigger('before', 'shutdown',
+                                  pool.closeCachedConnections)
+    sys.stderr.write('Recording to {} through proxy at http://{}:{}/\n'.format(
+        args.cassette_path, args.interface, port.getHost().port))
+    reactor.run()
+
+
+def match_criteria(string):
+    """Parse a comma-separated list of request matching criteria."""
+    return tuple(string.split(','))
+
+
+def maintenance_parser(name, description):
+    """Return an argument parser for the maintenance command *name*,
+    with the arguments common to every such command."""
+    parser = argparse.ArgumentParser(
+        prog='stenographer ' + name, description=description,
+        epilog='Directories are searched recursively for cassettes, '
+               'except for directory cassettes.  Cassettes are '
+               'processed in parallel worker processes, and streamed '
+               'rather than loaded whole.')
+    parser.add_argument(
+        'paths', metavar='PATH', nargs='+',
+        help='cassette, or directory of cassettes')
+    parser.add_argument(
+        '-j', '--processes', type=int, metavar='N',
+        help='number of worker processes (default: number of CPUs)')
+    parser.add_argument(
+        '--blob-store', metavar='DIRECTORY',
+        help='blob store directory holding the cassettes\' bodies')
+    parser.add_argument(
+        '--summary', metavar='PATH',
+        help='path to write a JSON summary of the run to')
+    return parser
+
+
+def run_maintenance(args, function, report, **kwargs):
+    """Run the maintenance *function* over the cassettes in *args*,
+    calling *report* with each cassette path and result dict, and
+    return the results.  Exit with an error status if any failed."""
+    def progress(path, result):
+        if 'error' in result:
+            sys.stderr.write('{}: {}\n'.format(path, result['error']))
+        else:
+            report(path, result)
+    blob_store = args.blob_store and BlobStore(args.blob_store)
+    results = maintain(function, args.paths, args.processes, progress,
+                       blob_store=blob_store, **kwargs)
+    if args.summary:
+        with open(args.summary, 'w') as summary_file:
+            json.dump(results, summary_file, indent=2, sort_keys=True)
+    failed = sum(1 for result in results.itervalues() if 'error' in result)
+    sys.stderr.write('{} cassettes, {} failed\n'.format(len(results), failed))
+    if failed:
+        sys.exit(1)
+    return results
+
+
+def report_rewrite(path, result):
+    """Print a summary of a rewritten cassette."""
+    dropped = ''
+    if 'dropped' in result:
+        dropped = ', {} interactions dropped'.format(result['dropped'])
+    sys.stdout.write('{}: {} -> {} bytes{}\n'.format(
+        path, result['before'], result['after'], dropped))
+
+
+#: The fields of `cassette_stats` results, in the order printed by
+#: the stats command.
+STATS_FIELDS = ('interactions', 'cassette_bytes', 'body_bytes',
+                'stored_body_bytes', 'base64_overhead', 'duplicate_bodies',
+                'duplicate_body_bytes')
+
+
+def stats(argv):
+    """Cassette statistics command line entry point."""
+    parser = maintenance_parser(
+        'stats', 'Report interaction counts and body sizes for cassettes.')
+    args = parser.parse_args(argv)
+    def report(path, result):
+        sys.stdout.write('\t'.join(
+            [path] + [str(result[field]) for field in STATS_FIELDS]) + '\n')
+    sys.stdout.write('\t'.join(('cassette',) + STATS_FIELDS) + '\n')
+    results = run_maintenance(args, cassette_stats, report)
+    report('total', {field: sum(result[field] for result in
+                                results.itervalues())
+                     for field in STATS_FIELDS})
+
+
+def compact(argv):
+    """Cassette compaction command line entry point."""
+    parser = maintenance_parser(
+        'compact', 'Rewrite cassettes in place with every body stored in '
+                   'its smallest representation.')
+    run_maintenance(parser.parse_args(argv), compact_cassette,
+                    report_rewrite)
+
+
+def dedupe(argv):
+    """Cassette deduplication command line entry point."""
+    parser = maintenance_parser(
+        'dedupe', 'Rewrite cassettes in place without interactions that '
+                  'repeat an earlier request and response.  Clients that '
+                  'make the same request several times may then run out '
+                  'of interactions for it.')
+    parser.add_argument(
+        '--match-on', type=match_criteria, default=DEFAULT_MATCH_ON,
+        metavar='CRITERION,...',
+        help='request criteria to compare interactions on: method, uri, '
+             'body, or header names (default: {})'.format(
+                 ','.join(DEFAULT_MATCH_ON)))
+    args = parser.parse_args(argv)
+    run_maintenance(args, dedupe_cassette, report_rewrite,
+                    match_on=args.match_on)
+
+
+def prune(argv):
+    """Cassette pruning command line entry point."""
+    parser = maintenance_parser(
+        'prune', 'Rewrite cassettes in place without interactions for '
+                 'URIs that are no longer used.')
+    parser.add_argument(
+        '--keep', metavar='PATH', required=True,
+        help='file listing the URIs to keep interactions for, one per '
+             'line')
+    args = parser.parse_args(argv)
+    with open(args.keep) as keep_file:
+        keep = [line.strip() for line in keep_file if line.strip()]
+    run_maintenance(args, prune_cassette, report_rewrite, keep=keep)
+
+
+def merge(argv):
+    """Cassette merging command line entry point."""
+    parser = argparse.ArgumentParser(
+        prog='stenographer merge',
+        description='Merge the interactions in several cassettes into a '
+                    'new one, in order, streaming them one at a time.')
+    parser.add_argument(
+        'source_paths', metavar='SOURCE', nargs='+',
+        help='path to input cassette')
+    parser.add_argument(
+        'target_path', metavar='TARGET', help='path to output cassette')
+    parser.add_argument(
+        '--binary', action='store_true',
+        help='write a binary cassette instead of a JSON one')
+    parser.add_argument(
+        '--blob-store', metavar='DIRECTORY',
+        help='blob store directory holding the input cassettes\' bodies')
+    args = parser.parse_args(argv)
+    blob_store = args.blob_store and BlobStore(args.blob_store)
+    count = merge_cassettes(args.source_paths, args.target_path,
+                            args.binary, blob_store)
+    sys.stderr.write('{} interactions merged\n'.format(count))
+
+
+@inlineCallbacks
+def refresh_all(refresher, paths, summary_path, pool):
+    """Refresh every cassette in *paths* in turn, report on each, and
+    stop the reactor."""
+    from twisted.internet import reactor
+    results = {}
+    try:
+        for path in find_cassettes(paths):
+            try:
+                results[path] = yield refresher.refresh(path)
+            except Exception as e:  # pylint: disable=broad-except
+                error = '{}: {}'.format(type(e).__name__, e)
+                results[path] = {'error': error}
+                sys.stderr.write('{}: {}\n'.format(path, error))
+                continue
+            sys.stderr.write(
+                '{}: {not_modified} not modified, {changed} changed, '
+                '{failed} failed, {fresh} fresh, {skipped} without '
+                'validators, {body_bytes} body bytes\n'.format(
+                    path, **results[path]))
+        if summary_path:
+            with open(summary_path, 'w') as summary_file:
+                json.dump(results, summary_file, indent=2, sort_keys=True)
+    finally:
+        yield pool.closeCachedConnections()
+        reactor.stop()
+
+
+def refresh(argv):
+    """Cassette refresh command line entry point."""
+    parser = argparse.ArgumentParser(
+        prog='stenographer refresh',
+        description='Refresh stale interactions in cassettes with '
+                    'conditional requests, re-recording only the responses '
+                    'that changed.',
+        epilog='Interactions are revalidated with the ETag and '
+               'Last-Modified headers of their recorded responses.  A 304 '
+               'response only updates the recorded headers and time. '
+               'Directories are searched recursively for cassettes.')
+    parser.add_argument(
+        'paths', metavar='PATH', nargs='+',
+        help='cassette, or directory of cassettes')
+    parser.add_argument(
+        '--max-age', type=float, default=86400, metavar='SECONDS',
+        help='refresh interactions recorded longer ago than this '
+             '(default: %(default)s)')
+    parser.add_argument(
+        '-c', '--concurrency', type=int, default=10, metavar='N',
+        help='maximum number of requests in flight (default: %(default)s)')
+    parser.add_argument(
+        '--per-host', type=int, default=2, metavar='N',
+        help='maximum number of requests in flight to, and idle '
+             'connections kept open to, any one host (default: '
+             '%(default)s)')
+    parser.add_argument(
+        '--unconditional', action='store_true',
+        help='also re-record stale interactions whose responses have no '
+             'validators')
+    parser.add_argument(
+        '--replace-gone', action='store_true',
+        help='replace interactions with 404 and 410 responses, instead '
+             'of counting those as failures')
+    parser.add_argument(
+        '--summary', metavar='PATH',
+        help='path to write a JSON summary of the run to')
+    args = parser.parse_args(argv)
+    from twisted.internet import reactor
+    pool = HTTPConnectionPool(reactor)
+    pool.maxPersistentPerHost = args.per_host
+    refresher = Refresher(Agent(reactor, pool=pool), args.max_age,
+                          args.concurrency, args.per_host, args.unconditional,
+                          args.replace_gone)
+    reactor.callWhenRunning(refresh_all, refresher, args.paths, args.summary,
+                            pool)
+    reactor.run()
+
+
+#: Command line entry points for commands other than recording, keyed
+#: by command name.
+COMMANDS = {'batch': batch, 'compact': compact, 'convert': convert,
+            'dedupe': dedupe, 'merge': merge, 'proxy': proxy,
+            'prune': prune, 'refresh': refresh, 'serve': serve,
+            'stats': stats}
+
+
+def main():
+    """Main command line entry point."""
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        COMMANDS[sys.argv[1]](sys.argv[2:])
+    else:
+        record(sys.argv[1:])
+
+
 if __name__ == '__main__':
     main()
@@ -1,77 +1,456 @@
 """Custom Twisted Web Agents."""
 
 
+from collections import defaultdict
 import errno
 import json
+from urlparse import urlparse
+import zlib
 
-from twisted.internet.defer import succeed, inlineCallbacks, returnValue
+from twisted.internet.defer import (DeferredList, fail, inlineCallbacks,
+                                    returnValue, succeed)
+from twisted.internet.task import deferLater
+from twisted.internet.threads import deferToThread
+from twisted.python import log
 
-from .cassette import Cassette
-from .proxy import RecordingBodyProducer, RecordingResponse, IsolatingResponse
+from .cassette import (DEFAULT_MATCH_ON, Cassette, Interaction,
+                       interaction_as_dict, normalize_uri)
+from .proxy import (SPOOL_THRESHOLD, RecordingBodyProducer,
+                    RecordingResponse, IsolatingResponse, SavedBodyProducer,
+                    StreamingResponse, read_body_producer)
+from .storage import (add_interactions, add_journal, finalize_journal,
+                      load_cassette, open_journal, save_cassette)
+
+
+#: The supported record modes, named after VCR's.
+RECORD_MODES = ('once', 'new_episodes', 'all')
+
+
+def accepts_gzip(headers):
+    """Return whether the Twisted `Headers` object *headers* includes an
+    ``Accept-Encoding`` header that allows gzip."""
+    if headers is None:
+        return False
+    for value in headers.getRawHeaders('Accept-Encoding', []):
+        for coding in value.split(','):
+            if coding.split(';')[0].strip().lower() == 'gzip':
+                return True
+    return False
+
+
+def save_snapshot(cassette, path, preserve_exact_body_bytes=False):
+    """Serialize the `Cassette` *cassette* and save it to *path*, as
+    `save_cassette` does, then close its body buffers."""
+    save_cassette(cassette.as_dict(preserve_exact_body_bytes), path)
+    cassette.close()
+
+
+def add_snapshot(cassette, path, preserve_exact_body_bytes=False,
+                 replace_on=None, blob_store=None):
+    """Serialize the interactions in the `Cassette` *cassette* and add
+    them to the cassette at *path*, as `add_interactions` does, then
+    close its body buffers."""
+    lines = [json.dumps(interaction) for interaction in
+             cassette.as_dict(preserve_exact_body_bytes)['http_interactions']]
+    add_interactions(path, lines, replace_on, blob_store)
+    cassette.close()
 
 
 class CassetteAgent(object):
     """A Twisted Web `Agent` that reconstructs a `Response` object from
-    a recorded HTTP response in JSON-serialized VCR cassette format, or
-    records a new cassette if none exists."""
+    a recorded HTTP response in JSON-serialized VCR cassette format (or
+    Stenographer's binary format), or records a new cassette if none
+    exists.
+
+    If a cassette exists, *record_mode* decides what happens to requests
+    it has no unplayed interaction for.  In ``once`` mode, they fail.
+    In ``new_episodes`` mode, they are made for real and recorded, and
+    `save` appends only the new interactions to the cassette, without
+    parsing it if it is uncompressed JSON.  In ``all`` mode, nothing is
+    replayed, and `save` replaces any saved interactions matching
+    recorded ones.
+
+    Recorded requests are matched against new ones on the criteria in
+    *match_on*, as described in `request_key`.  If *lazy* is true,
+    saved responses are only built when they are first replayed.
+
+    If *cassette_path* is a directory, or ends in a path separator, the
+    cassette is stored as a directory cassette: an index of requests,
+    plus a file for each interaction that is only read when it is
+    replayed if *lazy* is true.
+
+    If *incremental* is true, each recorded interaction is written to a
+    journal next to the cassette path (or, for a directory cassette, to
+    its own file) as soon as its response body has been delivered,
+    instead of being kept in memory until `save`.
+    Recorded bodies larger than *spool_threshold* bytes are spilled to
+    temporary files while recording, which are closed once they have
+    been saved.  Interactions recorded after `save` are added to the
+    end of the cassette by the next one.  If *blob_store* is given, bodies
+    are saved to and loaded from that `BlobStore`.  If *cache* is given,
+    the cassette is loaded through that `CassetteCache`.
+
+    Recorded interactions include the time taken until their response
+    headers and the last byte of their bodies arrived, according to the
+    `IReactorTime` provider *clock* (by default, the global reactor).
+    When replaying, these delays are multiplied by *time_scale* and
+    reproduced on *clock*; the default of 0 replays instantly, and 1
+    in real time.  If *chunk_size* is given, replayed bodies are
+    delivered in chunks of that many bytes with flow control, as
+    described in `StreamingResponse`.
 
-    def __init__(self, agent, cassette_path, preserve_exact_body_bytes=False):
+    If *metrics* is given, cassette loads and saves, replay lookups,
+    and recorded responses are reported to that `Metrics` object.
+
+    If *body_cache* is given, saved gzip-encoded responses to requests
+    that accept gzip, like those made through a `ContentDecoderAgent`,
+    are replayed already decoded, with their decoded bodies kept in that
+    `DecodedBodyCache`.  Their ``Content-Encoding`` headers are removed,
+    so a wrapping `ContentDecoderAgent` leaves them alone, and their
+    recorded bytes remain available from `SavedResponse.raw_value`."""
+
+    def __init__(self, agent, cassette_path, preserve_exact_body_bytes=False,
+                 match_on=DEFAULT_MATCH_ON, lazy=False, incremental=False,
+                 spool_threshold=SPOOL_THRESHOLD, blob_store=None,
+                 cache=None, chunk_size=None, clock=None, time_scale=0,
+                 metrics=None, record_mode='once', body_cache=None):
+        if record_mode not in RECORD_MODES:
+            raise ValueError('unknown record mode {!r}'.format(record_mode))
+        if clock is None:
+            from twisted.internet import reactor as clock
         self.agent = agent
         self.recording = True
+        self.record_mode = record_mode
         self.cassette_path = cassette_path
         self.preserve_exact_body_bytes = preserve_exact_body_bytes
-        self.index = 0
+        self.spool_threshold = spool_threshold
+        self.chunk_size = chunk_size
+        self.clock = clock
+        self.time_scale = time_scale
+        self.metrics = metrics
+        self.body_cache = body_cache
+        #: Whether any interactions have been recorded since this agent
+        #: was created or last saved.
+        self.changed = False
+        #: The number of interactions replayed so far for each request
+        #: fingerprint.
+        self.played = defaultdict(int)
+        #: The `JournalWriter` or `DirectoryWriter` for recorded
+        #: interactions, if recording incrementally.
+        self.journal = None
+        load = load_cassette if cache is None else cache.load
+        if metrics is not None:
+            started = metrics.timer()
         try:
-            with open(self.cassette_path) as cassette_file:
-                self.cassette = Cassette.from_dict(json.load(cassette_file))
-        except IOError as e:
+            self.cassette = load(self.cassette_path, match_on, lazy,
+                                 blob_store, metrics)
+        except EnvironmentError as e:
             if e.errno != errno.ENOENT:
                 raise
-            self.cassette = Cassette()
+            self.cassette = Cassette(match_on, blob_store)
         else:
             self.recording = False
+            if metrics is not None:
+                metrics.emit('load', path=cassette_path,
+                             interactions=len(self.cassette),
+                             seconds=metrics.timer() - started)
+        #: The `Cassette` holding interactions recorded in memory.  For
+        #: a new cassette, this is the same as `cassette`.
+        self.recorded = self.cassette
+        if not self.recording:
+            self.recorded = Cassette(match_on, blob_store)
+        #: Whether recorded interactions are journaled as they finish,
+        #: rather than kept in memory.
+        self.incremental = incremental and (self.recording or
+                                            record_mode != 'once')
+        if self.incremental:
+            self.journal = open_journal(cassette_path)
 
     @inlineCallbacks
     def request(self, method, uri, headers=None, bodyProducer=None):
         """Replay a recorded HTTP request, or make and record an actual
-        request if no recording exists."""
-        if not self.recording:
+        request if no recording exists or the record mode allows it."""
+        if self.recording or self.record_mode == 'all':
+            response = yield self.record_request(
+                method, uri, headers, bodyProducer)
+        elif self.record_mode == 'once':
             response = yield self.replay_request(
                 method, uri, headers, bodyProducer)
-            returnValue(response)
+        else:
+            body = None
+            if bodyProducer is not None and 'body' in self.cassette.match_on:
+                body = yield read_body_producer(bodyProducer)
+                bodyProducer = SavedBodyProducer(body)
+            saved = self._find(method, uri, headers, body)
+            if saved is None:
+                response = yield self.record_request(
+                    method, uri, headers, bodyProducer)
+            else:
+                response = yield self._play(saved)
+        returnValue(response)
+
+    @inlineCallbacks
+    def record_request(self, method, uri, headers=None, bodyProducer=None):
+        """Make an actual HTTP request, and record its interaction."""
         if bodyProducer is not None:
-            bodyProducer = RecordingBodyProducer(bodyProducer)
+            bodyProducer = RecordingBodyProducer(bodyProducer,
+                                                 self.spool_threshold)
+        started = self.clock.seconds()
         real_response = yield self.agent.request(
             method, uri, headers, bodyProducer)
-        response = RecordingResponse(real_response)
-        self.cassette.responses.append(response)
+        response = RecordingResponse(real_response, self.spool_threshold,
+                                     self.clock, started)
+        self.changed = True
+        # Only record responses whose bodies were received in full.  A
+        # client whose body delivery failed has already been told so.
+        finished = response.notifyFinish()
+        finished.addCallback(self._record)
+        if self.metrics is not None:
+            finished.addCallback(self._emit_record, uri)
+        finished.addErrback(self._record_failed, response, uri)
         # We have to do this because ContentDecoderAgent mutates the
         # response headers.  I don't like it, but them's the breaks.
         returnValue(IsolatingResponse(response))
 
+    @inlineCallbacks
     def replay_request(self, method, uri, headers=None, bodyProducer=None):
-        """Replay a recorded HTTP request.  Raise `IOError` if the
-        recorded request does not match the one being made, like VCR's
-        ``once`` record mode."""
-        try:
-            response = self.cassette[self.index]
-        except IndexError:
+        """Replay a recorded HTTP request.  Raise `IOError` if no unplayed
+        recorded request matches the one being made, like VCR's ``once``
+        record mode.  Identical requests are replayed in the order in
+        which they were recorded."""
+        body = None
+        if bodyProducer is not None and 'body' in self.cassette.match_on:
+            body = yield read_body_producer(bodyProducer)
+        saved = self._find(method, uri, headers, body)
+        if saved is None:
             raise IOError('no more saved interactions for current {} '
                           'request for {}'.format(method, uri))
-        self.index += 1
-        if not (method == response.request.method and
-                uri == response.request.absoluteURI):
-            raise IOError(
-                'current {} request for {} differs from saved {} '
-                'request for {}'.format(method, uri,
-                                        response.request.method,
-                                        response.request.absoluteURI))
-        return succeed(response)
+        response = yield self._play(saved)
+        returnValue(response)
+
+    def _find(self, method, uri, headers, body):
+        """Return the next unplayed saved response to a request with the
+        given attributes, or `None` if there is none."""
+        if self.metrics is not None:
+            started = self.metrics.timer()
+        key = self.cassette.request_key(method, uri, headers, body)
+        try:
+            position = self.cassette.index[key][self.played[key]]
+        except LookupError:
+            if self.metrics is not None:
+                self.metrics.emit('replay.mismatch', method=method, uri=uri,
+                                  seconds=self.metrics.timer() - started)
+            return None
+        self.played[key] += 1
+        if self.metrics is not None:
+            self.metrics.emit('replay.match', method=method, uri=uri,
+                              seconds=self.metrics.timer() - started)
+        if self.body_cache is not None and accepts_gzip(headers):
+            record = self.cassette.record(position)
+            if isinstance(record, Interaction) and record.is_gzip_encoded():
+                try:
+                    return record.response(
+                        self.body_cache.decode(record.response_body))
+                except zlib.error:
+                    pass  # leave it to the caller to fail to decode
+        return self.cassette[position]
+
+    @inlineCallbacks
+    def _play(self, response):
+        """Return a `Deferred` that fires with the saved *response* after
+        its scaled recorded delay, streamed if necessary."""
+        duration = 0
+        if self.time_scale and response.time_to_headers is not None:
+            yield deferLater(self.clock,
+                             response.time_to_headers * self.time_scale,
+                             lambda: None)
+            duration = ((response.time_to_last_byte -
+                         response.time_to_headers) * self.time_scale)
+        if self.chunk_size is not None or duration:
+            response = StreamingResponse(
+                response, self.chunk_size or max(1, len(response.value())),
+                self.clock, duration)
+        returnValue(response)
+
+    def _record(self, response):
+        if not self.incremental:
+            self.recorded.append(response)
+            return response
+        if self.journal is None:
+            self.journal = open_journal(self.cassette_path)
+        self.journal.write(interaction_as_dict(
+            response, self.preserve_exact_body_bytes, spooled=True,
+            blob_store=self.cassette.blob_store))
+        response.close()
+        return response
+
+    @staticmethod
+    def _record_failed(failure, response, uri):
+        if failure is not response.failure:
+            log.err(failure, 'Failed to record response for {}'.format(uri))
+
+    def _emit_record(self, response, uri):
+        self.metrics.emit('record', uri=uri, bytes=len(response.buffer()),
+                          seconds=response.time_to_last_byte)
+
+    def _snapshot(self):
+        """Return a tuple of a function and its arguments that write
+        the interactions recorded so far to this agent's cassette path
+        without touching the agent, or `None` if there is nothing to
+        write.  Only references to the interactions are taken here; they
+        are serialized by the function, which may run in a thread."""
+        match_on = self.cassette.match_on
+        blob_store = self.cassette.blob_store
+        recorded = self.recorded
+        journal, self.journal = self.journal, None
+        if journal is not None:
+            journal.close()
+        if self.recording and recorded is self.cassette:
+            # Interactions recorded from now on are added to the end of
+            # the cassette saved here by later saves.
+            self.cassette = Cassette(match_on, blob_store)
+            self.recorded = Cassette(match_on, blob_store)
+            if journal is not None:
+                return finalize_journal, (journal.path, self.cassette_path)
+            return save_snapshot, (recorded, self.cassette_path,
+                                   self.preserve_exact_body_bytes)
+        replace_on = None
+        if not self.recording:
+            if self.record_mode == 'once':
+                return None
+            if self.record_mode == 'all':
+                replace_on = match_on
+        if journal is not None:
+            return add_journal, (journal.path, self.cassette_path,
+                                 replace_on, blob_store)
+        if not recorded:
+            return None
+        self.recorded = Cassette(match_on, blob_store)
+        return add_snapshot, (recorded, self.cassette_path,
+                              self.preserve_exact_body_bytes, replace_on,
+                              blob_store)
+
+    def _emit_save(self, result, started):
+        self.metrics.emit('save', path=self.cassette_path,
+                          seconds=self.metrics.timer() - started)
+        return result
 
     def save(self, deferred_result=None):
-        """Record interactions in this agent's cassette path."""
-        if self.recording:
-            with open(self.cassette_path, 'w') as cassette_file:
-                dct = self.cassette.as_dict(self.preserve_exact_body_bytes)
-                json.dump(dct, cassette_file)
+        """Record interactions in this agent's cassette path, compressing
+        them if it ends in ``.gz``, ``.bz2``, or ``.xz``.  The cassette is
+        written to a temporary file and moved into place atomically.
+        When recording incrementally, this finalizes the journal, and a
+        new one is started for any interactions recorded afterwards."""
+        if self.metrics is not None:
+            started = self.metrics.timer()
+        snapshot = self._snapshot()
+        self.changed = False
+        if snapshot is not None:
+            function, args = snapshot
+            function(*args)
+            if self.metrics is not None:
+                self._emit_save(None, started)
         return deferred_result
+
+    def save_async(self, deferred_result=None):
+        """Like `save`, but serialize and write the cassette in a thread,
+        so that the reactor is not blocked.  The interactions recorded so
+        far are snapshotted immediately.  Return a `Deferred` that fires
+        with *deferred_result* once the cassette has been written."""
+        if self.metrics is not None:
+            started = self.metrics.timer()
+        snapshot = self._snapshot()
+        self.changed = False
+        if snapshot is None:
+            return succeed(deferred_result)
+        function, args = snapshot
+        finished = deferToThread(function, *args)
+        if self.metrics is not None:
+            finished.addCallback(self._emit_save, started)
+        finished.addCallback(lambda _: deferred_result)
+        return finished
+
+
+class RoutingAgent(object):
+    """A Twisted Web `Agent` that sends each request to one of several
+    `CassetteAgent` instances, chosen by the request URI.
+
+    *routes* maps either host names or URI prefixes, like
+    ``https://example.com/api/``, to cassette paths.  The longest
+    matching URI prefix wins, followed by a route for the request's
+    host, and then *default_path* if it is given.  Requests that match
+    no route fail with `IOError`.
+
+    Each cassette agent is only created, and its cassette loaded, when
+    the first request that needs it is made.  It wraps *agent*, and is
+    passed any other keyword arguments, such as *record_mode* or
+    *cache*.  Routes that share a cassette path share an agent."""
+
+    def __init__(self, agent, routes, default_path=None, **kwargs):
+        self.agent = agent
+        self.default_path = default_path
+        self.kwargs = kwargs
+        #: A list of ``(prefix, cassette_path)`` tuples for URI prefix
+        #: routes, longest prefix first.
+        self.prefixes = []
+        #: A dict mapping lowercased host names to cassette paths.
+        self.hosts = {}
+        for pattern, cassette_path in routes.iteritems():
+            if '://' in pattern:
+                self.prefixes.append((normalize_uri(pattern), cassette_path))
+            else:
+                self.hosts[pattern.lower()] = cassette_path
+        self.prefixes.sort(key=lambda route: len(route[0]), reverse=True)
+        #: The `CassetteAgent` created for each cassette path so far.
+        self.agents = {}
+
+    def route(self, uri):
+        """Return the path of the cassette that requests for *uri* are
+        sent to, or `None` if there is none."""
+        normalized = normalize_uri(uri)
+        for prefix, cassette_path in self.prefixes:
+            if normalized.startswith(prefix):
+                return cassette_path
+        return self.hosts.get(urlparse(normalized).hostname,
+                              self.default_path)
+
+    def cassette_agent(self, cassette_path):
+        """Return the `CassetteAgent` for *cassette_path*, creating it
+        if this is the first time it is needed."""
+        if cassette_path not in self.agents:
+            self.agents[cassette_path] = CassetteAgent(
+                self.agent, cassette_path, **self.kwargs)
+        return self.agents[cassette_path]
+
+    def request(self, method, uri, headers=None, bodyProducer=None):
+        """Send a request to the cassette agent routed to for *uri*."""
+        cassette_path = self.route(uri)
+        if cassette_path is None:
+            return fail(IOError('no cassette route for {} request for '
+                                '{}'.format(method, uri)))
+        return self.cassette_agent(cassette_path).request(
+            method, uri, headers, bodyProducer)
+
+    def changed(self):
+        """Return a list of the cassette agents that have recorded
+        interactions since they were created or last saved."""
+        return [cassette_agent for _, cassette_agent in
+                sorted(self.agents.iteritems()) if cassette_agent.changed]
+
+    def save(self, deferred_result=None):
+        """Save every cassette with newly recorded interactions, as
+        `CassetteAgent.save` does, leaving the others untouched."""
+        for cassette_agent in self.changed():
+            cassette_agent.save()
+        return deferred_result
+
+    def save_async(self, deferred_result=None):
+        """Like `save`, but save each cassette in a thread, as
+        `CassetteAgent.save_async` does.  Return a `Deferred` that fires
+        with *deferred_result* once every cassette has been written."""
+        finished = DeferredList(
+            [cassette_agent.save_async() for cassette_agent in self.changed()],
+            fireOnOneErrback=True, consumeErrors=True)
+        finished.addCallbacks(lambda _: deferred_result,
+                              lambda failure: failure.value.subFailure)
+        return finished
@@ -0,0 +1,178 @@
+"""Parallel recording of many cassettes from a manifest.
+
+A manifest is a JSON object mapping cassette paths, relative to the
+manifest's own directory, to lists of the URIs to record in them."""
+# -*- test-case-name: stenographer.test.test_batch
+
+
+import json
+from multiprocessing.pool import ThreadPool
+import os
+import subprocess
+import sys
+import time
+
+from twisted.internet.defer import DeferredList, inlineCallbacks, returnValue
+from twisted.python.failure import Failure
+from twisted.web.client import (Agent, ContentDecoderAgent, GzipDecoder,
+                                HTTPConnectionPool, RedirectAgent)
+
+from .agent import CassetteAgent
+from .recorder import Recorder
+from .storage import JOURNAL_SUFFIX
+
+
+#: The suffix appended to a cassette path to name the file it is
+#: recorded into before being moved into place.
+RECORDING_SUFFIX = '.recording'
+
+
+def plan_jobs(manifest_path, force=False):
+    """Read the manifest at *manifest_path*, and return a tuple of a
+    list of ``(cassette_path, uris)`` jobs to record and a list of the
+    cassette paths that can be skipped.  Unless *force* is true, a
+    cassette is skipped if it was written after the manifest last
+    changed."""
+    with open(manifest_path) as manifest_file:
+        manifest = json.load(manifest_file)
+    manifest_mtime = os.path.getmtime(manifest_path)
+    base = os.path.dirname(os.path.abspath(manifest_path))
+    jobs = []
+    skipped = []
+    for cassette_path, uris in sorted(manifest.iteritems()):
+        cassette_path = os.path.join(base, cassette_path)
+        if (not force and os.path.exists(cassette_path) and
+                os.path.getmtime(cassette_path) >= manifest_mtime):
+            skipped.append(cassette_path)
+        else:
+            jobs.append((cassette_path, [uri.encode('utf-8') for uri in uris]))
+    return jobs, skipped
+
+
+@inlineCallbacks
+def record_job(reactor, pool, cassette_path, uris, concurrency, per_host):
+    """Record *uris* into *cassette_path*, and return a tuple of the
+    path and a summary dict.  The cassette is only moved into place if
+    every URI succeeded."""
+    started = reactor.seconds()
+    recording_path = cassette_path + RECORDING_SUFFIX
+    summary = {'status': 'failed'}
+    try:
+        for path in (recording_path, recording_path + JOURNAL_SUFFIX):
+            if os.path.exists(path):
+                os.remove(path)
+        cassette_agent = CassetteAgent(Agent(reactor, pool=pool),
+                                       recording_path, incremental=True)
+        agent = ContentDecoderAgent(
+            RedirectAgent(cassette_agent), [('gzip', GzipDecoder)])
+        recorder = Recorder(agent, concurrency, per_host, reactor)
+        yield recorder.fetch_all(uris)
+        yield cassette_agent.save_async()
+        summary['completed'] = recorder.completed
+        summary['failures'] = [
+            {'uri': uri, 'error': failure.getErrorMessage()}
+            for uri, failure in recorder.failures]
+        if recorder.failures:
+            os.remove(recording_path)
+        else:
+            os.rename(recording_path, cassette_path)
+            summary['status'] = 'recorded'
+    except Exception:  # pylint: disable=broad-except
+        summary['error'] = Failure().getErrorMessage()
+    summary['seconds'] = reactor.seconds() - started
+    returnValue((cassette_path, summary))
+
+
+def record_jobs(args):
+    """Record every job in a ``(jobs, concurrency, per_host)`` tuple
+    concurrently, running a reactor in the current process, and return
+    a list of ``(cassette_path, summary)`` tuples.
+
+    Since a reactor can only be run once, this is meant to be called in
+    a fresh worker process."""
+    from twisted.internet import reactor
+    jobs, concurrency, per_host = args
+    pool = HTTPConnectionPool(reactor)
+    pool.maxPersistentPerHost = per_host
+    finished = DeferredList([
+        record_job(reactor, pool, cassette_path, uris, concurrency, per_host)
+        for cassette_path, uris in jobs])
+    results = []
+    @inlineCallbacks
+    def stop(job_results):
+        results.extend(result for _, result in job_results)
+        yield pool.closeCachedConnections()
+        reactor.stop()
+    finished.addCallback(stop)
+    reactor.run()
+    return results
+
+
+def run_worker(args):
+    """Call `record_jobs` with the ``(jobs, concurrency, per_host)``
+    tuple *args* in a new Python interpreter, and return its results.
+    If the interpreter fails, every job in *args* is reported as having
+    failed with its exit status."""
+    # Forked processes would inherit the reactor that importing Twisted
+    # Web installs in this one, so workers are fresh interpreters.
+    package_path = os.path.dirname(os.path.dirname(os.path.abspath(
+        __file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        filter(None, [package_path, os.environ.get('PYTHONPATH')])))
+    worker = subprocess.Popen(
+        [sys.executable, '-m', 'stenographer.batch'], env=env,
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, close_fds=True)
+    output, _ = worker.communicate(json.dumps(args))
+    if worker.returncode:
+        error = 'worker exited with status {}'.format(worker.returncode)
+        return [(cassette_path, {'status': 'failed', 'error': error})
+                for cassette_path, _ in args[0]]
+    return [(cassette_path.encode('utf-8'), summary)
+            for cassette_path, summary in json.loads(output)]
+
+
+def record_manifest(manifest_path, processes=None, batch_size=8,
+                    concurrency=10, per_host=2, force=False,
+                    progress=None):
+    """Record the cassettes in the manifest at *manifest_path* that are
+    not up to date, spreading them over *processes* worker processes
+    (by default, one per CPU) in batches of *batch_size* cassettes.
+    Each cassette is recorded with the given *concurrency* and
+    *per_host* limits.  If given, *progress* is called with each
+    ``(cassette_path, summary)`` tuple as it becomes available.
+
+    Return a summary dict, keyed by cassette path."""
+    started = time.time()
+    jobs, skipped = plan_jobs(manifest_path, force)
+    summary = {'cassettes': {path: {'status': 'skipped'}
+                             for path in skipped}}
+    batches = [(jobs[i:i + batch_size], concurrency, per_host)
+               for i in xrange(0, len(jobs), batch_size)]
+    # Each worker process runs its own reactor, and reactors can't be
+    # restarted, so every batch gets a new process.
+    workers = ThreadPool(processes)
+    try:
+        for results in workers.imap_unordered(run_worker, batches):
+            for cassette_path, cassette_summary in results:
+                summary['cassettes'][cassette_path] = cassette_summary
+                if progress is not None:
+                    progress(cassette_path, cassette_summary)
+    finally:
+        workers.close()
+        workers.join()
+    summary['seconds'] = time.time() - started
+    return summary
+
+
+def main():
+    """Record the batch read from standard input as JSON, as
+    `run_worker` sends it, and write the results to standard output."""
+    jobs, concurrency, per_host = json.load(sys.stdin)
+    jobs = [(cassette_path.encode('utf-8'),
+             [uri.encode('utf-8') for uri in uris])
+            for cassette_path, uris in jobs]
+    json.dump(record_jobs((jobs, concurrency, per_host)), sys.stdout)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""A compact binary cassette format.
+
+A binary cassette starts with `MAGIC`, followed by the length of a JSON
+header as an unsigned 64-bit big-endian integer, the header itself, and
+the raw bytes of every recorded body.  The header is a VCR cassette
+dict whose body dicts give the offset and length of each body within
+the body section, instead of an encoded copy of it, so that readers can
+memory-map the file and copy each body out of it only when it is
+needed."""
+# -*- test-case-name: stenographer.test.test_binary
+
+
+import json
+import mmap
+from shutil import copyfileobj
+from struct import Struct
+from tempfile import TemporaryFile
+
+from .cassette import body_from_dict
+
+
+#: The bytes every binary cassette starts with.
+MAGIC = 'STENOBIN'
+
+HEADER_LENGTH = Struct('>Q')
+
+
+def read_binary(cassette_file):
+    """Read a binary cassette from *cassette_file*, positioned just
+    after its magic number.  Return a tuple of the header dict and a
+    read-only buffer over the memory-mapped body section.  The body
+    section is only paged in as it is used, but slicing the buffer
+    returns a byte string, so each body read from it is copied.  If
+    *cassette_file* is not a plain file, and so can't be mapped, the
+    body section is read into memory instead."""
+    length, = HEADER_LENGTH.unpack(cassette_file.read(HEADER_LENGTH.size))
+    dct = json.loads(cassette_file.read(length))
+    if not isinstance(cassette_file, file):
+        return dct, cassette_file.read()
+    mapped = mmap.mmap(cassette_file.fileno(), 0, access=mmap.ACCESS_READ)
+    return dct, buffer(mapped, len(MAGIC) + HEADER_LENGTH.size + length)
+
+
+def write_binary(dct, cassette_file, blob_store=None, data=None):
+    """Write the VCR cassette dict *dct* to *cassette_file* in binary
+    format, copying in any bodies stored in *blob_store* or the binary
+    cassette data *data*."""
+    header = dict(dct, http_interactions=[])
+    offset = 0
+    with TemporaryFile() as bodies:
+        for interaction in dct['http_interactions']:
+            interaction = dict(interaction)
+            for part in ('request', 'response'):
+                rr = interaction[part] = dict(interaction[part])
+                original = rr['body']
+                string = body_from_dict(rr, blob_store, data)
+                rr['body'] = {'encoding': original.get('encoding', 'utf-8'),
+                              'slice': [offset, len(string)]}
+                # Remember which bodies weren't stored as text, so that
+                # they can be converted back the same way.
+                if ('base64_string' in original or 'blob' in original or
+                        original.get('base64')):
+                    rr['body']['base64'] = True
+                bodies.write(string)
+                offset += len(string)
+            header['http_interactions'].append(interaction)
+        encoded = json.dumps(header)
+        cassette_file.write(MAGIC)
+        cassette_file.write(HEADER_LENGTH.pack(len(encoded)))
+        cassette_file.write(encoded)
+        bodies.seek(0)
+        copyfileobj(bodies, cassette_file)
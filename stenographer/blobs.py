@@ -0,0 +1,76 @@
+"""Content-addressed storage for recorded bodies."""
+# -*- test-case-name: stenographer.test.test_blobs
+
+
+from collections import OrderedDict
+import errno
+from hashlib import sha256
+import os
+
+from .proxy import SpooledBuffer
+from .storage import make_temp_file
+
+
+class BlobStore(object):
+    """A directory of body byte strings, each written once under the
+    SHA-256 digest of its contents, that can be shared by any number of
+    cassettes.  Blobs are cached in memory once read, so interactions
+    that reference the same body share a single copy of it.  The least
+    recently read blobs are evicted from the cache once their total
+    size exceeds *max_cache_bytes*."""
+
+    def __init__(self, path, max_cache_bytes=64 * 1024 * 1024):
+        self.path = path
+        self.max_cache_bytes = max_cache_bytes
+        self._cache = OrderedDict()
+        self._cache_size = 0
+
+    def blob_path(self, digest):
+        """Return the path of the blob with the given hex *digest*."""
+        return os.path.join(self.path, digest[:2], digest[2:])
+
+    def put(self, data):
+        """Store *data*, a byte string or `SpooledBuffer`, if it is not
+        already present, and return its hex digest."""
+        chunks = data.slices() if isinstance(data, SpooledBuffer) else [data]
+        try:
+            os.makedirs(self.path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        # Write to a temporary file first, since we don't know the
+        # digest until we've seen all of the data.
+        hasher = sha256()
+        temp_path = make_temp_file(self.path)
+        with open(temp_path, 'wb') as temp:
+            for chunk in chunks:
+                hasher.update(chunk)
+                temp.write(chunk)
+        digest = hasher.hexdigest()
+        path = self.blob_path(digest)
+        if os.path.exists(path):
+            os.remove(temp_path)
+            return digest
+        try:
+            os.mkdir(os.path.dirname(path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        os.rename(temp_path, path)
+        return digest
+
+    def get(self, digest):
+        """Return the byte string stored under the hex *digest*."""
+        try:
+            data = self._cache.pop(digest)
+        except KeyError:
+            with open(self.blob_path(digest), 'rb') as blob_file:
+                data = blob_file.read()
+            if len(data) > self.max_cache_bytes:
+                return data
+            self._cache_size += len(data)
+        self._cache[digest] = data
+        while self._cache_size > self.max_cache_bytes:
+            _, evicted = self._cache.popitem(last=False)
+            self._cache_size -= len(evicted)
+        return data
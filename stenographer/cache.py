@@ -0,0 +1,140 @@
+"""Process-wide caches of loaded cassettes and decoded bodies."""
+# -*- test-case-name: stenographer.test.test_cache
+
+
+from collections import OrderedDict
+import os
+import zlib
+
+from .cassette import DEFAULT_MATCH_ON
+from .storage import load_cassette
+
+
+class CassetteCache(object):
+    """A least-recently-used cache of loaded cassettes, keyed by their
+    resolved paths, modification times, sizes, and match criteria.
+
+    The cache holds at most *max_entries* cassettes, and evicts the
+    least recently used ones once the total size of their files exceeds
+    *max_bytes*.  Each load returns a fresh `Cassette.copy` of the cached
+    cassette, so that callers share its `Interaction` records but build
+    their own responses.  Records are built in the cached cassette the
+    first time it is loaded without *lazy*.
+
+    Sizes are only estimated from file sizes.  A cached cassette holds
+    the parsed VCR dicts of its unbuilt interactions and the records of
+    its built ones, including their decoded bodies, so it may take
+    several times its file size in memory, or more if its bodies are
+    kept in a blob store."""
+
+    def __init__(self, max_entries=64, max_bytes=256 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def load(self, path, match_on=DEFAULT_MATCH_ON, lazy=False,
+             blob_store=None, metrics=None):
+        """Return the cassette at *path*, as `load_cassette` would,
+        loading it from disk only if it isn't already cached."""
+        status = os.stat(path)
+        real_path = os.path.realpath(path)
+        key = (real_path, status.st_mtime, status.st_size, tuple(match_on))
+        try:
+            template, size = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            template = load_cassette(path, match_on, True, blob_store,
+                                     metrics)
+            size = status.st_size
+            self.discard(real_path)
+            self.size += size
+        else:
+            self.hits += 1
+        self.entries[key] = (template, size)
+        while len(self.entries) > 1 and (len(self.entries) > self.max_entries
+                                         or self.size > self.max_bytes):
+            self._evict(next(iter(self.entries)))
+            self.evictions += 1
+        if not lazy:
+            template.materialize()
+        return template.copy(blob_store)
+
+    def _evict(self, key):
+        self.size -= self.entries.pop(key)[1]
+
+    def discard(self, path):
+        """Remove any cached versions of the cassette at *path*."""
+        real_path = os.path.realpath(path)
+        for key in [key for key in self.entries if key[0] == real_path]:
+            self._evict(key)
+
+    def clear(self):
+        """Remove all cached cassettes."""
+        self.entries.clear()
+        self.size = 0
+
+    def stats(self):
+        """Return a dict of this cache's hit, miss, and eviction counts,
+        and its current number of entries and size in bytes."""
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'entries': len(self.entries),
+                'size': self.size}
+
+
+#: A `CassetteCache` that can be shared by an entire process.
+shared_cache = CassetteCache()
+
+
+class DecodedBodyCache(object):
+    """A least-recently-used cache of decompressed gzip-encoded bodies,
+    keyed by the encoded bodies themselves, so that a response replayed
+    many times is only inflated once.
+
+    The cache holds at most *max_entries* bodies, and evicts the least
+    recently used ones once their total decoded size exceeds
+    *max_bytes*."""
+
+    def __init__(self, max_entries=1024, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def decode(self, body):
+        """Return the gzip-encoded byte string *body*, decompressed.
+        Raise `zlib.error` if it isn't valid gzip data."""
+        # Byte strings cache their hashes, so looking up the same saved
+        # body again doesn't rehash it.
+        try:
+            decoded = self.entries.pop(body)
+        except KeyError:
+            self.misses += 1
+            decoded = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+            self.size += len(decoded)
+        else:
+            self.hits += 1
+        self.entries[body] = decoded
+        while len(self.entries) > 1 and (len(self.entries) > self.max_entries
+                                         or self.size > self.max_bytes):
+            self.size -= len(self.entries.pop(next(iter(self.entries))))
+            self.evictions += 1
+        return decoded
+
+    def clear(self):
+        """Remove all cached bodies."""
+        self.entries.clear()
+        self.size = 0
+
+    def stats(self):
+        """Return a dict of this cache's hit, miss, and eviction counts,
+        and its current number of entries and decoded size in bytes."""
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'entries': len(self.entries),
+                'size': self.size}
@@ -4,84 +4,423 @@
 
 from collections import Sequence
 from base64 import b64encode, b64decode
-from email.utils import formatdate
+from calendar import timegm
+from email.utils import formatdate, mktime_tz, parsedate_tz
+from hashlib import sha1
+import json
+import os.path
+import re
 from urlparse import urlparse, urlunparse
 
 from twisted.web.client import URI
 from twisted.web.http_headers import Headers
 from twisted.web.iweb import UNKNOWN_LENGTH
 from twisted.web._newclient import Request, Response
-from twisted.web.test.test_agent import AbortableStringTransport
 
-from .proxy import SavedBodyProducer, SavedResponse
+from .proxy import (ReplayTransport, SavedBodyProducer, SavedResponse,
+                    SpooledBuffer)
 from .__version__ import __version__
 
 
-def body_from_dict(dct):
+#: The request criteria used for matching by default.
+DEFAULT_MATCH_ON = ('method', 'uri')
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+#: An ISO 8601 date and time, as Betamax writes ``recorded_at``.
+ISO_DATETIME = re.compile(
+    r'(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d):(\d\d)(?:\.\d*)?'
+    r'(?:(Z)|([+-])(\d\d):?(\d\d))?$')
+
+
+def parse_recorded_at(string):
+    """Return the POSIX timestamp of the ``recorded_at`` date *string*,
+    in RFC 2822 format as VCR writes it or ISO 8601 format as Betamax
+    does, or `None` if it can't be parsed.  ISO 8601 times without a
+    time zone are taken to be in UTC."""
+    parsed = parsedate_tz(string)
+    if parsed is not None:
+        return mktime_tz(parsed)
+    match = ISO_DATETIME.match(string.strip())
+    if match is None:
+        return None
+    fields = match.groups()
+    timestamp = timegm([int(field) for field in fields[:6]])
+    if fields[7] is not None:
+        offset = int(fields[8]) * 3600 + int(fields[9]) * 60
+        timestamp -= offset if fields[7] == '+' else -offset
+    return timestamp
+
+
+def body_from_dict(dct, blob_store=None, data=None):
     """Decode and return a body string from a VCR request or response
-    dict."""
+    dict, looking it up in *blob_store* or the binary cassette data
+    *data* if it is stored there."""
     body = dct['body']
+    if 'slice' in body:
+        offset, length = body['slice']
+        return data[offset:offset + length]
+    if 'blob' in body:
+        if blob_store is None:
+            raise ValueError('body is in a blob store, but none was given')
+        return blob_store.get(body['blob'])
     if 'base64_string' in body:
         return b64decode(body['base64_string'])
     return body['string'].encode(body['encoding'])
 
 
-def body_as_dict(string, headers=None, preserve_exact_body_bytes=False):
+def body_as_dict(string, headers=None, preserve_exact_body_bytes=False,
+                 blob_store=None):
     """Encode a body string into a VCR body dict and return it,
-    according to the given HTTP headers."""
+    according to the given HTTP headers.  If *string* is a
+    `SpooledBuffer`, it is stored in the dict as is, to be encoded by
+    the cassette writer.  If *blob_store* is given, non-empty bodies are
+    put there, and the dict only refers to their digests."""
     body = {'encoding': 'utf-8'}
+    if blob_store is not None and len(string):
+        body['blob'] = blob_store.put(string)
+        return body
     gzip_encoded = (
         headers and 'gzip' in headers.getRawHeaders('Content-Encoding', []))
     if preserve_exact_body_bytes or gzip_encoded:
-        body['base64_string'] = b64encode(string)
+        if not isinstance(string, SpooledBuffer):
+            string = b64encode(string)
+        body['base64_string'] = string
     else:
         body['string'] = string
     return body
 
 
+def inline_interaction(interaction, data):
+    """Return a copy of the VCR interaction dict *interaction* with any
+    bodies stored in the binary cassette data *data* moved inline."""
+    interaction = dict(interaction)
+    for part in ('request', 'response'):
+        dct = interaction[part] = dict(interaction[part])
+        body = dct['body']
+        if 'slice' in body:
+            string = body_from_dict(dct, data=data)
+            dct['body'] = {'encoding': body['encoding']}
+            if body.get('base64'):
+                dct['body']['base64_string'] = b64encode(string)
+            else:
+                dct['body']['string'] = string.decode(body['encoding'])
+    return interaction
+
+
+def headers_from_dict(dct):
+    """Decode a VCR header dict into a Twisted `Headers` object that
+    shares no mutable state with it."""
+    return Headers({k: list(v) for k, v in dct.iteritems()})
+
+
 def headers_as_dict(headers):
     """Encode a Twisted `Headers` object into a VCR header dict."""
     return {k: v for k, v in headers.getAllRawHeaders()}
 
 
+def normalize_uri(uri):
+    """Return *uri* with its scheme and host lowercased, any default
+    port removed, and any fragment dropped."""
+    parsed = urlparse(uri)
+    scheme = parsed.scheme.lower()
+    netloc = parsed.netloc.rpartition('@')
+    host = netloc[2].lower()
+    if parsed.port is not None and parsed.port == DEFAULT_PORTS.get(scheme):
+        host = host.rpartition(':')[0]
+    return urlunparse((scheme, netloc[0] + netloc[1] + host) +
+                      parsed[2:5] + ('',))
+
+
+def request_key(method, uri, headers=None, body=None,
+                match_on=DEFAULT_MATCH_ON):
+    """Return a hashable fingerprint of an HTTP request, built from the
+    criteria in *match_on*.  ``method``, ``uri``, and ``body`` stand for
+    the request method, normalized URI, and a digest of the body.  Any
+    other criterion is taken as the name of a request header."""
+    key = []
+    for criterion in match_on:
+        if criterion == 'method':
+            key.append(method)
+        elif criterion == 'uri':
+            key.append(normalize_uri(uri))
+        elif criterion == 'body':
+            key.append(sha1(body or '').hexdigest())
+        elif headers is None:
+            key.append(())
+        else:
+            key.append(tuple(headers.getRawHeaders(criterion, ())))
+    return tuple(key)
+
+
+def interaction_as_dict(response, preserve_exact_body_bytes=False,
+                        spooled=False, blob_store=None):
+    """Return a VCR interaction dict recording *response* and the
+    request that produced it.  If *spooled* is true, the bodies of
+    recorded requests and responses are left in their `SpooledBuffer`
+    objects instead of being read into memory.  If *blob_store* is
+    given, bodies are stored there as described in `body_as_dict`."""
+    def body(obj):
+        return obj.buffer() if spooled else obj.value()
+    # `Response._construct` wraps the original request in a proxy for
+    # `IClientRequest`, so we have to fish it out.
+    request = response.request.original
+    if request.bodyProducer is None:
+        request_body = {'encoding': 'utf-8', 'string': ''}
+    else:
+        request_body = body_as_dict(
+            body(request.bodyProducer), request.headers,
+            preserve_exact_body_bytes, blob_store)
+    # Twisted also eats any "Content-Length" header provided to us, so
+    # we have to reconstruct it if it's present.
+    if response.length is not UNKNOWN_LENGTH:
+        response.headers.setRawHeaders('Content-Length', [response.length])
+    interaction = {
+        'request': {
+            'method': request.method,
+            'uri': request.absoluteURI,
+            'body': request_body,
+            'headers': headers_as_dict(request.headers)},
+        'response': {
+            'http_version': '1.1',  # only one Twisted Web supports
+            'status': {'code': response.code, 'message': response.phrase},
+            'body': body_as_dict(body(response), response.headers,
+                                 preserve_exact_body_bytes, blob_store),
+            'headers': headers_as_dict(response.headers)}}
+    if response.started is not None:
+        interaction['recorded_at'] = formatdate(response.started)
+    if response.time_to_headers is not None:
+        interaction['timings'] = {
+            'time_to_headers': response.time_to_headers,
+            'time_to_last_byte': response.time_to_last_byte}
+    return interaction
+
+
+class Interaction(object):
+    """A compact record of a saved HTTP interaction, from which a fresh
+    `SavedResponse` is built each time it is replayed.  Headers are kept
+    as VCR header dicts, and bodies as byte strings."""
+
+    __slots__ = ('method', 'uri', 'request_headers', 'request_body',
+                 'code', 'phrase', 'response_headers', 'response_body',
+                 'started', 'time_to_headers', 'time_to_last_byte')
+
+    def __init__(self, method, uri, request_headers, request_body, code,
+                 phrase, response_headers, response_body, started=None,
+                 time_to_headers=None, time_to_last_byte=None):
+        self.method = method
+        self.uri = uri
+        self.request_headers = request_headers
+        self.request_body = request_body
+        self.code = code
+        self.phrase = phrase
+        self.response_headers = response_headers
+        self.response_body = response_body
+        self.started = started
+        self.time_to_headers = time_to_headers
+        self.time_to_last_byte = time_to_last_byte
+
+    @classmethod
+    def from_dict(cls, interaction, blob_store=None, data=None):
+        """Create a new record from the VCR interaction dict
+        *interaction*, whose bodies may be stored in *blob_store* or the
+        binary cassette data *data*."""
+        rq = interaction['request']
+        rp = interaction['response']
+        started = None
+        if 'recorded_at' in interaction:
+            started = parse_recorded_at(interaction['recorded_at'])
+        timings = interaction.get('timings', {})
+        return cls(rq['method'], rq['uri'], rq['headers'],
+                   body_from_dict(rq, blob_store, data),
+                   rp['status']['code'], rp['status']['message'],
+                   rp['headers'], body_from_dict(rp, blob_store, data),
+                   started, timings.get('time_to_headers'),
+                   timings.get('time_to_last_byte'))
+
+    def response(self, decoded_body=None):
+        """Return a new `SavedResponse` replaying this interaction.  If
+        *decoded_body* is given, it is replayed instead of the saved
+        body, as if it had never been content-encoded: without a
+        ``Content-Encoding`` header, and with a matching
+        ``Content-Length``.  The saved body is still available from the
+        response's `SavedResponse.raw_value`."""
+        # Overwrite the scheme and netloc, leaving just the part of the
+        # URI that would be sent in a real request.
+        relative_uri = urlunparse(('', '') + urlparse(self.uri)[2:])
+        request = Request._construct(
+            self.method, relative_uri, headers_from_dict(self.request_headers),
+            SavedBodyProducer(self.request_body), False,
+            URI.fromBytes(self.uri.encode('utf-8')))
+        response = Response._construct(
+            ('HTTP', 1, 1), self.code, self.phrase,
+            headers_from_dict(self.response_headers), ReplayTransport(),
+            request)
+        body, raw = self.response_body, None
+        if decoded_body is not None:
+            body, raw = decoded_body, self.response_body
+            response.headers.removeHeader('Content-Encoding')
+            response.headers.setRawHeaders('Content-Length',
+                                           [str(len(body))])
+        content_length = response.headers.getRawHeaders('Content-Length')
+        if content_length:
+            try:
+                response.length = int(content_length[0])
+            except ValueError:
+                pass
+        return SavedResponse(response, body, self.started,
+                             self.time_to_headers, self.time_to_last_byte,
+                             raw)
+
+    def is_gzip_encoded(self):
+        """Return whether this interaction's saved response body is
+        gzip-encoded, according to its ``Content-Encoding`` header."""
+        for name, values in self.response_headers.iteritems():
+            if name.lower() == 'content-encoding':
+                return 'gzip' in values
+        return False
+
+
+def response_from_dict(interaction, blob_store=None, data=None):
+    """Create a new `SavedResponse` from the VCR interaction dict
+    *interaction*, whose bodies may be stored in *blob_store* or the
+    binary cassette data *data*."""
+    return Interaction.from_dict(interaction, blob_store, data).response()
+
+
 class Cassette(Sequence):
-    """A container for recorded HTTP interactions."""
+    """A container for recorded HTTP interactions.  Bodies may be kept
+    in a shared `BlobStore` given as *blob_store*, or in the memory-mapped
+    body section *data* of a binary cassette."""
 
-    def __init__(self):
-        #: A list of `RecordingResponse` objects resulting from
-        #: recorded interactions.
+    def __init__(self, match_on=DEFAULT_MATCH_ON, blob_store=None,
+                 data=None):
+        #: A list of `RecordingResponse` objects resulting from recorded
+        #: interactions, `Interaction` records of saved interactions, or
+        #: `None` for saved interactions that have not been materialized
+        #: yet.
         self.responses = []
+        #: A list of raw VCR interaction dicts backing the unmaterialized
+        #: entries in `responses`, or `None` for the others.
+        self.interactions = []
+        #: The request criteria used to build this cassette's index.
+        self.match_on = tuple(match_on)
+        #: A mapping from request fingerprints to the positions of the
+        #: matching interactions, in recorded order.
+        self.index = {}
+        self.blob_store = blob_store
+        self.data = data
 
     @classmethod
-    def from_dict(cls, dct):
+    def from_dict(cls, dct, match_on=DEFAULT_MATCH_ON, lazy=False,
+                  blob_store=None, data=None):
         """Create a new cassette from *dct*, as deserialized from JSON
-        or YAML format."""
-        cassette = cls()
+        or YAML format.  If *lazy* is true, only index the interactions
+        in *dct*, and build their records the first time they are
+        retrieved."""
+        cassette = cls(match_on, blob_store, data)
         for interaction in dct['http_interactions']:
-            rq = interaction['request']
-            # Overwrite the scheme and netloc, leaving just the part of
-            # the URI that would be sent in a real request.
-            relative_uri = urlunparse(('', '') + urlparse(rq['uri'])[2:])
-            request = Request._construct(
-                rq['method'], relative_uri, Headers(rq['headers']),
-                SavedBodyProducer(body_from_dict(rq)),
-                False, URI.fromBytes(rq['uri'].encode('utf-8')))
-            rp = interaction['response']
-            response = Response._construct(
-                ('HTTP', 1, 1), rp['status']['code'], rp['status']['message'],
-                Headers(rp['headers']), AbortableStringTransport(), request)
-            content_length = response.headers.getRawHeaders('Content-Length')
-            if content_length:
-                try:
-                    response.length = int(content_length[0])
-                except ValueError:
-                    pass
-            cassette.responses.append(
-                SavedResponse(response, body_from_dict(rp)))
+            cassette.append_dict(interaction)
+        if not lazy:
+            cassette.materialize()
+        return cassette
+
+    def copy(self, blob_store=None):
+        """Return a new cassette sharing this one's `Interaction`
+        records, unbuilt interactions, and body data, but none of its
+        recorded responses.  Bodies of interactions that have not been
+        built yet are looked up in *blob_store*, if given, instead of
+        this cassette's blob store."""
+        cassette = type(self)(self.match_on, blob_store or self.blob_store,
+                              self.data)
+        # Records are never modified once built, and each response
+        # replayed from one gets its own headers, so they can be shared.
+        cassette.responses = [
+            response if isinstance(response, Interaction) else None
+            for response in self.responses]
+        cassette.interactions = list(self.interactions)
+        cassette.index = {k: list(v) for k, v in self.index.iteritems()}
         return cassette
 
+    def close(self):
+        """Close the body buffers of the recorded interactions in this
+        cassette.  They can no longer be serialized afterwards."""
+        for response in self.responses:
+            if response is not None and not isinstance(response,
+                                                       Interaction):
+                response.close()
+
+    def materialize(self):
+        """Build the records for all of this cassette's interactions."""
+        for index in xrange(len(self)):
+            self.record(index)
+
     def __getitem__(self, index):
-        return self.responses[index]
+        """Return the response for the interaction at *index*: either the
+        `RecordingResponse` it was recorded from, or a new `SavedResponse`
+        built from its record."""
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(len(self)))]
+        response = self.record(index)
+        if isinstance(response, Interaction):
+            return response.response()
+        return response
+
+    def record(self, index):
+        """Return the `Interaction` record of the saved interaction at
+        *index*, building it if necessary, or the `RecordingResponse` of
+        a recorded one."""
+        response = self.responses[index]
+        if response is None:
+            response = Interaction.from_dict(self._interaction(index),
+                                             self.blob_store, self.data)
+            self.responses[index] = response
+            self.interactions[index] = None
+        return response
+
+    def _interaction(self, index):
+        """Return the raw VCR interaction dict at *index*."""
+        return self.interactions[index]
+
+    def request_key(self, method, uri, headers=None, body=None):
+        """Return the fingerprint this cassette uses to match a request
+        with the given attributes."""
+        return request_key(method, uri, headers, body, self.match_on)
+
+    def response_key(self, response):
+        """Return the fingerprint of the request that produced
+        *response*."""
+        request = response.request.original
+        body = None
+        if request.bodyProducer is not None:
+            body = request.bodyProducer.value()
+        return self.request_key(request.method, request.absoluteURI,
+                                request.headers, body)
+
+    def interaction_key(self, interaction):
+        """Return the fingerprint of the request in the VCR interaction
+        dict *interaction*."""
+        rq = interaction['request']
+        headers = body = None
+        if set(self.match_on) - set(('method', 'uri', 'body')):
+            headers = Headers(rq['headers'])
+        if 'body' in self.match_on:
+            body = body_from_dict(rq, self.blob_store, self.data)
+        return self.request_key(rq['method'], rq['uri'], headers, body)
+
+    def _add(self, key, response, interaction):
+        self.index.setdefault(key, []).append(len(self.responses))
+        self.responses.append(response)
+        self.interactions.append(interaction)
+
+    def append(self, response):
+        """Add *response* to the end of this cassette and index it."""
+        self._add(self.response_key(response), response, None)
+
+    def append_dict(self, interaction):
+        """Add the VCR interaction dict *interaction* to the end of this
+        cassette and index it, without building its response."""
+        self._add(self.interaction_key(interaction), None, interaction)
 
     def __len__(self):
         return len(self.responses)
@@ -90,34 +429,37 @@ class Cassette(Sequence):
         """Return a dictionary representation of this cassette, suitable
         for serializing in JSON or YAML format."""
         http_interactions = []
-        for response in self.responses:
-            # `Response._construct` wraps the original request in a
-            # proxy for `IClientRequest`, so we have to fish it out.
-            request = response.request.original
-            if request.bodyProducer is None:
-                request_body = {'encoding': 'utf-8', 'string': ''}
+        for index, response in enumerate(self.responses):
+            if response is None:
+                interaction = self._interaction(index)
+                if self.data is not None:
+                    interaction = inline_interaction(interaction, self.data)
+                http_interactions.append(interaction)
             else:
-                request_body = body_as_dict(
-                    request.bodyProducer.value(), request.headers,
-                    preserve_exact_body_bytes)
-            # Twisted also eats any "Content-Length" header provided to
-            # us, so we have to reconstruct it if it's present.
-            if response.length is not UNKNOWN_LENGTH:
-                response.headers.setRawHeaders('Content-Length',
-                                               [response.length])
-            http_interactions.append({
-                'request': {
-                    'method': request.method,
-                    'uri': request.absoluteURI,
-                    'body': request_body,
-                    'headers': headers_as_dict(request.headers)},
-                'response': {
-                    'http_version': '1.1',  # only one Twisted Web supports
-                    'status': {'code': response.code,
-                               'message': response.phrase},
-                    'body': body_as_dict(response.value(), response.headers,
-                                         preserve_exact_body_bytes),
-                    'headers': headers_as_dict(response.headers)},
-                'recorded_at': formatdate()})
+                http_interactions.append(interaction_as_dict(
+                    self[index], preserve_exact_body_bytes,
+                    blob_store=self.blob_store))
         return {'http_interactions': http_interactions,
                 'recorded_with': 'Stenographer {}'.format(__version__)}
+
+
+class DirectoryCassette(Cassette):
+    """A cassette whose interactions are stored in individual files in a
+    directory cassette at *directory*.  Its raw interaction dicts only
+    hold their requests and the path of the file holding the rest,
+    relative to *directory*, which is read when they are built."""
+
+    def __init__(self, match_on=DEFAULT_MATCH_ON, blob_store=None,
+                 data=None, directory=None):
+        super(DirectoryCassette, self).__init__(match_on, blob_store, data)
+        self.directory = directory
+
+    def copy(self, blob_store=None):
+        cassette = super(DirectoryCassette, self).copy(blob_store)
+        cassette.directory = self.directory
+        return cassette
+
+    def _interaction(self, index):
+        path = os.path.join(self.directory, self.interactions[index]['file'])
+        with open(path, 'rb') as interaction_file:
+            return json.load(interaction_file)
@@ -0,0 +1,251 @@
+"""Bulk maintenance of cassettes on disk.
+
+Every operation here streams its cassettes, as `stream_cassette` does,
+so that they can be arbitrarily large.  Those that change a cassette
+rewrite it atomically in its current format."""
+# -*- test-case-name: stenographer.test.test_maintenance
+
+
+from base64 import b64encode
+from hashlib import sha1
+import json
+from multiprocessing import Pool
+import os
+import time
+
+from .batch import RECORDING_SUFFIX
+from .binary import MAGIC
+from .cassette import (DEFAULT_MATCH_ON, Cassette, body_from_dict,
+                       inline_interaction, normalize_uri)
+from .storage import (COMPRESSION_MAGIC, DIRECTORY_INDEX, JOURNAL_SUFFIX,
+                      save_interactions, stream_cassette)
+
+
+def is_cassette_file(path):
+    """Return whether the file at *path* looks like a cassette, judging
+    by its name and first few bytes."""
+    name = os.path.basename(path)
+    if name.startswith('.') or name.endswith((JOURNAL_SUFFIX,
+                                              RECORDING_SUFFIX)):
+        return False
+    with open(path, 'rb') as cassette_file:
+        head = cassette_file.read(64)
+    return (head.lstrip().startswith('{') or head.startswith(MAGIC) or
+            any(head.startswith(magic) for magic in COMPRESSION_MAGIC))
+
+
+def find_cassettes(paths):
+    """Yield the path of every cassette in *paths*, searching recursively
+    through any directories that aren't directory cassettes themselves.
+    """
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for directory, subdirectories, names in os.walk(path):
+            if DIRECTORY_INDEX in names:
+                del subdirectories[:]
+                yield directory
+                continue
+            subdirectories.sort()
+            for name in sorted(names):
+                name = os.path.join(directory, name)
+                if is_cassette_file(name):
+                    yield name
+
+
+def cassette_size(path):
+    """Return the number of bytes taken up on disk by the cassette at
+    *path*, counting every file of a directory cassette."""
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(directory, name))
+               for directory, _, names in os.walk(path) for name in names)
+
+
+def body_sizes(dct, blob_store=None, data=None):
+    """Return a tuple of the decoded body of a VCR request or response
+    dict *dct*, the number of bytes its body dict stores inline, and
+    how many of those are Base64 overhead."""
+    body = dct['body']
+    string = body_from_dict(dct, blob_store, data)
+    if 'base64_string' in body:
+        stored = len(body['base64_string'])
+        return string, stored, stored - len(string)
+    if 'string' in body:
+        return string, len(json.dumps(body['string'])) - 2, 0
+    return string, 0, 0
+
+
+def cassette_stats(path, blob_store=None):
+    """Return a dict of statistics about the cassette at *path*: its
+    size on disk in ``cassette_bytes``, its number of
+    ``interactions``, the decoded size of their request and
+    response bodies in ``body_bytes``, the size of the encoded bodies
+    held in the cassette itself in ``stored_body_bytes``, how much of
+    that is ``base64_overhead``, and the number of non-empty bodies
+    identical to an earlier one in ``duplicate_bodies``, with their size
+    in ``duplicate_body_bytes``."""
+    stats = dict.fromkeys(('interactions', 'body_bytes', 'stored_body_bytes',
+                           'base64_overhead', 'duplicate_bodies',
+                           'duplicate_body_bytes'), 0)
+    stats['cassette_bytes'] = cassette_size(path)
+    seen = set()
+    interactions, data = stream_cassette(path)
+    for interaction in interactions:
+        stats['interactions'] += 1
+        for part in ('request', 'response'):
+            string, stored, overhead = body_sizes(
+                interaction[part], blob_store, data)
+            stats['body_bytes'] += len(string)
+            stats['stored_body_bytes'] += stored
+            stats['base64_overhead'] += overhead
+            if not string:
+                continue
+            digest = sha1(string).digest()
+            if digest in seen:
+                stats['duplicate_bodies'] += 1
+                stats['duplicate_body_bytes'] += len(string)
+            seen.add(digest)
+    return stats
+
+
+def compact_body(dct):
+    """Return the smallest body dict that decodes to the same bytes as
+    the body of the VCR request or response dict *dct*.  Bodies stored
+    in a blob store or a binary cassette's body section are left alone.
+    """
+    body = dct['body']
+    if 'string' not in body and 'base64_string' not in body:
+        return body
+    string = body_from_dict(dct)
+    encoded = b64encode(string)
+    try:
+        text = string.decode('utf-8')
+    except UnicodeDecodeError:
+        return {'encoding': 'utf-8', 'base64_string': encoded}
+    if len(json.dumps(text)) <= len(encoded) + 2:
+        return {'encoding': 'utf-8', 'string': text}
+    return {'encoding': 'utf-8', 'base64_string': encoded}
+
+
+def rewrite_cassette(path, transform, blob_store=None):
+    """Atomically rewrite the cassette at *path* in its current format
+    with the interactions returned by *transform*, which is called with
+    an iterator over the cassette's VCR interaction dicts and its binary
+    cassette data (or `None`), and may return any iterable.  Return a
+    dict of the cassette's size in bytes ``before`` and ``after``."""
+    before = cassette_size(path)
+    interactions, data = stream_cassette(path)
+    save_interactions(transform(interactions, data), path,
+                      data is not None, data, blob_store)
+    return {'before': before, 'after': cassette_size(path)}
+
+
+def compact_cassette(path, blob_store=None):
+    """Rewrite the cassette at *path* with every body stored in its
+    smallest representation, as returned by `compact_body`."""
+    def transform(interactions, _):
+        for interaction in interactions:
+            for part in ('request', 'response'):
+                interaction[part]['body'] = compact_body(interaction[part])
+            yield interaction
+    return rewrite_cassette(path, transform, blob_store)
+
+
+def dedupe_cassette(path, match_on=DEFAULT_MATCH_ON, blob_store=None):
+    """Rewrite the cassette at *path* without any interaction whose
+    request matches an earlier one's on the criteria in *match_on*, and
+    whose response has the same status code and body.  Other response
+    headers, like ``Date``, are ignored.
+
+    Since identical requests are replayed in order, clients that make
+    the same request several times may run out of saved interactions
+    for it afterwards."""
+    summary = {'dropped': 0}
+    def transform(interactions, data):
+        cassette = Cassette(match_on, blob_store, data)
+        seen = set()
+        for interaction in interactions:
+            response = interaction['response']
+            key = (cassette.interaction_key(interaction),
+                   response['status']['code'],
+                   sha1(body_from_dict(response, blob_store, data)).digest())
+            if key in seen:
+                summary['dropped'] += 1
+                continue
+            seen.add(key)
+            yield interaction
+    summary.update(rewrite_cassette(path, transform, blob_store))
+    return summary
+
+
+def prune_cassette(path, keep, blob_store=None):
+    """Rewrite the cassette at *path* without any interaction whose
+    request URI, once normalized, is not in the collection of URIs
+    *keep*."""
+    keep = set(normalize_uri(uri) for uri in keep)
+    summary = {'dropped': 0}
+    def transform(interactions, _):
+        for interaction in interactions:
+            if normalize_uri(interaction['request']['uri']) in keep:
+                yield interaction
+            else:
+                summary['dropped'] += 1
+    summary.update(rewrite_cassette(path, transform, blob_store))
+    return summary
+
+
+def merge_cassettes(source_paths, target_path, binary=False,
+                    blob_store=None):
+    """Write every interaction in the cassettes at *source_paths*, in
+    order, to a new cassette at *target_path*, in binary format if
+    *binary* is true.  Return the number of interactions written."""
+    count = [0]
+    def interactions():
+        for source_path in source_paths:
+            source, data = stream_cassette(source_path)
+            for interaction in source:
+                count[0] += 1
+                if data is None:
+                    yield interaction
+                else:
+                    yield inline_interaction(interaction, data)
+    save_interactions(interactions(), target_path, binary,
+                      blob_store=blob_store)
+    return count[0]
+
+
+def run_job(job):
+    """Call the function in a ``(function, path, kwargs)`` tuple with
+    the path and keyword arguments, and return a tuple of the path and
+    its result, or an ``error`` dict if it raised an exception."""
+    function, path, kwargs = job
+    started = time.time()
+    try:
+        result = function(path, **kwargs)
+    except Exception as e:  # pylint: disable=broad-except
+        result = {'error': '{}: {}'.format(type(e).__name__, e)}
+    if isinstance(result, dict):
+        result['seconds'] = time.time() - started
+    return path, result
+
+
+def maintain(function, paths, processes=None, progress=None, **kwargs):
+    """Call *function* with the path of every cassette found in *paths*
+    by `find_cassettes`, plus *kwargs*, spread over *processes* worker
+    processes (by default, one per CPU).  If given, *progress* is
+    called with each ``(cassette_path, result)`` tuple as it becomes
+    available.  Return a dict of results keyed by cassette path."""
+    jobs = ((function, path, kwargs) for path in find_cassettes(paths))
+    results = {}
+    workers = Pool(processes)
+    try:
+        for path, result in workers.imap_unordered(run_job, jobs):
+            results[path] = result
+            if progress is not None:
+                progress(path, result)
+    finally:
+        workers.close()
+        workers.join()
+    return results
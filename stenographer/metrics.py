@@ -0,0 +1,89 @@
+"""Instrumentation of cassette loading, replaying, and recording."""
+# -*- test-case-name: stenographer.test.test_metrics
+
+
+from collections import defaultdict
+import time
+
+try:
+    from twisted.logger import Logger
+except ImportError:  # Twisted < 15.2
+    Logger = None
+
+
+class Metrics(object):
+    """Keeps running counters of instrumentation events, and passes each
+    event to any registered observers.
+
+    An event is a dict with at least an ``event`` key naming it, and
+    optionally ``seconds`` and ``bytes`` keys giving its duration and
+    size.  The events emitted by Stenographer are:
+
+    ``load``
+        A cassette was loaded into a `CassetteAgent`, with its ``path``,
+        number of ``interactions``, and load duration.
+    ``parse``
+        A cassette file at ``path`` was read and parsed from disk, not
+        including building its interactions.
+    ``replay.match`` and ``replay.mismatch``
+        A request for ``uri`` was looked up in a cassette, with the
+        duration of the lookup.
+    ``record``
+        A response from ``uri`` was recorded, with its body size and
+        the time taken to receive it.
+    ``save``
+        A cassette was saved to ``path``, with its duration.
+
+    Durations are measured with *timer*, which defaults to
+    `time.time`."""
+
+    def __init__(self, timer=time.time):
+        self.timer = timer
+        self.observers = []
+        self.counters = defaultdict(int)
+
+    def add_observer(self, observer):
+        """Call *observer* with every subsequent event dict."""
+        self.observers.append(observer)
+
+    def remove_observer(self, observer):
+        """Stop calling *observer* with events."""
+        self.observers.remove(observer)
+
+    def emit(self, event, **fields):
+        """Count an event named *event* with the given *fields*, and
+        pass it to every observer."""
+        fields['event'] = event
+        self.counters[event] += 1
+        for field in ('seconds', 'bytes'):
+            if fields.get(field) is not None:
+                self.counters['{}.{}'.format(event, field)] += fields[field]
+        for observer in self.observers:
+            observer(fields)
+
+    def stats(self):
+        """Return a dict of this object's counters.  For each event name,
+        it holds the number of times the event was emitted and, where
+        available, the total ``seconds`` and ``bytes`` reported with it,
+        under keys like ``replay.match.seconds``."""
+        return dict(self.counters)
+
+    def reset(self):
+        """Reset all counters to zero."""
+        self.counters.clear()
+
+
+def logger_observer(logger=None):
+    """Return an observer that emits events as debug messages to the
+    `twisted.logger.Logger` *logger*, or a new one by default."""
+    if logger is None:
+        if Logger is None:
+            raise RuntimeError('twisted.logger requires Twisted 15.2')
+        logger = Logger(namespace='stenographer')
+    def observer(event):
+        logger.debug('{event}', **event)
+    return observer
+
+
+#: A `Metrics` instance that can be shared by an entire process.
+shared_metrics = Metrics()
@@ -3,20 +3,125 @@
 
 
 from io import BytesIO
+import mmap
+from tempfile import SpooledTemporaryFile
 
-from twisted.internet.interfaces import IConsumer, IProtocol
+from twisted.internet.defer import Deferred, fail, succeed
+from twisted.internet.error import ConnectionLost
+from twisted.internet.interfaces import IConsumer, IProtocol, IPushProducer
 from twisted.python.components import proxyForInterface
-from twisted.web.client import FileBodyProducer
+from twisted.python.failure import Failure
+from twisted.web.client import ResponseDone
+from twisted.web.http import PotentialDataLoss
 from twisted.web.iweb import IBodyProducer, IResponse
+from twisted.web._newclient import ResponseFailed
+from zope.interface import implementer
+
+
+#: The default number of recorded body bytes kept in memory before
+#: they are spilled to a temporary file.
+SPOOL_THRESHOLD = 1024 * 1024
+
+#: The default size of the chunks read by `SpooledBuffer.chunks`.
+CHUNK_SIZE = 64 * 1024
+
+
+class SpooledBuffer(object):
+    """An append-only byte buffer that is kept in memory until it grows
+    past *threshold* bytes, and in a temporary file after that."""
+
+    def __init__(self, threshold=SPOOL_THRESHOLD):
+        self.threshold = threshold
+        self.length = 0
+        self.file = SpooledTemporaryFile(max_size=threshold)
+
+    def __len__(self):
+        return self.length
+
+    def write(self, data):
+        """Append the byte string *data* to this buffer."""
+        self.file.seek(0, 2)
+        self.file.write(data)
+        self.length += len(data)
+
+    def value(self):
+        """Return a byte string containing this buffer's contents."""
+        self.file.seek(0)
+        return self.file.read()
+
+    def view(self):
+        """Return a read-only object supporting `len` and slicing that
+        exposes this buffer's contents.  Once the buffer has spilled to
+        disk, this is an `mmap` of the temporary file, so nothing is
+        read into memory until it is sliced; it should be closed after
+        use."""
+        if self.length <= self.threshold:
+            return self.value()
+        self.file.flush()
+        return mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def slices(self, size=CHUNK_SIZE):
+        """Yield read-only `buffer` objects over this buffer's contents,
+        at most *size* bytes each, taken from its `view` without copying
+        them."""
+        view = self.view()
+        try:
+            for offset in xrange(0, len(view), size):
+                yield buffer(view, offset, size)
+        finally:
+            if isinstance(view, mmap.mmap):
+                view.close()
+
+    def chunks(self, size=CHUNK_SIZE):
+        """Yield this buffer's contents as byte strings of at most
+        *size* bytes."""
+        self.file.seek(0)
+        while True:
+            chunk = self.file.read(size)
+            if not chunk:
+                return
+            yield chunk
+
+    def close(self):
+        """Discard this buffer's contents, closing its temporary file.
+        Its length is still available afterwards."""
+        self.file.close()
+
+
+@implementer(IConsumer)
+class BufferingConsumer(object):
+    """An `IConsumer` implementation that keeps any consumed data."""
+
+    def __init__(self):
+        self.io = BytesIO()
+
+    def registerProducer(self, producer, streaming):
+        """See `IConsumer.registerProducer`."""
+
+    def unregisterProducer(self):
+        """See `IConsumer.unregisterProducer`."""
+
+    def write(self, data):
+        """See `IConsumer.write`."""
+        self.io.write(data)
+
+
+def read_body_producer(producer):
+    """Return a `Deferred` that fires with the bytes produced by the
+    `IBodyProducer` *producer*."""
+    consumer = BufferingConsumer()
+    finished = producer.startProducing(consumer)
+    finished.addCallback(lambda _: consumer.io.getvalue())
+    return finished
 
 
 class RecordingConsumer(proxyForInterface(IConsumer)):
     """An `IConsumer` implementation that wraps another, recording any
-    consumed data."""
+    consumed data in a `SpooledBuffer`."""
 
-    def __init__(self, original):
+    def __init__(self, original, threshold=SPOOL_THRESHOLD):
         self.original = original
-        self.io = BytesIO()
+        self.io = SpooledBuffer(threshold)
 
     def write(self, data):
         """See `IConsumer.write`."""
@@ -28,54 +133,128 @@ class RecordingBodyProducer(proxyForInterface(IBodyProducer)):
     """An `IBodyProducer` implementation that wraps another, recording
     any bytes produced to its consumer."""
 
-    def __init__(self, original):
+    def __init__(self, original, threshold=SPOOL_THRESHOLD):
         self.original = original
+        self.threshold = threshold
         self.consumer = None
 
     def startProducing(self, consumer):
         """See `IBodyProducer.startProducing`."""
-        self.consumer = RecordingConsumer(consumer)
+        self.consumer = RecordingConsumer(consumer, self.threshold)
         return self.original.startProducing(self.consumer)
 
-    def value(self):
-        """Return a byte string containing any bytes produced."""
+    def buffer(self):
+        """Return the `SpooledBuffer` holding any bytes produced."""
         if self.consumer is None:
             raise ValueError('no consumer started yet')
-        return self.consumer.io.getvalue()
+        return self.consumer.io
+
+    def value(self):
+        """Return a byte string containing any bytes produced."""
+        return self.buffer().value()
 
 
 class RecordingProtocol(proxyForInterface(IProtocol)):
     """An `IProtocol` implementation that wraps another, recording any
-    received data."""
+    received data in a `SpooledBuffer`."""
 
-    def __init__(self, original):
+    def __init__(self, original, threshold=SPOOL_THRESHOLD):
         self.original = original
-        self.io = BytesIO()
+        self.io = SpooledBuffer(threshold)
+        #: A `Deferred` that fires when the whole body has been received,
+        #: or fails with the reason the connection was lost before then.
+        self.finished = Deferred()
 
     def dataReceived(self, data):
         """See `IProtocol.dataReceived`."""
         self.io.write(data)
         self.original.dataReceived(data)
 
+    def connectionLost(self, reason):
+        """See `IProtocol.connectionLost`."""
+        if reason.check(ResponseDone, PotentialDataLoss):
+            self.finished.callback(None)
+        else:
+            self.finished.errback(reason)
+        self.original.connectionLost(reason)
+
 
 class RecordingResponse(proxyForInterface(IResponse)):
     """An `IResponse` implementation that records body bytes delivered
-    to its protocol by wrapping it in `RecordingProtocol`."""
+    to its protocol by wrapping it in `RecordingProtocol`.
 
-    def __init__(self, original):
+    If an `IReactorTime` provider *clock* is given, along with the time
+    *started* at which the request was made, the time taken until the
+    response's headers and the last byte of its body arrived are
+    recorded as well."""
+
+    def __init__(self, original, threshold=SPOOL_THRESHOLD, clock=None,
+                 started=None):
         self.original = original
+        self.threshold = threshold
         self.protocol = None
+        self._waiting = []
+        #: The `Failure` that cut delivery of the body short, if any.
+        self.failure = None
+        self.clock = clock
+        self.started = started
+        self.time_to_headers = self.time_to_last_byte = None
+        if clock is not None:
+            self.time_to_headers = clock.seconds() - started
 
     def deliverBody(self, protocol):
         """See `IResponse.deliverBody`."""
-        self.protocol = RecordingProtocol(protocol)
+        self.protocol = RecordingProtocol(protocol, self.threshold)
+        self.protocol.finished.addCallbacks(self._notify_finish,
+                                            self._notify_finish)
         self.original.deliverBody(self.protocol)
 
-    def value(self):
-        """Return a byte string containing the delivered body bytes."""
+    def _notify_finish(self, result):
+        if isinstance(result, Failure):
+            self.failure = result
+        elif self.clock is not None:
+            self.time_to_last_byte = self.clock.seconds() - self.started
+        waiting, self._waiting = self._waiting, None
+        for deferred in waiting:
+            if self.failure is None:
+                deferred.callback(self)
+            else:
+                deferred.errback(self.failure)
+
+    def notifyFinish(self):
+        """Return a `Deferred` that fires with this response once its
+        body has been completely delivered, or fails with the reason its
+        delivery was cut short.  It never fires if the body is never
+        delivered."""
+        if self._waiting is None:
+            if self.failure is not None:
+                return fail(self.failure)
+            return succeed(self)
+        deferred = Deferred()
+        self._waiting.append(deferred)
+        return deferred
+
+    def buffer(self):
+        """Return the `SpooledBuffer` holding the delivered body bytes."""
         if self.protocol is None:
             raise ValueError('response body not yet delivered')
-        return self.protocol.io.getvalue()
+        return self.protocol.io
+
+    def value(self):
+        """Return a byte string containing the delivered body bytes."""
+        return self.buffer().value()
+
+    def close(self):
+        """Close the `SpooledBuffer` objects holding the recorded body
+        bytes of this response and of the request that produced it."""
+        if self.protocol is not None:
+            self.protocol.io.close()
+        if self.request is None:
+            return
+        producer = self.request.original.bodyProducer
+        if (isinstance(producer, RecordingBodyProducer) and
+                producer.consumer is not None):
+            producer.buffer().close()
 
 
 class IsolatingResponse(proxyForInterface(IResponse)):
@@ -92,27 +271,162 @@ class IsolatingResponse(proxyForInterface(IResponse)):
         return self._headers
 
 
-class SavedBodyProducer(FileBodyProducer):
-    """An `IBodyProducer` that returns a predetermined byte string."""
+@implementer(IBodyProducer)
+class SavedBodyProducer(object):
+    """An `IBodyProducer` that writes a predetermined byte string to its
+    consumer all at once."""
 
     def __init__(self, value):
         self._value = value
-        FileBodyProducer.__init__(self, BytesIO(value))
+        self.length = len(value)
+
+    def startProducing(self, consumer):
+        """See `IBodyProducer.startProducing`."""
+        consumer.write(self._value)
+        return succeed(None)
+
+    def pauseProducing(self):
+        """See `IBodyProducer.pauseProducing`."""
+
+    def resumeProducing(self):
+        """See `IBodyProducer.resumeProducing`."""
+
+    def stopProducing(self):
+        """See `IBodyProducer.stopProducing`."""
 
     def value(self):
         """Return the byte string this producer was initialized with."""
         return self._value
 
 
-class SavedResponse(proxyForInterface(IResponse)):
-    """An `IResponse` that returns a predetermined byte string."""
+@implementer(IPushProducer)
+class ReplayTransport(object):
+    """The transport of a saved `Response`, whose body is delivered
+    from memory, so that there is nothing for it to do."""
+
+    def write(self, data):
+        """Discard *data*."""
+
+    def writeSequence(self, data):
+        """Discard *data*."""
 
-    def __init__(self, original, value):
+    def loseConnection(self):
+        """Do nothing."""
+
+    def abortConnection(self):
+        """Do nothing."""
+
+    def pauseProducing(self):
+        """Do nothing."""
+
+    def resumeProducing(self):
+        """Do nothing."""
+
+    def stopProducing(self):
+        """Do nothing."""
+
+
+class SavedResponse(proxyForInterface(IResponse)):
+    """An `IResponse` that returns a predetermined byte string.  Like
+    `RecordingResponse`, it carries the time its request was *started*
+    and the recorded *time_to_headers* and *time_to_last_byte*, where
+    known.  If *value* was decoded from the recorded body, the recorded
+    bytes are given as *raw*."""
+
+    def __init__(self, original, value, started=None, time_to_headers=None,
+                 time_to_last_byte=None, raw=None):
         self.original = original
         self._value = value
+        self._raw = raw
+        self.started = started
+        self.time_to_headers = time_to_headers
+        self.time_to_last_byte = time_to_last_byte
         self.original._bodyDataReceived(value)
         self.original._bodyDataFinished()
 
     def value(self):
         """Return the byte string this response was initialized with."""
         return self._value
+
+    def raw_value(self):
+        """Return the body bytes exactly as recorded, before any content
+        decoding."""
+        return self.value() if self._raw is None else self._raw
+
+
+@implementer(IPushProducer)
+class StreamingResponse(proxyForInterface(IResponse)):
+    """An `IResponse` implementation that wraps a `SavedResponse` and
+    delivers its body to a protocol in chunks of at most *chunk_size*
+    bytes, one per call scheduled on the `IReactorTime` provider
+    *clock*, spread evenly over *duration* seconds.  It acts as the
+    protocol's transport, so delivery stops while the protocol has
+    paused it."""
+
+    def __init__(self, original, chunk_size=CHUNK_SIZE, clock=None,
+                 duration=0):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.original = original
+        self.chunk_size = chunk_size
+        self.clock = clock
+        chunks = -(-len(original.value()) // chunk_size)
+        self.interval = float(duration) / max(1, chunks)
+        self.protocol = None
+        self.offset = 0
+        self.paused = False
+        self._call = None
+
+    def value(self):
+        """Return the body bytes of the wrapped `SavedResponse`."""
+        return self.original.value()
+
+    def raw_value(self):
+        """Return the body bytes of the wrapped `SavedResponse` exactly
+        as recorded, before any content decoding."""
+        return self.original.raw_value()
+
+    def deliverBody(self, protocol):
+        """See `IResponse.deliverBody`."""
+        self.protocol = protocol
+        protocol.makeConnection(self)
+        self._schedule()
+
+    def _schedule(self):
+        if not self.paused and self._call is None:
+            self._call = self.clock.callLater(self.interval, self._deliver)
+
+    def _deliver(self):
+        self._call = None
+        value = self.original.value()
+        if self.offset < len(value):
+            chunk = value[self.offset:self.offset + self.chunk_size]
+            self.offset += len(chunk)
+            self.protocol.dataReceived(chunk)
+        if self.offset < len(value):
+            self._schedule()
+        elif self.protocol is not None:
+            self._finish(Failure(ResponseDone()))
+
+    def _finish(self, reason):
+        protocol, self.protocol = self.protocol, None
+        protocol.connectionLost(reason)
+
+    def pauseProducing(self):
+        """See `IPushProducer.pauseProducing`."""
+        self.paused = True
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+
+    def resumeProducing(self):
+        """See `IPushProducer.resumeProducing`."""
+        self.paused = False
+        if self.protocol is not None:
+            self._schedule()
+
+    def stopProducing(self):
+        """See `IPushProducer.stopProducing`."""
+        self.pauseProducing()
+        if self.protocol is not None:
+            self._finish(Failure(ResponseFailed([Failure(ConnectionLost())])))
@@ -0,0 +1,85 @@
+"""Bulk recording of HTTP interactions."""
+# -*- test-case-name: stenographer.test.test_recorder
+
+
+from collections import defaultdict
+from urlparse import urlparse
+
+from twisted.internet.defer import (DeferredList, DeferredSemaphore,
+                                    inlineCallbacks)
+from twisted.internet.task import Cooperator
+from twisted.python.failure import Failure
+from twisted.web.client import PartialDownloadError, readBody
+
+
+def read_complete_body(response):
+    """Return a `Deferred` that fires with the body of *response*,
+    treating a body of unknown length as complete."""
+    finished = readBody(response)
+    finished.addErrback(partial_body)
+    return finished
+
+
+def partial_body(failure):
+    """Return the body read so far from a `PartialDownloadError`
+    *failure*, or pass any other failure on."""
+    failure.trap(PartialDownloadError)
+    return failure.value.response
+
+
+class Recorder(object):
+    """Makes GET requests through *agent* and reads their responses,
+    including any earlier responses in a redirect chain, so that a
+    wrapped `CassetteAgent` records them in full.  At most *concurrency*
+    requests are outstanding at once, and at most *per_host* to any one
+    host.  Work is scheduled on the `IReactorTime` provider *clock*,
+    which defaults to the global reactor."""
+
+    def __init__(self, agent, concurrency=10, per_host=2, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.agent = agent
+        self.concurrency = concurrency
+        self.semaphores = defaultdict(lambda: DeferredSemaphore(per_host))
+        self.clock = clock
+        self.cooperator = Cooperator(
+            scheduler=lambda work: clock.callLater(0, work))
+        self.started = clock.seconds()
+        #: The number of URIs fetched successfully.
+        self.completed = 0
+        #: A list of ``(uri, failure)`` tuples for URIs that could not
+        #: be fetched.
+        self.failures = []
+
+    @inlineCallbacks
+    def fetch(self, uri):
+        """Request *uri* and read its response."""
+        semaphore = self.semaphores[urlparse(uri).netloc]
+        yield semaphore.acquire()
+        try:
+            response = yield self.agent.request('GET', uri)
+            while response:
+                yield read_complete_body(response)
+                response = response.previousResponse
+        except Exception:  # pylint: disable=broad-except
+            self.failures.append((uri, Failure()))
+        else:
+            self.completed += 1
+        finally:
+            semaphore.release()
+
+    def fetch_all(self, uris):
+        """Fetch every URI in the iterable *uris*, taking each from it
+        only once there is capacity to request it.  Return a `Deferred`
+        that fires when all of them are done."""
+        work = (self.fetch(uri) for uri in uris)
+        return DeferredList([self.cooperator.cooperate(work).whenDone()
+                             for _ in xrange(self.concurrency)])
+
+    def progress(self):
+        """Return a human-readable summary of the progress so far."""
+        elapsed = self.clock.seconds() - self.started
+        finished = self.completed + len(self.failures)
+        return '{} completed, {} failed, {:.1f} requests/s'.format(
+            self.completed, len(self.failures),
+            finished / elapsed if elapsed > 0 else 0.0)
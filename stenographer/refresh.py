@@ -0,0 +1,221 @@
+"""Refreshing stale interactions with conditional requests."""
+# -*- test-case-name: stenographer.test.test_refresh
+
+
+from collections import defaultdict
+from email.utils import formatdate
+from urlparse import urlparse
+
+from twisted.internet.defer import (DeferredList, DeferredSemaphore,
+                                    inlineCallbacks, returnValue)
+from twisted.internet.task import Cooperator
+from twisted.web.http_headers import Headers
+from twisted.web.iweb import UNKNOWN_LENGTH
+
+from .cassette import body_as_dict, headers_as_dict, parse_recorded_at
+from .recorder import read_complete_body
+from .server import HOP_BY_HOP_HEADERS, header_value
+from .storage import save_interactions, stream_cassette
+
+
+#: Request headers that are replaced when making a conditional request.
+CONDITIONAL_HEADERS = frozenset((
+    'if-match', 'if-none-match', 'if-modified-since', 'if-unmodified-since',
+    'if-range'))
+
+#: Status codes that mean a resource no longer exists.
+GONE_STATUSES = frozenset((404, 410))
+
+
+def stored_header(headers, name):
+    """Return the first value of the header *name* in the VCR header
+    dict *headers*, regardless of case, or `None` if it is missing."""
+    name = name.lower()
+    for key, values in headers.iteritems():
+        if key.lower() == name and values:
+            return values[0]
+    return None
+
+
+def update_headers(headers, new_headers):
+    """Update the VCR header dict *headers* in place with the values in
+    the Twisted `Headers` object *new_headers*, as a cache does when it
+    gets a 304 response, leaving out headers that only describe the
+    connection."""
+    for name, values in new_headers.getAllRawHeaders():
+        if name.lower() in HOP_BY_HOP_HEADERS:
+            continue
+        for key in [key for key in headers if key.lower() == name.lower()]:
+            del headers[key]
+        headers[name] = values
+
+
+class Refresher(object):
+    """Refreshes cassettes by making conditional requests through the
+    Twisted Web agent *agent*, usually a plain `Agent`, for interactions
+    recorded more than *max_age* seconds ago.
+
+    Only ``GET`` interactions are refreshed.  Their requests are made
+    again with ``If-None-Match`` and ``If-Modified-Since`` headers taken
+    from the ``ETag`` and ``Last-Modified`` headers of the recorded
+    response.  A 304 response updates the recorded headers and time,
+    leaving the body as it is.  Any other successful or redirect
+    response replaces the recorded one, as does a 404 or 410 response
+    if *replace_gone* is true.  Other responses count as failures, and
+    leave the recorded interaction alone.  Interactions with neither
+    header are left alone, unless *unconditional* is true, in which
+    case they are requested again and replaced as described above.
+
+    At most *concurrency* requests are outstanding at once, and at most
+    *per_host* to any one host.  Time is measured and work is scheduled
+    on the `IReactorTime` provider *clock*, which defaults to the global
+    reactor."""
+
+    def __init__(self, agent, max_age=0, concurrency=10, per_host=2,
+                 unconditional=False, replace_gone=False, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.agent = agent
+        self.max_age = max_age
+        self.concurrency = concurrency
+        self.unconditional = unconditional
+        self.replace_gone = replace_gone
+        self.semaphores = defaultdict(lambda: DeferredSemaphore(per_host))
+        self.clock = clock
+        self.cooperator = Cooperator(
+            scheduler=lambda work: clock.callLater(0, work))
+
+    def is_stale(self, interaction):
+        """Return whether *interaction* was recorded long enough ago to
+        be refreshed.  Interactions without a recording time that can be
+        parsed are always stale."""
+        recorded = None
+        if 'recorded_at' in interaction:
+            recorded = parse_recorded_at(interaction['recorded_at'])
+        if recorded is None:
+            return True
+        return self.clock.seconds() - recorded > self.max_age
+
+    def conditional_headers(self, interaction):
+        """Return the Twisted `Headers` to refresh *interaction* with, or
+        `None` if it can't be refreshed."""
+        request = interaction['request']
+        response_headers = interaction['response']['headers']
+        if request['method'] != 'GET':
+            return None
+        headers = Headers()
+        for name, values in request['headers'].iteritems():
+            if name.lower() not in HOP_BY_HOP_HEADERS | CONDITIONAL_HEADERS:
+                headers.setRawHeaders(header_value(name),
+                                      [header_value(v) for v in values])
+        validated = False
+        for validator, condition in (('ETag', 'If-None-Match'),
+                                     ('Last-Modified', 'If-Modified-Since')):
+            value = stored_header(response_headers, validator)
+            if value is not None:
+                headers.setRawHeaders(condition, [header_value(value)])
+                validated = True
+        if not validated and not self.unconditional:
+            return None
+        return headers
+
+    @inlineCallbacks
+    def refresh_interaction(self, stale, updates, summary):
+        """Make a conditional request for an interaction described by
+        the dict *stale*, as yielded by `stale_interactions`.  If the
+        interaction changed, store a function that updates its VCR
+        interaction dict in *updates*, under its index.  Count the
+        outcome in the dict *summary*."""
+        uri = stale['request']['uri'].encode('utf-8')
+        semaphore = self.semaphores[urlparse(uri).netloc]
+        yield semaphore.acquire()
+        try:
+            started = self.clock.seconds()
+            response = yield self.agent.request('GET', uri, stale['headers'])
+            time_to_headers = self.clock.seconds() - started
+            body = yield read_complete_body(response)
+        except Exception:  # pylint: disable=broad-except
+            summary['failed'] += 1
+            return
+        finally:
+            semaphore.release()
+        summary['body_bytes'] += len(body)
+        recorded_at = formatdate(started)
+        if response.code == 304:
+            summary['not_modified'] += 1
+            def update(interaction):
+                update_headers(interaction['response']['headers'],
+                               response.headers)
+                interaction['recorded_at'] = recorded_at
+                return interaction
+        elif not (200 <= response.code < 400 or
+                  self.replace_gone and response.code in GONE_STATUSES):
+            summary['failed'] += 1
+            return
+        else:
+            summary['changed'] += 1
+            if response.length is not UNKNOWN_LENGTH:
+                response.headers.setRawHeaders('Content-Length',
+                                               [response.length])
+            timings = {'time_to_headers': time_to_headers,
+                       'time_to_last_byte': self.clock.seconds() - started}
+            def update(interaction):
+                old_body = interaction['response']['body']
+                interaction['response'] = {
+                    'http_version': '1.1',
+                    'status': {'code': response.code,
+                               'message': response.phrase},
+                    'body': body_as_dict(body, response.headers,
+                                         'base64_string' in old_body or
+                                         old_body.get('base64')),
+                    'headers': headers_as_dict(response.headers)}
+                interaction['recorded_at'] = recorded_at
+                interaction['timings'] = timings
+                return interaction
+        updates[stale['index']] = update
+
+    def stale_interactions(self, path, summary):
+        """Yield a small dict, holding its ``index``, ``request``, and
+        conditional request ``headers``, for every interaction in the
+        cassette at *path* that should be refreshed."""
+        interactions, _ = stream_cassette(path)
+        for index, interaction in enumerate(interactions):
+            summary['interactions'] += 1
+            if not self.is_stale(interaction):
+                summary['fresh'] += 1
+                continue
+            headers = self.conditional_headers(interaction)
+            if headers is None:
+                summary['skipped'] += 1
+                continue
+            yield {'index': index, 'request': interaction['request'],
+                   'headers': headers}
+
+    @inlineCallbacks
+    def refresh(self, path):
+        """Refresh the stale interactions in the cassette at *path*, and
+        rewrite it in its current format if any of them changed.  Return
+        a `Deferred` that fires with a summary dict counting the
+        cassette's ``interactions``, those that were ``fresh`` enough to
+        leave alone, ``skipped`` for lack of validators, ``not_modified``,
+        ``changed``, or ``failed``, and the ``body_bytes`` downloaded.
+
+        The cassette is streamed once to find stale interactions, and
+        again to write it out, so only changed bodies are held in
+        memory."""
+        summary = dict.fromkeys(('interactions', 'fresh', 'skipped',
+                                 'not_modified', 'changed', 'failed',
+                                 'body_bytes'), 0)
+        updates = {}
+        work = (self.refresh_interaction(stale, updates, summary)
+                for stale in self.stale_interactions(path, summary))
+        yield DeferredList([self.cooperator.cooperate(work).whenDone()
+                            for _ in xrange(self.concurrency)])
+        if updates:
+            interactions, data = stream_cassette(path)
+            save_interactions(
+                (updates[index](interaction) if index in updates
+                 else interaction
+                 for index, interaction in enumerate(interactions)),
+                path, data is not None, data)
+        returnValue(summary)
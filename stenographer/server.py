@@ -0,0 +1,257 @@
+"""Serving cassettes over HTTP, and recording them through a proxy."""
+# -*- test-case-name: stenographer.test.test_server
+
+
+from collections import defaultdict
+from urlparse import urljoin, urlparse
+
+from twisted.internet.protocol import Protocol
+from twisted.web.client import FileBodyProducer, ResponseDone
+from twisted.web.http import PotentialDataLoss
+from twisted.web.http_headers import Headers
+from twisted.web.iweb import UNKNOWN_LENGTH
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
+
+
+#: Headers that describe a single connection rather than the request
+#: or response, and so are not replayed or forwarded.
+HOP_BY_HOP_HEADERS = frozenset((
+    'connection', 'content-length', 'keep-alive', 'proxy-authenticate',
+    'proxy-authorization', 'proxy-connection', 'te', 'trailer',
+    'transfer-encoding', 'upgrade'))
+
+
+def header_value(value):
+    """Return a saved header name or *value* as a byte string."""
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def single_origin(cassette):
+    """Return the scheme and authority shared by the URIs of every
+    interaction in *cassette*, like ``https://example.com``, or `None`
+    if there are several or the cassette isn't matched on URI."""
+    if 'uri' not in cassette.match_on:
+        return None
+    position = cassette.match_on.index('uri')
+    origins = set('{0.scheme}://{0.netloc}'.format(urlparse(key[position]))
+                  for key in cassette.index)
+    if len(origins) == 1:
+        return origins.pop()
+    return None
+
+
+class CassetteResource(Resource):
+    """A Twisted Web resource that answers every request with a saved
+    interaction from *cassette* that matches it on the cassette's
+    criteria.  Requests that match nothing get a 404 response.
+
+    Absolute request URIs are used as is.  Others are resolved against
+    *origin*, a URI like ``https://example.com``, which defaults to the
+    origin shared by every interaction in the cassette, or failing that,
+    to the request's own ``Host`` header.
+
+    Identical requests are answered with their saved interactions in
+    order.  Once they run out, they start over from the first one,
+    unless *once* is true.  If *time_scale* is nonzero, each response
+    is delayed by its recorded duration times *time_scale*, according to
+    the `IReactorTime` provider *clock* (by default, the global
+    reactor)."""
+
+    isLeaf = True
+
+    def __init__(self, cassette, origin=None, once=False, time_scale=0,
+                 clock=None):
+        Resource.__init__(self)
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.cassette = cassette
+        self.origin = origin or single_origin(cassette)
+        self.once = once
+        self.time_scale = time_scale
+        self.clock = clock
+        #: The number of times each request fingerprint has been served.
+        self.played = defaultdict(int)
+        #: The tuples returned by `prepare` for each cassette position
+        #: served so far.
+        self.prepared = {}
+
+    def absolute_uri(self, request):
+        """Return the absolute URI that *request* is taken to be for."""
+        if urlparse(request.uri).scheme:
+            return request.uri
+        if self.origin is not None:
+            return urljoin(self.origin, request.uri)
+        scheme = 'https' if request.isSecure() else 'http'
+        return '{}://{}{}'.format(scheme, request.getHeader('Host'),
+                                  request.uri)
+
+    def find(self, request):
+        """Return the cassette position of the saved interaction that
+        should answer *request*, or `None` if there is none."""
+        body = None
+        if 'body' in self.cassette.match_on:
+            body = request.content.read()
+        key = self.cassette.request_key(
+            request.method, self.absolute_uri(request),
+            request.requestHeaders, body)
+        positions = self.cassette.index.get(key)
+        if not positions:
+            return None
+        played = self.played[key]
+        if played >= len(positions):
+            if self.once:
+                return None
+            played %= len(positions)
+        self.played[key] = played + 1
+        return positions[played]
+
+    def prepare(self, position):
+        """Return a ``(code, phrase, headers, body, delay)`` tuple for
+        replaying the saved interaction at *position*."""
+        if position not in self.prepared:
+            record = self.cassette.record(position)
+            headers = [
+                (header_value(name), [header_value(v) for v in values])
+                for name, values in record.response_headers.iteritems()
+                if name.lower() not in HOP_BY_HOP_HEADERS]
+            delay = 0
+            if self.time_scale and record.time_to_last_byte is not None:
+                delay = record.time_to_last_byte * self.time_scale
+            self.prepared[position] = (
+                record.code, header_value(record.phrase), headers,
+                record.response_body, delay)
+        return self.prepared[position]
+
+    def render(self, request):
+        position = self.find(request)
+        if position is None:
+            request.setResponseCode(404)
+            request.setHeader('Content-Type', 'text/plain')
+            return 'no saved interaction for {} {}\n'.format(
+                request.method, self.absolute_uri(request))
+        code, phrase, headers, body, delay = self.prepare(position)
+        request.setResponseCode(code, phrase)
+        for name, values in headers:
+            request.responseHeaders.setRawHeaders(name, values)
+        request.setHeader('Content-Length', str(len(body)))
+        if not request.responseHeaders.hasHeader('Content-Type'):
+            request.defaultContentType = None
+        if not delay:
+            return body
+        call = self.clock.callLater(delay, self._finish, request, body)
+        # A client that disconnects early can't be finished later.
+        request.notifyFinish().addErrback(lambda _: call.cancel())
+        return NOT_DONE_YET
+
+    @staticmethod
+    def _finish(request, body):
+        request.write(body)
+        request.finish()
+
+
+def error_response(request, code, message):
+    """Set *request* up for a plain text error response with status
+    *code*, and return its body."""
+    request.setResponseCode(code)
+    request.setHeader('Content-Type', 'text/plain')
+    return message + '\n'
+
+
+class RelayProtocol(Protocol):
+    """Writes a response body to the Twisted Web *request* as it
+    arrives, instead of buffering it.  The response's transport is
+    registered as the request's producer, so that it is paused while
+    the client isn't reading.  If the client goes away, the rest of the
+    body is still read and discarded, so that it is recorded in full."""
+
+    def __init__(self, request):
+        self.request = request
+        self.disconnected = False
+        request.notifyFinish().addErrback(self._client_lost)
+
+    def connectionMade(self):
+        if not self.disconnected:
+            self.request.registerProducer(self.transport, True)
+
+    def dataReceived(self, data):
+        if not self.disconnected:
+            self.request.write(data)
+
+    def connectionLost(self, reason):
+        if self.disconnected:
+            return
+        self.request.unregisterProducer()
+        if reason.check(ResponseDone, PotentialDataLoss):
+            self.request.finish()
+        else:
+            # The body was cut short, so don't pretend otherwise.
+            self.request.loseConnection()
+
+    def _client_lost(self, _):
+        self.disconnected = True
+        if self.transport is not None:
+            self.transport.resumeProducing()
+
+
+class ProxyResource(Resource):
+    """A Twisted Web resource that acts as an HTTP forward proxy,
+    passing each request it receives to the Twisted Web agent *agent*,
+    usually a `CassetteAgent`, and streaming the response back to the
+    client as it arrives.  Requests must have absolute URIs, as sent by
+    clients configured to use a proxy; ``CONNECT`` tunnels for HTTPS are
+    not supported.  If *agent* fails, the client gets a 502 response."""
+
+    isLeaf = True
+
+    def __init__(self, agent):
+        Resource.__init__(self)
+        self.agent = agent
+
+    def render(self, request):
+        if request.method == 'CONNECT':
+            return error_response(request, 501, 'CONNECT is not supported')
+        if not urlparse(request.uri).scheme:
+            return error_response(
+                request, 400, 'request URI must be absolute')
+        headers = Headers()
+        for name, values in request.requestHeaders.getAllRawHeaders():
+            if name.lower() not in HOP_BY_HOP_HEADERS:
+                headers.setRawHeaders(name, values)
+        body_producer = None
+        request.content.seek(0, 2)
+        if request.content.tell():
+            request.content.seek(0)
+            body_producer = FileBodyProducer(request.content)
+        relay = RelayProtocol(request)
+        finished = self.agent.request(request.method, request.uri,
+                                      headers, body_producer)
+        finished.addCallbacks(self._respond, self._fail,
+                              callbackArgs=(request, relay),
+                              errbackArgs=(request, relay))
+        return NOT_DONE_YET
+
+    @staticmethod
+    def _respond(response, request, relay):
+        if not relay.disconnected:
+            request.setResponseCode(response.code,
+                                    header_value(response.phrase))
+            for name, values in response.headers.getAllRawHeaders():
+                if name.lower() not in HOP_BY_HOP_HEADERS:
+                    request.responseHeaders.setRawHeaders(
+                        header_value(name), [header_value(v) for v in values])
+            if response.length is not UNKNOWN_LENGTH:
+                request.setHeader('Content-Length', str(response.length))
+            if not request.responseHeaders.hasHeader('Content-Type'):
+                request.defaultContentType = None
+        response.deliverBody(relay)
+
+    @staticmethod
+    def _fail(failure, request, relay):
+        if relay.disconnected:
+            return
+        request.write(error_response(request, 502, 'proxy error: {}'.format(
+            failure.getErrorMessage())))
+        request.finish()
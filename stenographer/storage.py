@@ -0,0 +1,623 @@
+"""Reading and writing cassettes on disk."""
+# -*- test-case-name: stenographer.test.test_storage
+
+
+from base64 import b64encode
+import bz2
+import codecs
+from collections import OrderedDict
+from contextlib import contextmanager
+import errno
+import gzip
+import json
+import os
+import re
+import tempfile
+import time
+from uuid import uuid4
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+from .binary import MAGIC, read_binary, write_binary
+from .cassette import (DEFAULT_MATCH_ON, Cassette, DirectoryCassette,
+                       inline_interaction)
+from .proxy import CHUNK_SIZE, SpooledBuffer
+from .__version__ import __version__
+
+
+#: The suffix appended to a cassette path to name its journal.
+JOURNAL_SUFFIX = '.journal'
+
+#: The name of the index file in a directory cassette.
+DIRECTORY_INDEX = 'index.json'
+
+#: The name of the subdirectory of a directory cassette that holds its
+#: interaction files.
+DIRECTORY_INTERACTIONS = 'interactions'
+
+#: Compression formats, keyed by the file extensions that select them
+#: when saving.
+COMPRESSION_EXTENSIONS = {'.gz': 'gzip', '.bz2': 'bz2', '.xz': 'xz'}
+
+#: Compression formats, keyed by the magic numbers that identify them
+#: when loading.
+COMPRESSION_MAGIC = {'\x1f\x8b': 'gzip', 'BZh': 'bz2', '\xfd7zXZ\x00': 'xz'}
+
+
+def detect_compression(path, mode='rb'):
+    """Return the name of the compression format to use when opening
+    the cassette at *path* in *mode*, or `None` if it is uncompressed.
+    Files being read are identified by their magic numbers, and files
+    being written by their extensions."""
+    if 'r' in mode:
+        with open(path, 'rb') as cassette_file:
+            head = cassette_file.read(max(len(m) for m in COMPRESSION_MAGIC))
+        for magic, compression in COMPRESSION_MAGIC.iteritems():
+            if head.startswith(magic):
+                return compression
+        return None
+    return COMPRESSION_EXTENSIONS.get(os.path.splitext(path)[1])
+
+
+def open_cassette_file(path, mode='rb'):
+    """Open the cassette file at *path* in *mode*, transparently
+    compressing or decompressing it as it is written or read."""
+    compression = detect_compression(path, mode)
+    if compression == 'gzip':
+        return gzip.open(path, mode)
+    if compression == 'bz2':
+        return bz2.BZ2File(path, mode)
+    if compression == 'xz':
+        if lzma is None:
+            raise IOError('xz cassettes require the lzma module')
+        return lzma.LZMAFile(path, mode)
+    return open(path, mode)
+
+
+def make_temp_file(directory, prefix='tmp', suffix=''):
+    """Create an empty temporary file in *directory*, with the given
+    *prefix* and *suffix*, that is readable by whoever could read a
+    file created there normally, and return its path."""
+    fd, temp_path = tempfile.mkstemp(suffix, prefix, directory)
+    os.close(fd)
+    # mkstemp creates files readable only by their owner.
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(temp_path, 0o666 & ~umask)
+    return temp_path
+
+
+@contextmanager
+def atomic_cassette_file(path):
+    """Return a context manager that opens a temporary file next to
+    *path* for writing, compressed according to the extension of
+    *path*, and moves it into place once the block exits successfully.
+    An interrupted write never leaves a partially written cassette at
+    *path*."""
+    directory, name = os.path.split(os.path.abspath(path))
+    temp_path = make_temp_file(directory, '.{}.'.format(name),
+                               os.path.splitext(name)[1])
+    try:
+        with open_cassette_file(temp_path, 'wb') as cassette_file:
+            yield cassette_file
+        os.rename(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def is_directory_cassette(path):
+    """Return whether *path* names a directory cassette, either because
+    it is an existing directory or because it ends in a separator."""
+    return path.endswith(os.sep) or os.path.isdir(path)
+
+
+def save_cassette(dct, path):
+    """Atomically write the cassette dict *dct* to *path* as JSON, with
+    its interactions last so that `add_interactions` can append to it
+    without parsing it, or as a directory cassette if *path* names one."""
+    if is_directory_cassette(path):
+        save_directory(dct['http_interactions'], path)
+        return
+    ordered = OrderedDict(sorted(
+        dct.iteritems(), key=lambda item: item[0] == 'http_interactions'))
+    with atomic_cassette_file(path) as cassette_file:
+        json.dump(ordered, cassette_file)
+
+
+#: Matches the JSON encoding of the placeholders that stand in for
+#: spooled bodies while an interaction is being serialized.
+PLACEHOLDER = re.compile(r'"\\u0000(\d+)"')
+
+
+def write_spooled_body(out, spooled, key):
+    """Write the contents of the `SpooledBuffer` *spooled* to the file
+    *out* as a JSON string, encoded as appropriate for the VCR body dict
+    key *key*, one chunk at a time."""
+    out.write('"')
+    if key == 'base64_string':
+        # Keep slices at a multiple of three bytes so that their
+        # Base64 encodings can simply be concatenated.
+        for piece in spooled.slices(CHUNK_SIZE - CHUNK_SIZE % 3):
+            out.write(b64encode(piece))
+    else:
+        # Python 2's incremental decoders only accept byte strings.
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        for chunk in spooled.chunks():
+            out.write(json.dumps(decoder.decode(chunk))[1:-1])
+        decoder.decode('', final=True)
+    out.write('"')
+
+
+def write_interaction(out, interaction):
+    """Write the VCR interaction dict *interaction* to the file *out*
+    as JSON, encoding any `SpooledBuffer` body values directly from
+    their buffers."""
+    spooled = []
+    for part in ('request', 'response'):
+        body = interaction[part]['body']
+        for key, value in body.items():
+            if isinstance(value, SpooledBuffer):
+                body[key] = '\0{}'.format(len(spooled))
+                spooled.append((value, key))
+    pieces = PLACEHOLDER.split(json.dumps(interaction))
+    out.write(pieces[0])
+    for i in xrange(1, len(pieces), 2):
+        write_spooled_body(out, *spooled[int(pieces[i])])
+        out.write(pieces[i + 1])
+
+
+class JournalWriter(object):
+    """Appends VCR interaction dicts to a line-delimited journal file,
+    one JSON object per line, flushing after each one.  An existing
+    journal left behind by an interrupted run is appended to, once any
+    incomplete final line has been dropped, so that the interactions
+    it holds are saved along with the new ones."""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'a+b')
+        self.file.seek(0, os.SEEK_END)
+        end = self.file.tell()
+        while end:
+            start = max(0, end - CHUNK_SIZE)
+            self.file.seek(start)
+            newline = self.file.read(end - start).rfind('\n')
+            if newline >= 0:
+                end = start + newline + 1
+                break
+            end = start
+        self.file.truncate(end)
+
+    def write(self, interaction):
+        """Append the VCR interaction dict *interaction*."""
+        write_interaction(self.file, interaction)
+        self.file.write('\n')
+        self.file.flush()
+
+    def close(self):
+        """Close the underlying journal file."""
+        self.file.close()
+
+
+class DirectoryWriter(object):
+    """Writes VCR interaction dicts to their own files in the directory
+    cassette at *path*, without touching its index.  File names start
+    with the time the writer was created and a random tag, so several
+    writers can record into the same cassette at once."""
+
+    def __init__(self, path):
+        self.path = path
+        self.prefix = '{:013x}-{}'.format(int(time.time() * 1000),
+                                          uuid4().hex[:8])
+        self.count = 0
+        try:
+            os.makedirs(os.path.join(path, DIRECTORY_INTERACTIONS))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def write(self, interaction):
+        """Write the VCR interaction dict *interaction* to a new file,
+        and return the file's path relative to the cassette."""
+        name = '{}/{}-{:08d}.json'.format(DIRECTORY_INTERACTIONS,
+                                          self.prefix, self.count)
+        self.count += 1
+        with atomic_cassette_file(os.path.join(self.path, name)) as out:
+            write_interaction(out, interaction)
+        return name
+
+    def close(self):
+        """Do nothing, since every interaction is written as soon as it
+        is received."""
+
+
+def open_journal(cassette_path):
+    """Return a writer for journaling interactions recorded into the
+    cassette at *cassette_path*: a `DirectoryWriter` for directory
+    cassettes, or a `JournalWriter` for the others."""
+    if is_directory_cassette(cassette_path):
+        return DirectoryWriter(cassette_path)
+    return JournalWriter(cassette_path + JOURNAL_SUFFIX)
+
+
+def iter_journal_lines(journal_file):
+    """Yield the serialized interactions in *journal_file*, skipping
+    any final line left incomplete by an interrupted writer."""
+    for line in journal_file:
+        if line.endswith('\n'):
+            yield line[:-1]
+
+
+def write_interaction_lines(cassette_file, lines):
+    """Write a JSON cassette holding the JSON-serialized interactions in
+    *lines* to *cassette_file*, one at a time, in the standard VCR
+    layout."""
+    cassette_file.write('{"recorded_with": ')
+    cassette_file.write(json.dumps('Stenographer {}'.format(__version__)))
+    cassette_file.write(', "http_interactions": [')
+    for i, line in enumerate(lines):
+        if i:
+            cassette_file.write(', ')
+        cassette_file.write(line)
+    cassette_file.write(']}')
+
+
+def finalize_journal(journal_path, cassette_path):
+    """Write the interactions in the journal at *journal_path* to
+    *cassette_path* in the standard VCR layout, one at a time.  For a
+    directory cassette, whose interactions were journaled in place,
+    this only writes its index."""
+    if is_directory_cassette(cassette_path):
+        update_index(cassette_path)
+        return
+    with open(journal_path, 'rb') as journal_file, \
+            atomic_cassette_file(cassette_path) as cassette_file:
+        write_interaction_lines(cassette_file,
+                                iter_journal_lines(journal_file))
+    os.remove(journal_path)
+
+
+def read_cassette_dict(cassette_file):
+    """Read a cassette in either JSON or binary format from
+    *cassette_file*.  Return a tuple of the cassette dict and, for
+    binary cassettes, the buffer holding their bodies."""
+    if cassette_file.read(len(MAGIC)) == MAGIC:
+        return read_binary(cassette_file)
+    cassette_file.seek(0)
+    return json.load(cassette_file), None
+
+
+def read_index(path):
+    """Return the list of index entries in the directory cassette at
+    *path*, each a dict holding an interaction's request and the path of
+    its file, or an empty list if it has no index yet."""
+    try:
+        with open(os.path.join(path, DIRECTORY_INDEX), 'rb') as index_file:
+            return json.load(index_file)['http_interactions']
+    except EnvironmentError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return []
+
+
+def write_index(path, entries):
+    """Atomically write the index of the directory cassette at *path*
+    with the given list of index *entries*."""
+    save_cassette({'recorded_with': 'Stenographer {}'.format(__version__),
+                   'http_interactions': entries},
+                  os.path.join(path, DIRECTORY_INDEX))
+
+
+def remove_files(path, entries):
+    """Remove the interaction files of the index *entries* from the
+    directory cassette at *path*, ignoring any that are already gone."""
+    for entry in entries:
+        try:
+            os.remove(os.path.join(path, entry['file']))
+        except EnvironmentError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+def update_index(path, replace_on=None, blob_store=None):
+    """Add the interaction files in the directory cassette at *path*
+    that are missing from its index to the end of it, in file name
+    order, and drop entries whose files have gone.  If *replace_on* is
+    given, previously indexed interactions whose requests match any of
+    the new ones on those criteria are deleted."""
+    names = set(
+        '{}/{}'.format(DIRECTORY_INTERACTIONS, name) for name in
+        os.listdir(os.path.join(path, DIRECTORY_INTERACTIONS))
+        if name.endswith('.json') and not name.startswith('.'))
+    entries = [entry for entry in read_index(path) if entry['file'] in names]
+    added = []
+    for name in sorted(names - set(entry['file'] for entry in entries)):
+        with open(os.path.join(path, name), 'rb') as interaction_file:
+            added.append({'request': json.load(interaction_file)['request'],
+                          'file': name})
+    if replace_on is not None:
+        cassette = Cassette(replace_on, blob_store)
+        replaced = set(cassette.interaction_key(entry) for entry in added)
+        removed = [entry for entry in entries
+                   if cassette.interaction_key(entry) in replaced]
+        entries = [entry for entry in entries
+                   if cassette.interaction_key(entry) not in replaced]
+    write_index(path, entries + added)
+    if replace_on is not None:
+        remove_files(path, removed)
+
+
+def save_directory(interactions, path):
+    """Write the VCR interaction dicts in the iterable *interactions* to
+    *path* as a directory cassette, one at a time, replacing any
+    interactions already there.  The new index is written before the
+    files of the interactions it replaces are removed, and files that
+    were never indexed, such as those being written by an incremental
+    recording, are left alone."""
+    previous = read_index(path)
+    writer = DirectoryWriter(path)
+    entries = [{'request': interaction['request'],
+                'file': writer.write(interaction)}
+               for interaction in interactions]
+    write_index(path, entries)
+    written = set(entry['file'] for entry in entries)
+    remove_files(path, [entry for entry in previous
+                        if entry['file'] not in written])
+
+
+def read_cassette(path):
+    """Read the cassette at *path* in any format, as `read_cassette_dict`
+    does, reading every interaction file of a directory cassette."""
+    if not is_directory_cassette(path):
+        with open_cassette_file(path) as cassette_file:
+            return read_cassette_dict(cassette_file)
+    cassette = DirectoryCassette(directory=path)
+    for entry in read_index(path):
+        cassette.append_dict(entry)
+    return cassette.as_dict(), None
+
+
+#: Matches the start of the list of interactions in a JSON cassette.
+INTERACTIONS_START = re.compile(r'"http_interactions"\s*:\s*\[')
+
+#: Matches the separators between interactions in a JSON cassette.
+INTERACTIONS_SEPARATOR = re.compile(r'[\s,]*')
+
+
+def iter_json_interactions(cassette_file, chunk_size=CHUNK_SIZE):
+    """Yield the VCR interaction dicts in the JSON cassette being read
+    from *cassette_file*, parsing one at a time, so that no more than a
+    single interaction is held in memory at once."""
+    decoder = json.JSONDecoder()
+    data = ''
+    while True:
+        match = INTERACTIONS_START.search(data)
+        if match is not None:
+            break
+        chunk = cassette_file.read(chunk_size)
+        if not chunk:
+            raise ValueError('no interactions found in cassette')
+        data += chunk
+    position = match.end()
+    while True:
+        position = INTERACTIONS_SEPARATOR.match(data, position).end()
+        if position < len(data) and data[position] == ']':
+            return
+        try:
+            if position == len(data):
+                raise ValueError('end of buffered data')
+            interaction, position = decoder.raw_decode(data, position)
+        except ValueError:
+            # Read at least as much again as is buffered, so that a
+            # large interaction isn't parsed over again for every chunk.
+            chunk = cassette_file.read(max(chunk_size, len(data) - position))
+            if not chunk:
+                raise ValueError('cassette ended in the middle of its '
+                                 'interactions')
+            data = data[position:] + chunk
+            position = 0
+            continue
+        yield interaction
+
+
+def _iter_file_interactions(cassette_file):
+    with cassette_file:
+        for interaction in iter_json_interactions(cassette_file):
+            yield interaction
+
+
+def _iter_directory_interactions(path):
+    for entry in read_index(path):
+        with open(os.path.join(path, entry['file']), 'rb') as interaction_file:
+            yield json.load(interaction_file)
+
+
+def stream_cassette(path):
+    """Return a tuple of an iterator over the VCR interaction dicts in
+    the cassette at *path*, in any format, and for binary cassettes the
+    buffer holding their bodies.  Only one interaction of a JSON or
+    directory cassette is read into memory at a time, and the bodies of
+    a binary cassette are memory-mapped, so cassettes much larger than
+    memory can be streamed."""
+    if is_directory_cassette(path):
+        return _iter_directory_interactions(path), None
+    cassette_file = open_cassette_file(path)
+    if cassette_file.read(len(MAGIC)) == MAGIC:
+        with cassette_file:
+            dct, data = read_binary(cassette_file)
+        return iter(dct['http_interactions']), data
+    cassette_file.seek(0)
+    return _iter_file_interactions(cassette_file), None
+
+
+def save_interactions(interactions, path, binary=False, data=None,
+                      blob_store=None):
+    """Atomically write the VCR interaction dicts in the iterable
+    *interactions* to a cassette at *path*, one at a time.  The cassette
+    is written in binary format if *binary* is true, as a directory
+    cassette if *path* names one, and as JSON otherwise.  Bodies stored
+    in the binary cassette data *data* are copied in, as are bodies in
+    *blob_store* when writing a binary cassette."""
+    if binary:
+        dct = {'recorded_with': 'Stenographer {}'.format(__version__),
+               'http_interactions': interactions}
+        with atomic_cassette_file(path) as cassette_file:
+            write_binary(dct, cassette_file, blob_store, data)
+        return
+    if data is not None:
+        interactions = (inline_interaction(interaction, data)
+                        for interaction in interactions)
+    if is_directory_cassette(path):
+        save_directory(interactions, path)
+        return
+    with atomic_cassette_file(path) as cassette_file:
+        write_interaction_lines(cassette_file, (
+            json.dumps(interaction) for interaction in interactions))
+
+
+def load_cassette(path, match_on=DEFAULT_MATCH_ON, lazy=False,
+                  blob_store=None, metrics=None):
+    """Load and return the cassette at *path*, which may be in JSON or
+    binary format, possibly compressed, or a directory cassette.  Only
+    the index of a directory cassette is read if *lazy* is true.  If
+    *metrics* is given, a ``parse`` event is emitted to that `Metrics`
+    object."""
+    if metrics is not None:
+        started = metrics.timer()
+    directory = is_directory_cassette(path)
+    if directory:
+        with open(os.path.join(path, DIRECTORY_INDEX), 'rb') as index_file:
+            dct, data = json.load(index_file), None
+    else:
+        with open_cassette_file(path) as cassette_file:
+            dct, data = read_cassette_dict(cassette_file)
+    if metrics is not None:
+        metrics.emit('parse', path=path, seconds=metrics.timer() - started)
+    if not directory:
+        return Cassette.from_dict(dct, match_on, lazy, blob_store, data)
+    cassette = DirectoryCassette.from_dict(dct, match_on, True, blob_store)
+    cassette.directory = path
+    if not lazy:
+        cassette.materialize()
+    return cassette
+
+
+def append_offset(path):
+    """Return a tuple of the offset in the cassette at *path* where
+    interactions should be appended, and whether it has no interactions
+    yet; or `None` if the cassette is compressed, in binary format, or
+    doesn't end with its interactions."""
+    if detect_compression(path) is not None:
+        return None
+    with open(path, 'rb') as cassette_file:
+        if cassette_file.read(len(MAGIC)) == MAGIC:
+            return None
+        cassette_file.seek(0, os.SEEK_END)
+        end = cassette_file.tell()
+        cassette_file.seek(max(0, end - 4096))
+        tail = cassette_file.read()
+    # The only list in the top level of a VCR cassette is its list of
+    # interactions, so the cassette ends with them if it ends in "]}".
+    stripped = tail.rstrip()
+    if stripped.endswith('}') and stripped[:-1].rstrip().endswith(']'):
+        stripped = stripped[:-1].rstrip()[:-1]
+        return end - len(tail) + len(stripped), stripped.rstrip().endswith('[')
+    return None
+
+
+def add_interactions(cassette_path, lines, replace_on=None,
+                     blob_store=None):
+    """Add the JSON-serialized interactions in *lines* to the end of
+    the cassette at *cassette_path*.  Uncompressed JSON cassettes are
+    copied up to the end of their interactions into a new file, without
+    parsing their existing interactions, and the new ones are appended
+    to it.  Other cassettes are rewritten in their current format,
+    copying in bodies from *blob_store* if they are binary.  Either way,
+    the new cassette is moved into place atomically.
+
+    If *replace_on* is given, saved interactions whose requests match
+    any of the new ones on those criteria are dropped, which always
+    requires a full rewrite.  Directory cassettes are always added to in
+    place."""
+    if is_directory_cassette(cassette_path):
+        writer = DirectoryWriter(cassette_path)
+        for line in lines:
+            writer.write(json.loads(line))
+        update_index(cassette_path, replace_on, blob_store)
+        return
+    appending = None if replace_on is not None else append_offset(
+        cassette_path)
+    if appending is not None:
+        remaining, empty = appending
+        with open(cassette_path, 'rb') as original, \
+                atomic_cassette_file(cassette_path) as cassette_file:
+            while remaining:
+                chunk = original.read(min(remaining, CHUNK_SIZE))
+                if not chunk:
+                    raise IOError('{} was truncated while being appended '
+                                  'to'.format(cassette_path))
+                cassette_file.write(chunk)
+                remaining -= len(chunk)
+            for line in lines:
+                if not empty:
+                    cassette_file.write(', ')
+                cassette_file.write(line)
+                empty = False
+            cassette_file.write(']}')
+        return
+    dct, data = read_cassette(cassette_path)
+    interactions = [json.loads(line) for line in lines]
+    if replace_on is not None:
+        cassette = Cassette(replace_on, blob_store, data)
+        replaced = set(cassette.interaction_key(interaction)
+                       for interaction in interactions)
+        dct['http_interactions'] = [
+            interaction for interaction in dct['http_interactions']
+            if cassette.interaction_key(interaction) not in replaced]
+    dct['http_interactions'].extend(interactions)
+    if data is None:
+        save_cassette(dct, cassette_path)
+        return
+    with atomic_cassette_file(cassette_path) as cassette_file:
+        write_binary(dct, cassette_file, blob_store, data)
+
+
+def add_journal(journal_path, cassette_path, replace_on=None,
+                blob_store=None):
+    """Add the interactions in the journal at *journal_path* to the
+    cassette at *cassette_path*, as `add_interactions` does, and remove
+    the journal.  The interactions of a directory cassette are already
+    in place, so only its index is updated."""
+    if is_directory_cassette(cassette_path):
+        update_index(cassette_path, replace_on, blob_store)
+        return
+    if os.path.getsize(journal_path):
+        with open(journal_path, 'rb') as journal_file:
+            add_interactions(cassette_path, iter_journal_lines(journal_file),
+                             replace_on, blob_store)
+    os.remove(journal_path)
+
+
+def convert_cassette(source_path, target_path, binary=False,
+                     blob_store=None):
+    """Convert the cassette at *source_path* to JSON format, or binary
+    format if *binary* is true, and write it to *target_path*.  Either
+    path may name a directory cassette.  Bodies in *blob_store* are left
+    there when converting to JSON or directory cassettes."""
+    dct, data = read_cassette(source_path)
+    if binary:
+        with atomic_cassette_file(target_path) as target_file:
+            write_binary(dct, target_file, blob_store, data)
+        return
+    if data is not None:
+        dct['http_interactions'] = [
+            inline_interaction(interaction, data)
+            for interaction in dct['http_interactions']]
+    save_cassette(dct, target_path)
@@ -2,16 +2,23 @@
 # pylint: disable=missing-docstring,too-few-public-methods
 
 
+import json
+import os
+import shutil
 import sys
 
 from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.task import Clock
 from twisted.python.failure import Failure
 from twisted.trial.unittest import TestCase
-from twisted.web.client import Headers, Response, ResponseDone, readBody
+from twisted.web.client import (ContentDecoderAgent, GzipDecoder, Headers,
+                                Response, ResponseDone, readBody)
 from twisted.web.test.test_agent import (AbortableStringTransport,
                                          FakeReactorAndConnectMixin)
 
-from ..agent import CassetteAgent
+from ..agent import CassetteAgent, RoutingAgent
+from ..cache import DecodedBodyCache
+from ..storage import JOURNAL_SUFFIX
 from .helpers import cassette_path
 
 
@@ -34,6 +41,21 @@ class CassetteAgentTestCase(FakeReactorAndConnectMixin, TestCase):
         self.assertEqual(request.method, 'GET')
         self.assertEqual(request.absoluteURI, 'http://room208.org/')
 
+    @inlineCallbacks
+    def test_saved_out_of_order(self):
+        agent = CassetteAgent(self.agent, cassette_path('room208'))
+        second = yield agent.request('GET', 'https://room208.org/')
+        first = yield agent.request('GET', 'HTTP://Room208.org:80/')
+        self.assertEqual(second.code, 200)
+        self.assertEqual(first.code, 301)
+        self.assertEqual(len(self.protocol.requests), 0)
+
+    def test_saved_exhausted(self):
+        agent = CassetteAgent(self.agent, cassette_path('room208'))
+        agent.request('GET', 'http://room208.org/')
+        finished = agent.request('GET', 'http://room208.org/')
+        return self.assertFailure(finished, IOError)
+
     def test_saved_mismatch(self):
         agent = CassetteAgent(self.agent, cassette_path('room208'))
         finished = agent.request('GET', 'http://foo.test/')
@@ -96,3 +118,240 @@ class CassetteAgentTestCase(FakeReactorAndConnectMixin, TestCase):
             returnValue(agent_response)
         finished.addCallback(assert_intact_headers)
         return finished
+
+    def test_incremental(self):
+        path = self.mktemp()
+        agent = CassetteAgent(self.agent, path, incremental=True)
+        finished = agent.request('GET', 'http://foo.test/')
+        request, result = self.protocol.requests.pop()
+        response = Response._construct(('HTTP', 1, 1), 200, 'OK', Headers(),
+                                       AbortableStringTransport(), request)
+        response._bodyDataReceived('foo')
+        response._bodyDataFinished()
+        result.callback(response)
+        finished.addCallback(readBody)
+        def assert_journaled(deferred_result):
+            with open(path + JOURNAL_SUFFIX) as journal_file:
+                self.assertEqual(len(journal_file.readlines()), 1)
+            agent.save()
+            with open(path) as cassette_file:
+                interaction = json.load(cassette_file)['http_interactions'][0]
+            self.assertEqual(interaction['response']['body']['string'], 'foo')
+            return deferred_result
+        finished.addCallback(assert_journaled)
+        return finished
+
+    def test_save_async(self):
+        path = self.mktemp()
+        agent = CassetteAgent(self.agent, path)
+        finished = agent.request('GET', 'http://foo.test/')
+        request, result = self.protocol.requests.pop()
+        response = Response._construct(('HTTP', 1, 1), 200, 'OK', Headers(),
+                                       AbortableStringTransport(), request)
+        response._bodyDataReceived('foo')
+        response._bodyDataFinished()
+        result.callback(response)
+        finished.addCallback(readBody)
+        finished.addCallback(agent.save_async)
+        def assert_saved(deferred_result):
+            self.assertEqual(deferred_result, 'foo')
+            with open(path) as cassette_file:
+                interaction = json.load(cassette_file)['http_interactions'][0]
+            self.assertEqual(interaction['response']['body']['string'], 'foo')
+        finished.addCallback(assert_saved)
+        return finished
+
+    def respond(self, body):
+        request, result = self.protocol.requests.pop()
+        response = Response._construct(('HTTP', 1, 1), 200, 'OK', Headers(),
+                                       AbortableStringTransport(), request)
+        response._bodyDataReceived(body)
+        response._bodyDataFinished()
+        result.callback(response)
+
+    def saved_uris(self, path):
+        with open(path) as cassette_file:
+            return [interaction['request']['uri'] for interaction in
+                    json.load(cassette_file)['http_interactions']]
+
+    def test_new_episodes(self):
+        path = self.mktemp()
+        shutil.copy(cassette_path('room208'), path)
+        agent = CassetteAgent(self.agent, path, record_mode='new_episodes')
+        self.successResultOf(agent.request('GET', 'http://room208.org/'))
+        self.assertEqual(len(self.protocol.requests), 0)
+        for uri in ('http://room208.org/', 'http://foo.test/'):
+            finished = agent.request('GET', uri)
+            self.respond(uri)
+            self.assertEqual(self.successResultOf(finished.addCallback(
+                readBody)), uri)
+        agent.save()
+        self.assertEqual(self.saved_uris(path), [
+            'http://room208.org/', 'https://room208.org/',
+            'http://room208.org/', 'http://foo.test/'])
+
+    def test_save_twice(self, incremental=False):
+        path = self.mktemp()
+        agent = CassetteAgent(self.agent, path, spool_threshold=2,
+                              incremental=incremental)
+        responses = []
+        for uri in ('http://foo.test/', 'http://bar.test/'):
+            finished = agent.request('GET', uri)
+            self.respond(uri)
+            responses.append(self.successResultOf(finished))
+            self.successResultOf(readBody(responses[-1]))
+            agent.save()
+        self.assertEqual(self.saved_uris(path),
+                         ['http://foo.test/', 'http://bar.test/'])
+        for response in responses:
+            self.assertTrue(response.original.buffer().file.closed)
+        self.assertFalse(os.path.exists(path + JOURNAL_SUFFIX))
+        agent.save()
+        self.assertEqual(len(self.saved_uris(path)), 2)
+
+    def test_save_twice_incremental(self):
+        self.test_save_twice(incremental=True)
+
+    def test_journal_failure_logged(self):
+        agent = CassetteAgent(self.agent, self.mktemp(), incremental=True)
+        def write(_):
+            raise IOError('disk full')
+        agent.journal.write = write
+        finished = agent.request('GET', 'http://foo.test/')
+        self.respond('foo')
+        self.successResultOf(finished.addCallback(readBody))
+        self.assertEqual(len(self.flushLoggedErrors(IOError)), 1)
+
+    def test_all(self):
+        path = self.mktemp()
+        shutil.copy(cassette_path('room208'), path)
+        agent = CassetteAgent(self.agent, path, record_mode='all')
+        finished = agent.request('GET', 'http://room208.org/')
+        self.respond('foo')
+        self.successResultOf(finished.addCallback(readBody))
+        agent.save()
+        self.assertEqual(self.saved_uris(path), [
+            'https://room208.org/', 'http://room208.org/'])
+
+    def test_incremental_directory(self):
+        path = self.mktemp() + os.sep
+        agent = CassetteAgent(self.agent, path, incremental=True)
+        finished = agent.request('GET', 'http://foo.test/')
+        self.respond('foo')
+        self.successResultOf(finished.addCallback(readBody))
+        self.assertEqual(len(os.listdir(os.path.join(path, 'interactions'))),
+                         1)
+        agent.save()
+        agent = CassetteAgent(self.agent, path, lazy=True)
+        finished = agent.request('GET', 'http://foo.test/')
+        self.assertEqual(
+            self.successResultOf(finished.addCallback(readBody)), 'foo')
+
+    def test_unknown_record_mode(self):
+        self.assertRaises(ValueError, CassetteAgent, self.agent, '',
+                          record_mode='none')
+
+    def test_timings_recorded(self):
+        clock = Clock()
+        agent = CassetteAgent(self.agent, '', clock=clock)
+        finished = agent.request('GET', 'http://foo.test/')
+        request, result = self.protocol.requests.pop()
+        response = Response._construct(('HTTP', 1, 1), 200, 'OK', Headers(),
+                                       AbortableStringTransport(), request)
+        clock.advance(2)
+        result.callback(response)
+        finished.addCallback(readBody)
+        clock.advance(3)
+        response._bodyDataFinished()
+        self.successResultOf(finished)
+        interaction = agent.cassette.as_dict()['http_interactions'][0]
+        self.assertEqual(interaction['timings'],
+                         {'time_to_headers': 2, 'time_to_last_byte': 5})
+
+    def test_timings_replayed(self):
+        with open(cassette_path('room208')) as cassette_file:
+            dct = json.load(cassette_file)
+        dct['http_interactions'][0]['timings'] = {
+            'time_to_headers': 2, 'time_to_last_byte': 5}
+        path = self.mktemp()
+        with open(path, 'w') as cassette_file:
+            json.dump(dct, cassette_file)
+        clock = Clock()
+        agent = CassetteAgent(self.agent, path, clock=clock, time_scale=0.5)
+        finished = agent.request('GET', 'http://room208.org/')
+        self.assertNoResult(finished)
+        clock.advance(1)
+        finished = readBody(self.successResultOf(finished))
+        clock.advance(1)
+        self.assertNoResult(finished)
+        clock.advance(0.5)
+        self.assertEqual(len(self.successResultOf(finished)), 178)
+
+    def test_decoded_bodies(self):
+        cache = DecodedBodyCache()
+        agent = ContentDecoderAgent(
+            CassetteAgent(self.agent, cassette_path('room208'),
+                          body_cache=cache), [('gzip', GzipDecoder)])
+        uri = 'https://room208.org/'
+        response = self.successResultOf(agent.request('GET', uri))
+        self.assertNotIn('gzip', response.headers.getRawHeaders(
+            'Content-Encoding', []))
+        self.assertEqual(response.length, len(response.value()))
+        self.assertEqual(len(response.raw_value()), 509)
+        self.assertIn('<html', response.value())
+        # Requests that don't accept gzip get the saved bytes.
+        agent = CassetteAgent(self.agent, cassette_path('room208'),
+                              body_cache=cache)
+        response = self.successResultOf(agent.request('GET', uri))
+        self.assertEqual(response.headers.getRawHeaders('Content-Encoding'),
+                         ['gzip'])
+        self.assertEqual(len(response.value()), 509)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+
+class RoutingAgentTestCase(FakeReactorAndConnectMixin, TestCase):
+    def setUp(self):
+        self.reactor = self.Reactor()
+        self.agent = self.buildAgentForWrapperTest(self.reactor)
+        self.connect(None)
+        self.path = self.mktemp()
+        shutil.copy(cassette_path('room208'), self.path)
+
+    def test_route(self):
+        agent = RoutingAgent(self.agent, {
+            'Room208.org': 'host.json',
+            'https://room208.org/': 'prefix.json',
+            'https://room208.org/api/': 'api.json'}, 'default.json')
+        self.assertEqual(agent.route('http://room208.org/'), 'host.json')
+        self.assertEqual(agent.route('https://room208.org/'), 'prefix.json')
+        self.assertEqual(agent.route('https://room208.org:443/api/v1'),
+                         'api.json')
+        self.assertEqual(agent.route('http://foo.test/'), 'default.json')
+
+    def test_lazy_loading(self):
+        agent = RoutingAgent(self.agent, {'room208.org': self.path,
+                                          'foo.test': self.mktemp()})
+        self.successResultOf(agent.request('GET', 'http://room208.org/'))
+        self.assertEqual(agent.agents.keys(), [self.path])
+        self.failureResultOf(agent.request('GET', 'http://bar.test/'),
+                             IOError)
+
+    def test_save_changed(self):
+        new_path = self.mktemp()
+        agent = RoutingAgent(self.agent, {'room208.org': self.path,
+                                          'foo.test': new_path},
+                             record_mode='new_episodes')
+        self.successResultOf(agent.request('GET', 'http://room208.org/'))
+        finished = agent.request('GET', 'http://foo.test/')
+        request, result = self.protocol.requests.pop()
+        response = Response._construct(('HTTP', 1, 1), 200, 'OK', Headers(),
+                                       AbortableStringTransport(), request)
+        response._bodyDataFinished()
+        result.callback(response)
+        self.successResultOf(finished.addCallback(readBody))
+        self.assertEqual(agent.changed(), [agent.agents[new_path]])
+        os.utime(self.path, (1000, 1000))
+        self.assertEqual(agent.save('foo'), 'foo')
+        self.assertEqual(os.path.getmtime(self.path), 1000)
+        self.assertTrue(os.path.exists(new_path))
+        self.assertEqual(agent.changed(), [])
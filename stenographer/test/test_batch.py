@@ -0,0 +1,61 @@
+"""Batch recording tests."""
+# pylint: disable=missing-docstring
+
+
+import json
+import os
+
+from twisted.trial.unittest import TestCase
+
+from ..batch import plan_jobs, record_manifest
+
+
+class PlanJobsTestCase(TestCase):
+    def setUp(self):
+        self.directory = self.mktemp()
+        os.mkdir(self.directory)
+        self.manifest_path = os.path.join(self.directory, 'manifest.json')
+        with open(self.manifest_path, 'w') as manifest_file:
+            json.dump({'fresh.json': ['http://example.com/a'],
+                       'stale.json': ['http://example.com/b'],
+                       'missing.json': ['http://example.com/c']},
+                      manifest_file)
+        os.utime(self.manifest_path, (1000, 1000))
+        for name, mtime in (('fresh.json', 2000), ('stale.json', 0)):
+            path = os.path.join(self.directory, name)
+            open(path, 'w').close()
+            os.utime(path, (mtime, mtime))
+
+    def path(self, name):
+        return os.path.join(os.path.abspath(self.directory), name)
+
+    def test_skip_up_to_date(self):
+        jobs, skipped = plan_jobs(self.manifest_path)
+        self.assertEqual(jobs, [
+            (self.path('missing.json'), ['http://example.com/c']),
+            (self.path('stale.json'), ['http://example.com/b'])])
+        self.assertEqual(skipped, [self.path('fresh.json')])
+
+    def test_force(self):
+        jobs, skipped = plan_jobs(self.manifest_path, force=True)
+        self.assertEqual([path for path, _ in jobs], [
+            self.path('fresh.json'), self.path('missing.json'),
+            self.path('stale.json')])
+        self.assertEqual(skipped, [])
+
+
+class RecordManifestTestCase(TestCase):
+    def test_worker(self):
+        directory = self.mktemp()
+        os.mkdir(directory)
+        manifest_path = os.path.join(directory, 'manifest.json')
+        with open(manifest_path, 'w') as manifest_file:
+            json.dump({'refused.json': ['http://127.0.0.1:1/']},
+                      manifest_file)
+        summary = record_manifest(manifest_path, processes=1)
+        cassette_path = os.path.join(os.path.abspath(directory),
+                                     'refused.json')
+        result = summary['cassettes'][cassette_path]
+        self.assertEqual(result['status'], 'failed')
+        self.assertEqual(len(result['failures']), 1)
+        self.assertFalse(os.path.exists(cassette_path))
@@ -0,0 +1,36 @@
+"""Binary cassette format tests."""
+# pylint: disable=missing-docstring,too-few-public-methods
+
+
+import json
+
+from twisted.trial.unittest import TestCase
+
+from ..binary import MAGIC
+from ..storage import convert_cassette, load_cassette
+from .helpers import cassette_path
+
+
+class BinaryCassetteTestCase(TestCase):
+    def setUp(self):
+        self.binary_path = self.mktemp()
+        convert_cassette(cassette_path('room208'), self.binary_path,
+                         binary=True)
+
+    def test_load(self):
+        with open(self.binary_path, 'rb') as binary_file:
+            self.assertEqual(binary_file.read(len(MAGIC)), MAGIC)
+        binary = load_cassette(self.binary_path)
+        original = load_cassette(cassette_path('room208'))
+        self.assertEqual(len(binary), len(original))
+        for saved, converted in zip(original, binary):
+            self.assertEqual(saved.code, converted.code)
+            self.assertEqual(saved.value(), converted.value())
+
+    def test_round_trip(self):
+        json_path = self.mktemp()
+        convert_cassette(self.binary_path, json_path)
+        with open(cassette_path('room208')) as cassette_file:
+            original = json.load(cassette_file)
+        with open(json_path) as cassette_file:
+            self.assertEqual(json.load(cassette_file), original)
@@ -0,0 +1,56 @@
+"""Blob store tests."""
+# pylint: disable=missing-docstring,too-few-public-methods
+
+
+import json
+import os
+
+from twisted.trial.unittest import TestCase
+
+from ..blobs import BlobStore
+from ..cassette import Cassette
+from ..proxy import SpooledBuffer
+from .helpers import cassette_path
+
+
+class BlobStoreTestCase(TestCase):
+    def setUp(self):
+        self.store = BlobStore(self.mktemp())
+
+    def test_put_once(self):
+        buf = SpooledBuffer(threshold=2)
+        buf.write('foobar')
+        digest = self.store.put('foobar')
+        self.assertEqual(self.store.put(buf), digest)
+        self.assertEqual(os.listdir(self.store.path), [digest[:2]])
+        self.assertEqual(self.store.get(digest), 'foobar')
+
+    def test_permissions(self):
+        umask = os.umask(0o022)
+        self.addCleanup(os.umask, umask)
+        digest = self.store.put('foobar')
+        mode = os.stat(self.store.blob_path(digest)).st_mode
+        self.assertEqual(mode & 0o777, 0o644)
+
+    def test_bounded_cache(self):
+        store = BlobStore(self.store.path, max_cache_bytes=6)
+        digests = [self.store.put(data) for data in ('foo', 'bar', 'baz')]
+        first = store.get(digests[0])
+        self.assertIs(store.get(digests[0]), first)
+        store.get(digests[1])
+        store.get(digests[2])
+        self.assertEqual(store.get(digests[0]), 'foo')
+        self.assertIsNot(store.get(digests[0]), first)
+        self.assertEqual(store.get(self.store.put('foobarbaz')),
+                         'foobarbaz')
+
+    def test_cassette_round_trip(self):
+        with open(cassette_path('room208')) as cassette_file:
+            serialized = json.load(cassette_file)
+        serialized['http_interactions'] *= 2
+        cassette = Cassette.from_dict(serialized, blob_store=self.store)
+        deduplicated = cassette.as_dict()
+        body = deduplicated['http_interactions'][0]['response']['body']
+        self.assertIn('blob', body)
+        cassette = Cassette.from_dict(deduplicated, blob_store=self.store)
+        self.assertIs(cassette[1].value(), cassette[3].value())
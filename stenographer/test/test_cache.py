@@ -0,0 +1,83 @@
+"""Cassette cache tests."""
+# pylint: disable=missing-docstring,too-few-public-methods
+
+
+from gzip import GzipFile
+from io import BytesIO
+import os
+import shutil
+import zlib
+
+from twisted.trial.unittest import TestCase
+
+from ..cache import CassetteCache, DecodedBodyCache
+from .helpers import cassette_path
+
+
+class CassetteCacheTestCase(TestCase):
+    def setUp(self):
+        self.cache = CassetteCache()
+        self.path = self.mktemp()
+        shutil.copy(cassette_path('room208'), self.path)
+
+    def test_hit(self):
+        first = self.cache.load(self.path)
+        second = self.cache.load(self.path)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+        self.assertIsNot(first[0], second[0])
+        first[0].headers.addRawHeader('Server', 'Twisted')
+        self.assertEqual(second[0].headers.getRawHeaders('Server'),
+                         ['nginx'])
+
+    def test_shared_records(self):
+        first = self.cache.load(self.path)
+        second = self.cache.load(self.path)
+        self.assertIs(first.record(1), second.record(1))
+        lazy = self.cache.load(self.path, lazy=True)
+        self.assertIs(lazy.responses[1], first.record(1))
+
+    def test_modified(self):
+        self.cache.load(self.path)
+        os.utime(self.path, (0, 0))
+        self.cache.load(self.path)
+        self.assertEqual(self.cache.stats()['misses'], 2)
+        self.assertEqual(self.cache.stats()['entries'], 1)
+
+    def test_eviction(self):
+        self.cache.max_entries = 1
+        self.cache.load(self.path)
+        self.cache.load(cassette_path('room208'))
+        self.cache.load(self.path)
+        self.assertEqual(self.cache.stats()['misses'], 3)
+        self.assertEqual(self.cache.stats()['evictions'], 2)
+
+
+def gzip_encode(string):
+    out = BytesIO()
+    with GzipFile(fileobj=out, mode='wb') as gzip_file:
+        gzip_file.write(string)
+    return out.getvalue()
+
+
+class DecodedBodyCacheTestCase(TestCase):
+    def setUp(self):
+        self.cache = DecodedBodyCache()
+
+    def test_hit(self):
+        body = gzip_encode('foo')
+        self.assertEqual(self.cache.decode(body), 'foo')
+        self.assertEqual(self.cache.decode(body), 'foo')
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['size'], 3)
+
+    def test_eviction(self):
+        self.cache.max_bytes = 5
+        for string in ('foo', 'bar', 'foo'):
+            self.cache.decode(gzip_encode(string))
+        stats = self.cache.stats()
+        self.assertEqual((stats['misses'], stats['evictions']), (3, 2))
+        self.assertEqual(stats['entries'], 1)
+
+    def test_invalid(self):
+        self.assertRaises(zlib.error, self.cache.decode, 'foo')
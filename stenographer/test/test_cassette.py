@@ -7,7 +7,8 @@ import json
 from twisted.trial.unittest import TestCase
 from twisted.web.iweb import UNKNOWN_LENGTH
 
-from ..cassette import Cassette
+from ..cassette import (Cassette, Interaction, normalize_uri,
+                        parse_recorded_at)
 from .helpers import cassette_path
 
 
@@ -29,6 +30,74 @@ class CassetteLoadTestCase(TestCase):
         self.assertEqual(cassette[1].phrase, 'OK')
         self.assertEqual(cassette[1].length, UNKNOWN_LENGTH)
 
+    def test_recorded_at_formats(self):
+        with open(cassette_path('room208')) as cassette_file:
+            serialized = json.load(cassette_file)
+        interactions = serialized['http_interactions']
+        interactions[0]['recorded_at'] = '2014-04-12T21:58:49'
+        interactions[1]['recorded_at'] = 'yesterday'
+        cassette = Cassette.from_dict(serialized)
+        self.assertEqual(cassette.record(0).started, 1397339929)
+        self.assertIs(cassette.record(1).started, None)
+        self.assertNotIn('recorded_at',
+                         cassette.as_dict()['http_interactions'][1])
+        self.assertEqual(parse_recorded_at('2014-04-12T23:58:49.5+02:00'),
+                         1397339929)
+        self.assertEqual(parse_recorded_at('Sat, 12 Apr 2014 21:58:49 GMT'),
+                         1397339929)
+
+
+class CassetteLazyLoadTestCase(TestCase):
+    def setUp(self):
+        with open(cassette_path('room208')) as cassette_file:
+            self.serialized = json.load(cassette_file)
+
+    def test_materialize(self):
+        cassette = Cassette.from_dict(self.serialized, lazy=True)
+        self.assertEqual(cassette.responses, [None, None])
+        response = cassette[1]
+        self.assertEqual(response.code, 200)
+        self.assertIsInstance(cassette.responses[1], Interaction)
+        self.assertIs(cassette.responses[0], None)
+
+    def test_fresh_responses(self):
+        cassette = Cassette.from_dict(self.serialized)
+        first = cassette[1]
+        self.assertIsNot(cassette[1], first)
+        self.assertEqual(cassette[1].value(), first.value())
+
+    def test_round_trip(self):
+        cassette = Cassette.from_dict(self.serialized, lazy=True)
+        self.assertEqual(cassette.as_dict()['http_interactions'],
+                         self.serialized['http_interactions'])
+
+
+class CassetteIndexTestCase(TestCase):
+    def setUp(self):
+        with open(cassette_path('room208')) as cassette_file:
+            serialized = json.load(cassette_file)
+        serialized['http_interactions'] *= 2
+        self.serialized = serialized
+
+    def test_fifo(self):
+        cassette = Cassette.from_dict(self.serialized)
+        key = cassette.request_key('GET', 'https://room208.org/')
+        self.assertEqual(cassette.index[key], [1, 3])
+        self.assertEqual(cassette[cassette.index[key][1]].code, 200)
+
+    def test_match_on_headers(self):
+        cassette = Cassette.from_dict(self.serialized,
+                                      ('method', 'uri', 'Accept-Encoding'))
+        self.assertNotIn(
+            cassette.request_key('GET', 'https://room208.org/'),
+            cassette.index)
+
+    def test_normalize_uri(self):
+        self.assertEqual(normalize_uri('HTTPS://Room208.ORG:443/A?b#c'),
+                         'https://room208.org/A?b')
+        self.assertEqual(normalize_uri('http://room208.org:8080/'),
+                         'http://room208.org:8080/')
+
 
 class CassetteRoundTripTestCase(TestCase):
     def test_room208(self):
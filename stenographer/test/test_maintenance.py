@@ -0,0 +1,65 @@
+"""Cassette maintenance tests."""
+# pylint: disable=missing-docstring
+
+
+import os
+import shutil
+
+from twisted.trial.unittest import TestCase
+
+from ..maintenance import (cassette_stats, compact_body, dedupe_cassette,
+                           find_cassettes, maintain, merge_cassettes,
+                           prune_cassette)
+from ..storage import convert_cassette, read_cassette
+from .helpers import cassette_path
+
+
+class MaintenanceTestCase(TestCase):
+    def setUp(self):
+        self.directory = self.mktemp()
+        os.makedirs(os.path.join(self.directory, 'nested'))
+        self.path = os.path.join(self.directory, 'room208.json')
+        shutil.copy(cassette_path('room208'), self.path)
+
+    def test_find_cassettes(self):
+        binary_path = os.path.join(self.directory, 'nested', 'binary')
+        convert_cassette(self.path, binary_path, binary=True)
+        convert_cassette(self.path, os.path.join(self.directory, 'dir/'))
+        with open(os.path.join(self.directory, 'notes.txt'), 'w') as notes:
+            notes.write('not a cassette\n')
+        self.assertEqual(
+            sorted(find_cassettes([self.directory])),
+            sorted([self.path, binary_path,
+                    os.path.join(self.directory, 'dir')]))
+
+    def test_stats(self):
+        stats = cassette_stats(self.path)
+        self.assertEqual(stats['interactions'], 2)
+        self.assertEqual(stats['body_bytes'], 178 + 509)
+        self.assertEqual(stats['base64_overhead'], 171)
+        self.assertEqual(stats['duplicate_bodies'], 0)
+
+    def test_compact_body(self):
+        text = {'body': {'encoding': 'utf-8', 'base64_string': 'aGk='}}
+        self.assertEqual(compact_body(text),
+                         {'encoding': 'utf-8', 'string': u'hi'})
+        binary = {'body': {'encoding': 'utf-8', 'base64_string': '/w=='}}
+        self.assertEqual(compact_body(binary), binary['body'])
+
+    def test_merge_and_dedupe(self):
+        merged_path = os.path.join(self.directory, 'merged.json')
+        self.assertEqual(
+            merge_cassettes([self.path, self.path], merged_path), 4)
+        self.assertEqual(cassette_stats(merged_path)['duplicate_bodies'], 2)
+        self.assertEqual(dedupe_cassette(merged_path)['dropped'], 2)
+        self.assertEqual(read_cassette(merged_path)[0]['http_interactions'],
+                         read_cassette(self.path)[0]['http_interactions'])
+
+    def test_prune(self):
+        results = maintain(prune_cassette, [self.directory], processes=1,
+                           keep=['HTTP://room208.org:80/'])
+        self.assertEqual(results[self.path]['dropped'], 1)
+        dct, _ = read_cassette(self.path)
+        self.assertEqual([interaction['request']['uri'] for interaction
+                          in dct['http_interactions']],
+                         ['http://room208.org/'])
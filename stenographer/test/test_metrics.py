@@ -0,0 +1,46 @@
+"""Instrumentation tests."""
+# pylint: disable=missing-docstring
+
+
+from itertools import count
+
+from twisted.trial.unittest import TestCase
+
+from ..agent import CassetteAgent
+from ..metrics import Metrics
+from .helpers import cassette_path
+
+
+class MetricsTestCase(TestCase):
+    def setUp(self):
+        self.metrics = Metrics(timer=count().next)
+        self.events = []
+        self.metrics.add_observer(self.events.append)
+
+    def test_counters(self):
+        self.metrics.emit('record', bytes=10, seconds=2)
+        self.metrics.emit('record', bytes=5, seconds=None)
+        self.assertEqual(self.metrics.stats(), {
+            'record': 2, 'record.bytes': 15, 'record.seconds': 2})
+        self.assertEqual(self.events[0],
+                         {'event': 'record', 'bytes': 10, 'seconds': 2})
+        self.metrics.reset()
+        self.assertEqual(self.metrics.stats(), {})
+
+    def test_remove_observer(self):
+        self.metrics.remove_observer(self.events.append)
+        self.metrics.emit('save')
+        self.assertEqual(self.events, [])
+
+    def test_agent(self):
+        path = cassette_path('room208')
+        agent = CassetteAgent(None, path, metrics=self.metrics)
+        agent.request('GET', 'http://room208.org/')
+        self.failureResultOf(agent.request('GET', 'http://room208.org/'),
+                             IOError)
+        self.assertEqual([event['event'] for event in self.events],
+                         ['parse', 'load', 'replay.match', 'replay.mismatch'])
+        self.assertEqual(self.events[1]['path'], path)
+        self.assertEqual(self.events[1]['interactions'], 2)
+        self.assertEqual(self.events[2]['uri'], 'http://room208.org/')
+        self.assertEqual(self.metrics.stats()['replay.match.seconds'], 1)
@@ -6,12 +6,18 @@ from io import BytesIO
 from textwrap import dedent
 
 from twisted.internet.defer import inlineCallbacks
+from twisted.internet.error import ConnectionLost
+from twisted.internet.protocol import Protocol
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
 from twisted.trial.unittest import TestCase
-from twisted.web.client import FileBodyProducer, Response, readBody
+from twisted.web.client import (FileBodyProducer, Response, ResponseDone,
+                                readBody)
 from twisted.web.http_headers import Headers
 from twisted.web.test.test_agent import AbortableStringTransport
 
-from ..proxy import RecordingBodyProducer, RecordingResponse
+from ..proxy import (RecordingBodyProducer, RecordingResponse,
+                     SavedResponse, SpooledBuffer, StreamingResponse)
 
 
 LOREM_IPSUM = dedent("""\
@@ -25,6 +31,35 @@ LOREM_IPSUM = dedent("""\
     suscil.""")
 
 
+class SpooledBufferTestCase(TestCase):
+    def test_in_memory(self):
+        buf = SpooledBuffer()
+        buf.write(LOREM_IPSUM)
+        self.assertEqual(len(buf), len(LOREM_IPSUM))
+        self.assertEqual(buf.value(), LOREM_IPSUM)
+        self.assertEqual(buf.view(), LOREM_IPSUM)
+
+    def test_spilled(self):
+        buf = SpooledBuffer(threshold=16)
+        buf.write(LOREM_IPSUM[:10])
+        buf.write(LOREM_IPSUM[10:])
+        self.assertEqual(len(buf), len(LOREM_IPSUM))
+        self.assertEqual(''.join(buf.chunks(7)), LOREM_IPSUM)
+        self.assertEqual(buf.value(), LOREM_IPSUM)
+        view = buf.view()
+        self.assertEqual(len(view), len(LOREM_IPSUM))
+        self.assertEqual(view[5:50], LOREM_IPSUM[5:50])
+        view.close()
+        pieces = []
+        for piece in buf.slices(7):
+            self.assertIsInstance(piece, buffer)
+            pieces.append(str(piece))
+        self.assertEqual(''.join(pieces), LOREM_IPSUM)
+        buf.close()
+        self.assertTrue(buf.file.closed)
+        self.assertEqual(len(buf), len(LOREM_IPSUM))
+
+
 class RecordingBodyProducerTestCase(TestCase):
     @inlineCallbacks
     def test_proxy_filebodyproducer(self):
@@ -48,3 +83,65 @@ class RecordingReadBodyProtocolTestCase(TestCase):
         body = yield readBody(proxy)
         self.assertEqual(body, LOREM_IPSUM)
         self.assertEqual(proxy.value(), LOREM_IPSUM)
+        yield proxy.notifyFinish()
+
+    def test_truncated(self):
+        original = Response(('HTTP', 1, 1), 200, 'OK', Headers(),
+                            AbortableStringTransport())
+        proxy = RecordingResponse(original)
+        finished = proxy.notifyFinish()
+        proxy.deliverBody(ChunkRecordingProtocol())
+        original._bodyDataReceived(LOREM_IPSUM[:10])
+        original._bodyDataFinished(Failure(ConnectionLost()))
+        self.failureResultOf(finished, ConnectionLost)
+        self.failureResultOf(proxy.notifyFinish(), ConnectionLost)
+
+
+class ChunkRecordingProtocol(Protocol):
+    def __init__(self, pause=False):
+        self.pause = pause
+        self.chunks = []
+        self.reason = None
+
+    def dataReceived(self, data):
+        self.chunks.append(data)
+        if self.pause:
+            self.transport.pauseProducing()
+
+    def connectionLost(self, reason):
+        self.reason = reason
+
+
+class StreamingResponseTestCase(TestCase):
+    def setUp(self):
+        original = Response(('HTTP', 1, 1), 200, 'OK', Headers(),
+                            AbortableStringTransport())
+        self.clock = Clock()
+        self.response = StreamingResponse(
+            SavedResponse(original, LOREM_IPSUM), 100, self.clock)
+
+    def test_chunks(self):
+        protocol = ChunkRecordingProtocol()
+        self.response.deliverBody(protocol)
+        self.assertEqual(protocol.chunks, [])
+        self.clock.advance(0)
+        self.assertEqual(''.join(protocol.chunks), LOREM_IPSUM)
+        self.assertEqual(len(protocol.chunks), len(LOREM_IPSUM) // 100 + 1)
+        protocol.reason.trap(ResponseDone)
+
+    def test_value(self):
+        self.assertEqual(self.response.value(), LOREM_IPSUM)
+        self.assertEqual(self.response.raw_value(), LOREM_IPSUM)
+
+    def test_pause(self):
+        protocol = ChunkRecordingProtocol(pause=True)
+        self.response.deliverBody(protocol)
+        self.clock.pump([0] * 3)
+        self.assertEqual(protocol.chunks, [LOREM_IPSUM[:100]])
+        self.response.resumeProducing()
+        self.clock.advance(0)
+        self.assertEqual(protocol.chunks, [LOREM_IPSUM[:100],
+                                           LOREM_IPSUM[100:200]])
+        self.response.stopProducing()
+        self.assertIsNot(protocol.reason, None)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
@@ -0,0 +1,57 @@
+"""Bulk recorder tests."""
+# pylint: disable=missing-docstring,too-few-public-methods
+
+
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from ..recorder import Recorder
+
+
+class FakeAgent(object):
+    def __init__(self):
+        self.requests = []
+
+    def request(self, method, uri, headers=None, bodyProducer=None):
+        deferred = Deferred()
+        self.requests.append((uri, deferred))
+        return deferred
+
+
+class RecorderTestCase(TestCase):
+    def setUp(self):
+        self.agent = FakeAgent()
+        self.clock = Clock()
+        self.recorder = Recorder(self.agent, concurrency=3, per_host=2,
+                                 clock=self.clock)
+        self.consumed = []
+
+    def uris(self, count):
+        for i in xrange(count):
+            uri = 'http://{}.test/{}'.format(i % 2, i)
+            self.consumed.append(uri)
+            yield uri
+
+    def test_bounded(self):
+        finished = self.recorder.fetch_all(self.uris(10))
+        self.clock.advance(0)
+        self.assertEqual(len(self.consumed), 3)
+        self.assertEqual(len(self.agent.requests), 3)
+        _, deferred = self.agent.requests.pop(0)
+        deferred.errback(ValueError('oops'))
+        self.clock.advance(0)
+        self.assertEqual(len(self.consumed), 4)
+        while self.agent.requests:
+            _, deferred = self.agent.requests.pop(0)
+            deferred.errback(ValueError('oops'))
+            self.clock.advance(0)
+        self.successResultOf(finished)
+        self.assertEqual(len(self.consumed), 10)
+        self.assertEqual(len(self.recorder.failures), 10)
+
+    def test_per_host(self):
+        self.recorder.fetch_all(['http://a.test/{}'.format(i)
+                                 for i in xrange(5)])
+        self.clock.advance(0)
+        self.assertEqual(len(self.agent.requests), 2)
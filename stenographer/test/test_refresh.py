@@ -0,0 +1,133 @@
+"""Cassette refresh tests."""
+# pylint: disable=missing-docstring
+
+
+from email.utils import formatdate
+import json
+import os.path
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.protocol import Factory, Protocol
+from twisted.trial.unittest import TestCase
+from twisted.web.client import Agent, readBody
+from twisted.web.http import CACHED
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+
+from ..agent import CassetteAgent
+from ..refresh import Refresher
+from ..storage import load_cassette, read_cassette, save_cassette
+
+
+class VersionedResource(Resource):
+    isLeaf = True
+
+    def __init__(self):
+        Resource.__init__(self)
+        self.version = 1
+        self.requests = 0
+        self.code = None
+
+    def render_GET(self, request):
+        self.requests += 1
+        if self.code is not None:
+            request.setResponseCode(self.code)
+            return 'error'
+        if request.setETag('"v{}"'.format(self.version)) is CACHED:
+            return ''
+        request.setHeader('Content-Type', 'text/plain')
+        return 'version {}'.format(self.version)
+
+
+class CloseDelimitedProtocol(Protocol):
+    def dataReceived(self, data):
+        self.transport.write('HTTP/1.1 200 OK\r\n'
+                             'Content-Type: text/plain\r\n\r\n'
+                             'closed body')
+        self.transport.loseConnection()
+
+
+class RefresherTestCase(TestCase):
+    @inlineCallbacks
+    def setUp(self):
+        self.upstream = VersionedResource()
+        port = reactor.listenTCP(0, Site(self.upstream),
+                                 interface='127.0.0.1')
+        self.addCleanup(port.stopListening)
+        self.uri = 'http://127.0.0.1:{}/'.format(port.getHost().port)
+        self.path = os.path.join(self.mktemp(), 'cassette.json')
+        os.makedirs(os.path.dirname(self.path))
+        cassette_agent = CassetteAgent(Agent(reactor), self.path)
+        response = yield cassette_agent.request('GET', self.uri)
+        yield readBody(response)
+        cassette_agent.save()
+        dct, _ = read_cassette(self.path)
+        dct['http_interactions'][0]['recorded_at'] = (
+            'Fri, 21 Aug 2015 00:45:40 -0000')
+        save_cassette(dct, self.path)
+
+    def saved_body(self):
+        return load_cassette(self.path)[0].value()
+
+    @inlineCallbacks
+    def test_not_modified(self):
+        refresher = Refresher(Agent(reactor), max_age=3600)
+        summary = yield refresher.refresh(self.path)
+        self.assertEqual((summary['not_modified'], summary['body_bytes']),
+                         (1, 0))
+        self.assertEqual(self.saved_body(), 'version 1')
+        # The interaction is now fresh, so it isn't requested again.
+        summary = yield refresher.refresh(self.path)
+        self.assertEqual(summary['fresh'], 1)
+        self.assertEqual(self.upstream.requests, 2)
+
+    @inlineCallbacks
+    def test_changed(self):
+        self.upstream.version = 2
+        summary = yield Refresher(Agent(reactor)).refresh(self.path)
+        self.assertEqual(summary['changed'], 1)
+        self.assertEqual(self.saved_body(), 'version 2')
+        with open(self.path) as cassette_file:
+            interaction = json.load(cassette_file)['http_interactions'][0]
+        self.assertEqual(interaction['response']['headers']['ETag'],
+                         ['"v2"'])
+
+    @inlineCallbacks
+    def test_error_kept(self):
+        self.upstream.code = 429
+        summary = yield Refresher(Agent(reactor)).refresh(self.path)
+        self.assertEqual((summary['failed'], summary['changed']), (1, 0))
+        self.assertEqual(self.saved_body(), 'version 1')
+
+    @inlineCallbacks
+    def test_gone(self):
+        self.upstream.code = 410
+        summary = yield Refresher(Agent(reactor)).refresh(self.path)
+        self.assertEqual(summary['failed'], 1)
+        summary = yield Refresher(Agent(reactor),
+                                  replace_gone=True).refresh(self.path)
+        self.assertEqual(summary['changed'], 1)
+        self.assertEqual(self.saved_body(), 'error')
+
+    @inlineCallbacks
+    def test_close_delimited(self):
+        factory = Factory.forProtocol(CloseDelimitedProtocol)
+        port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+        self.addCleanup(port.stopListening)
+        dct, _ = read_cassette(self.path)
+        dct['http_interactions'][0]['request']['uri'] = (
+            'http://127.0.0.1:{}/'.format(port.getHost().port))
+        save_cassette(dct, self.path)
+        summary = yield Refresher(Agent(reactor)).refresh(self.path)
+        self.assertEqual((summary['changed'], summary['body_bytes']),
+                         (1, len('closed body')))
+        self.assertEqual(self.saved_body(), 'closed body')
+
+    def test_is_stale(self):
+        refresher = Refresher(Agent(reactor), max_age=3600)
+        self.assertTrue(refresher.is_stale(
+            {'recorded_at': '2014-04-12T21:58:49'}))
+        self.assertTrue(refresher.is_stale({'recorded_at': 'yesterday'}))
+        self.assertFalse(refresher.is_stale(
+            {'recorded_at': formatdate(reactor.seconds())}))
@@ -0,0 +1,127 @@
+"""Cassette server tests."""
+# pylint: disable=missing-docstring
+
+
+import os.path
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.endpoints import TCP4ClientEndpoint
+from twisted.internet.error import ConnectionDone
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.trial.unittest import TestCase
+from twisted.web.client import Agent, ProxyAgent, readBody
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET, Site
+from twisted.web.test.requesthelper import DummyRequest
+
+from ..agent import CassetteAgent
+from ..storage import load_cassette
+from ..server import CassetteResource, ProxyResource
+from .helpers import cassette_path
+
+
+class CassetteResourceTestCase(TestCase):
+    def serve(self, resource):
+        port = reactor.listenTCP(0, Site(resource), interface='127.0.0.1')
+        self.addCleanup(port.stopListening)
+        self.base = 'http://127.0.0.1:{}'.format(port.getHost().port)
+        self.agent = Agent(reactor)
+
+    @inlineCallbacks
+    def get(self, path):
+        response = yield self.agent.request('GET', self.base + path)
+        response.body = yield readBody(response)
+        returnValue(response)
+
+    @inlineCallbacks
+    def test_replay(self):
+        cassette = load_cassette(cassette_path('room208'), lazy=True)
+        resource = CassetteResource(cassette, origin='http://room208.org')
+        self.serve(resource)
+        for _ in xrange(2):
+            response = yield self.get('/')
+            self.assertEqual(response.code, 301)
+            self.assertEqual(response.headers.getRawHeaders('Location'),
+                             ['https://room208.org/'])
+            self.assertEqual(len(response.body), 178)
+        resource.once = True
+        response = yield self.get('/')
+        self.assertEqual(response.code, 404)
+
+    @inlineCallbacks
+    def test_mismatch(self):
+        cassette = load_cassette(cassette_path('room208'), lazy=True)
+        self.serve(CassetteResource(cassette))
+        response = yield self.get('/')
+        self.assertEqual(response.code, 404)
+
+    def test_time_scale(self):
+        clock = Clock()
+        cassette = load_cassette(cassette_path('room208'))
+        cassette.record(1).time_to_last_byte = 4
+        resource = CassetteResource(cassette, time_scale=0.5, clock=clock)
+        code, _, _, body, delay = resource.prepare(1)
+        self.assertEqual((code, len(body), delay), (200, 509, 2))
+
+    def test_disconnect(self):
+        clock = Clock()
+        cassette = load_cassette(cassette_path('room208'))
+        cassette.record(1).time_to_last_byte = 4
+        resource = CassetteResource(cassette, time_scale=0.5, clock=clock)
+        request = DummyRequest([''])
+        request.method = 'GET'
+        request.uri = 'https://room208.org/'
+        self.assertIs(resource.render(request), NOT_DONE_YET)
+        request.processingFailed(Failure(ConnectionDone()))
+        self.assertEqual(clock.getDelayedCalls(), [])
+        self.assertEqual((request.written, request.finished), ([], 0))
+
+
+class UpstreamResource(Resource):
+    isLeaf = True
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'text/plain')
+        return 'upstream ' * 10000
+
+
+class ProxyResourceTestCase(TestCase):
+    def listen(self, resource):
+        port = reactor.listenTCP(0, Site(resource), interface='127.0.0.1')
+        self.addCleanup(port.stopListening)
+        return port.getHost().port
+
+    @inlineCallbacks
+    def test_record(self):
+        path = os.path.join(self.mktemp(), 'cassette.json')
+        os.makedirs(os.path.dirname(path))
+        upstream = 'http://127.0.0.1:{}/'.format(
+            self.listen(UpstreamResource()))
+        cassette_agent = CassetteAgent(Agent(reactor), path)
+        agent = ProxyAgent(TCP4ClientEndpoint(
+            reactor, '127.0.0.1', self.listen(ProxyResource(cassette_agent))))
+        response = yield agent.request('GET', upstream)
+        body = yield readBody(response)
+        self.assertEqual(response.code, 200)
+        self.assertEqual(len(body), 90000)
+        cassette_agent.save()
+        cassette = load_cassette(path)
+        self.assertEqual(len(cassette), 1)
+        self.assertEqual(cassette[0].value(), body)
+        # Relative request URIs can't be proxied.
+        response = yield Agent(reactor).request(
+            'GET', 'http://127.0.0.1:{}/'.format(self.listen(
+                ProxyResource(cassette_agent))))
+        self.assertEqual(response.code, 400)
+
+    @inlineCallbacks
+    def test_agent_failure(self):
+        cassette_agent = CassetteAgent(None, cassette_path('room208'))
+        agent = ProxyAgent(TCP4ClientEndpoint(
+            reactor, '127.0.0.1', self.listen(ProxyResource(cassette_agent))))
+        response = yield agent.request('GET', 'http://example.com/')
+        body = yield readBody(response)
+        self.assertEqual(response.code, 502)
+        self.assertIn('no more saved interactions', body)
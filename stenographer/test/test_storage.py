@@ -0,0 +1,213 @@
+"""Cassette storage tests."""
+# pylint: disable=missing-docstring,too-few-public-methods
+
+
+from io import BytesIO
+import json
+import os.path
+
+from twisted.trial.unittest import TestCase
+
+from ..cassette import body_as_dict
+from ..proxy import SpooledBuffer
+from ..storage import (lzma, DirectoryWriter, JournalWriter,
+                       add_interactions, atomic_cassette_file,
+                       convert_cassette, finalize_journal,
+                       iter_json_interactions, load_cassette, read_cassette,
+                       save_cassette, stream_cassette, update_index,
+                       write_interaction)
+from .helpers import cassette_path
+
+
+class WriteInteractionTestCase(TestCase):
+    def test_spooled_bodies(self):
+        data = u'caf\xe9 \u2603 "quoted"\n'.encode('utf-8') * 1000
+        buffers = [SpooledBuffer(threshold=100) for _ in xrange(2)]
+        for buf in buffers:
+            buf.write(data)
+        out = BytesIO()
+        write_interaction(out, {
+            'request': {'body': body_as_dict(buffers[0])},
+            'response': {'body': body_as_dict(buffers[1], None, True)}})
+        expected = {
+            'request': {'body': body_as_dict(data)},
+            'response': {'body': body_as_dict(data, None, True)}}
+        self.assertEqual(json.loads(out.getvalue()),
+                         json.loads(json.dumps(expected)))
+
+
+class JournalTestCase(TestCase):
+    def test_finalize(self):
+        journal_path = self.mktemp()
+        cassette_path = self.mktemp()
+        interactions = [
+            {'request': {'body': body_as_dict(str(i))},
+             'response': {'body': body_as_dict(str(i))}} for i in xrange(2)]
+        journal = JournalWriter(journal_path)
+        for interaction in interactions:
+            journal.write(interaction)
+        journal.file.write('{"request": ')  # interrupted write
+        journal.close()
+        finalize_journal(journal_path, cassette_path)
+        with open(cassette_path) as cassette_file:
+            dct = json.load(cassette_file)
+        self.assertEqual(dct['http_interactions'], interactions)
+        self.assertFalse(os.path.exists(journal_path))
+
+    def test_resume(self):
+        journal_path = self.mktemp()
+        cassette_path = self.mktemp()
+        interactions = [
+            {'request': {'body': body_as_dict(str(i))},
+             'response': {'body': body_as_dict(str(i))}} for i in xrange(2)]
+        journal = JournalWriter(journal_path)
+        journal.write(interactions[0])
+        journal.file.write('{"request": ')  # interrupted write
+        journal.close()
+        journal = JournalWriter(journal_path)
+        journal.write(interactions[1])
+        journal.close()
+        finalize_journal(journal_path, cassette_path)
+        with open(cassette_path) as cassette_file:
+            dct = json.load(cassette_file)
+        self.assertEqual(dct['http_interactions'], interactions)
+
+
+class StreamCassetteTestCase(TestCase):
+    def test_small_chunks(self):
+        original, _ = read_cassette(cassette_path('room208'))
+        with open(cassette_path('room208'), 'rb') as cassette_file:
+            streamed = list(iter_json_interactions(cassette_file, 16))
+        self.assertEqual(streamed, original['http_interactions'])
+
+    def test_truncated(self):
+        with open(cassette_path('room208'), 'rb') as cassette_file:
+            data = cassette_file.read()
+        truncated = BytesIO(data[:data.rindex('}', 0, -2)])
+        self.assertRaises(ValueError, list, iter_json_interactions(truncated))
+
+    def test_binary(self):
+        path = self.mktemp()
+        convert_cassette(cassette_path('room208'), path, binary=True)
+        interactions, data = stream_cassette(path)
+        self.assertEqual(len(list(interactions)), 2)
+        self.assertIsNot(data, None)
+
+
+class AtomicCassetteFileTestCase(TestCase):
+    def test_interrupted(self):
+        path = self.mktemp()
+        with atomic_cassette_file(path) as cassette_file:
+            cassette_file.write('old')
+        with self.assertRaises(ValueError):
+            with atomic_cassette_file(path) as cassette_file:
+                cassette_file.write('new')
+                raise ValueError()
+        with open(path) as cassette_file:
+            self.assertEqual(cassette_file.read(), 'old')
+        self.assertEqual(os.listdir(os.path.dirname(path)),
+                         [os.path.basename(path)])
+
+
+class AddInteractionsTestCase(TestCase):
+    def test_append(self):
+        path = self.mktemp()
+        save_cassette({'recorded_with': 'Test', 'http_interactions': []},
+                      path)
+        add_interactions(path, ['1'])
+        with open(path) as cassette_file:
+            saved = cassette_file.read()
+        add_interactions(path, ['2', '3'])
+        with open(path) as cassette_file:
+            appended = cassette_file.read()
+        self.assertEqual(appended[:len(saved) - 2], saved[:-2])
+        self.assertEqual(json.loads(appended),
+                         {'recorded_with': 'Test',
+                          'http_interactions': [1, 2, 3]})
+
+    def test_rewrite(self):
+        path = self.mktemp() + '.gz'
+        convert_cassette(cassette_path('room208'), path)
+        with open(cassette_path('room208')) as cassette_file:
+            interaction = json.load(cassette_file)['http_interactions'][0]
+        add_interactions(path, [json.dumps(interaction)])
+        self.assertEqual(len(load_cassette(path)), 3)
+
+
+class DirectoryCassetteTestCase(TestCase):
+    def setUp(self):
+        self.path = self.mktemp() + os.sep
+        convert_cassette(cassette_path('room208'), self.path)
+
+    def test_round_trip(self):
+        target_path = self.mktemp()
+        convert_cassette(self.path, target_path)
+        original, _ = read_cassette(cassette_path('room208'))
+        converted, _ = read_cassette(target_path)
+        self.assertEqual(converted['http_interactions'],
+                         original['http_interactions'])
+
+    def test_lazy(self):
+        cassette = load_cassette(self.path, lazy=True)
+        self.assertEqual(len(cassette), 2)
+        self.assertNotIn('response', cassette.interactions[0])
+        self.assertEqual(cassette[1].code, 200)
+
+    def test_concurrent_writers(self):
+        original, _ = read_cassette(cassette_path('room208'))
+        first = DirectoryWriter(self.path)
+        second = DirectoryWriter(self.path)
+        first.write(original['http_interactions'][0])
+        second.write(original['http_interactions'][1])
+        first.write(original['http_interactions'][1])
+        update_index(self.path)
+        self.assertEqual(len(load_cassette(self.path)), 5)
+
+    def test_rewrite_keeps_unindexed_files(self):
+        original, _ = read_cassette(cassette_path('room208'))
+        name = DirectoryWriter(self.path).write(
+            original['http_interactions'][0])
+        convert_cassette(cassette_path('room208'), self.path)
+        self.assertTrue(os.path.exists(os.path.join(self.path, name)))
+        self.assertEqual(
+            len(os.listdir(os.path.join(self.path, 'interactions'))), 3)
+        self.assertEqual(len(load_cassette(self.path)), 2)
+
+    def test_add_interactions_replacing(self):
+        original, _ = read_cassette(cassette_path('room208'))
+        add_interactions(self.path,
+                         [json.dumps(original['http_interactions'][0])],
+                         replace_on=('method', 'uri'))
+        dct, _ = read_cassette(self.path)
+        self.assertEqual(
+            [interaction['request']['uri']
+             for interaction in dct['http_interactions']],
+            ['https://room208.org/', 'http://room208.org/'])
+        self.assertEqual(
+            len(os.listdir(os.path.join(self.path, 'interactions'))), 2)
+
+
+class CompressionTestCase(TestCase):
+    def assert_round_trip(self, extension, magic, binary=False):
+        compressed_path = self.mktemp() + extension
+        convert_cassette(cassette_path('room208'), compressed_path, binary)
+        with open(compressed_path, 'rb') as compressed_file:
+            self.assertTrue(compressed_file.read().startswith(magic))
+        original = load_cassette(cassette_path('room208'))
+        cassette = load_cassette(compressed_path)
+        self.assertEqual([r.value() for r in cassette],
+                         [r.value() for r in original])
+
+    def test_gzip(self):
+        self.assert_round_trip('.gz', '\x1f\x8b')
+
+    def test_bz2(self):
+        self.assert_round_trip('.bz2', 'BZh')
+
+    def test_xz(self):
+        self.assert_round_trip('.xz', '\xfd7zXZ\x00')
+    if lzma is None:
+        test_xz.skip = 'lzma module not available'
+
+    def test_binary_gzip(self):
+        self.assert_round_trip('.gz', '\x1f\x8b', binary=True)